@@ -0,0 +1,85 @@
+"""
+Splits numbers into bins and counts how many fall into each bin. Used
+by `histogram` (the counts are worked out here and then handed to
+matplotlib as weights) and `counts`.
+
+The counting is done in one pass over the values, using NumPy when it's
+installed and the values are all ints/floats, and otherwise a binary
+search of the bin edges for each value.
+"""
+
+import bisect
+
+np = None
+
+def load_numpy():
+    """Returns the numpy module, or None if it's not installed."""
+    global np
+    if np is None:
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            np = False
+    return np or None
+
+class BinningError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+def bin_edges(xs, num_bins=10, bin_width=None, start=0):
+    """Returns the edges of the bins, from the left edge of the first bin
+    to the right edge of the last one. If `bin_width` is given, the bins
+    are lined up with `start` (moving it back if some values come before
+    it) and cover all the values. Otherwise, `num_bins` bins of equal
+    width span the values."""
+    if not xs:
+        raise BinningError("Can't divide an empty array into bins.")
+    lo = min(xs)
+    hi = max(xs)
+    if bin_width is not None:
+        if bin_width <= 0:
+            raise BinningError(f"Bin width must be positive but was {bin_width}.")
+        if lo < start:
+            start -= bin_width*-((lo-start)//bin_width)
+        # Every value must be strictly below the last edge, except that
+        # the last bin includes its right edge.
+        n = int((hi-start)//bin_width) + 1
+        return [start + i*bin_width for i in range(n+1)]
+    if num_bins <= 0:
+        raise BinningError(f"Number of bins must be positive but was {num_bins}.")
+    if lo == hi:
+        # Same as matplotlib.
+        lo -= 0.5
+        hi += 0.5
+    width = (hi-lo)/num_bins
+    return [lo + i*width for i in range(num_bins)] + [hi]
+
+def bin_counts(xs, edges):
+    """Number of values in each bin. Bins include their left edge, and the
+    last one also includes its right edge. Values outside the bins
+    aren't counted."""
+    numpy = load_numpy()
+    if numpy and all(type(x) in (int, float) for x in xs):
+        counts, _ = numpy.histogram(numpy.asarray(xs, dtype=float), bins=edges)
+        return counts.tolist()
+    counts = [0]*(len(edges)-1)
+    last_edge = edges[-1]
+    last_bin = len(counts)-1
+    bisect_right = bisect.bisect_right
+    for x in xs:
+        i = bisect_right(edges, x) - 1
+        if i > last_bin:
+            if x == last_edge:
+                counts[last_bin] += 1
+        elif i >= 0:
+            counts[i] += 1
+    return counts
+
+def cumulative(counts):
+    result = []
+    total = 0
+    for c in counts:
+        total += c
+        result.append(total)
+    return result
@@ -1,10 +1,18 @@
 import argparse
+import datetime
+import io
 import sys
 
-from .interpret import (run_interpreter, execute,
+from .interpret import (run_interpreter, execute, ResultBox,
     print_units, print_functions, print_unit_info,
-    print_function_info, print_prefixes)
-from .currency import scrape_and_store_rates_to
+    print_function_info, print_prefixes, compile_source,
+    execute_parse_tree)
+from .scriptcache import load_parse_tree, store_parse_tree
+from .eval import EvalEnvironment
+from .tokens import split_statements
+from .limits import limits_from_config
+from .currency import scrape_and_store_rates_to, parse_currency_data
+from .ratehistory import add_rates
 import ka.config
 from .config import ConfigProperties
 
@@ -19,7 +27,13 @@ def main():
 
     flaglist = ["-h", "--help"]
     add_and_store_argument(parser, flaglist, "--script", help="Run a script file containing Ka code.")
+    add_and_store_argument(parser, flaglist, "--no-cache", action="store_true", help="With --script, don't use or update the cached parse tree of the script (in __kacache__).")
+    add_and_store_argument(parser, flaglist, "--stream", action="store_true", help="With --script, run the script one statement at a time as it's read, rather than parsing all of it first.")
+    add_and_store_argument(parser, flaglist, "--print-all", action="store_true", help="With --script, print the value of every statement that isn't an assignment, not just the last one. Implies --stream.")
+    add_and_store_argument(parser, flaglist, "--http", type=int, metavar="PORT", help="Serve POST /eval requests on localhost, at the given port.")
+    add_and_store_argument(parser, flaglist, "--workers", type=int, help="With --http, the number of worker processes (by default, one per CPU).")
     add_and_store_argument(parser, flaglist, "--scrape-currency-to", help="Scrape currency data and dump to the given file.")
+    add_and_store_argument(parser, flaglist, "--add-rates", nargs=2, metavar=("DATE", "FILE"), help="Add the exchange rates in FILE (same format as the currency file) to the exchange rate history, as the rates for DATE (YYYY-MM-DD).")
     add_and_store_argument(parser, flaglist, "--units", action="store_true", help="List all available units.")
     add_and_store_argument(parser, flaglist, "--functions", action="store_true", help="List all available functions.")
     add_and_store_argument(parser, flaglist, "--unit", help="See the details of a particular unit.")
@@ -47,17 +61,73 @@ def main():
         from .gui import run_gui
         run_gui()
     elif args.script:
-        run_script(args.script)
+        sys.exit(run_script(args.script,
+                            stream=args.stream or args.print_all,
+                            print_all=args.print_all,
+                            use_cache=not args.no_cache))
+    elif args.http is not None:
+        from .server import run_server
+        run_server(args.http, workers=args.workers)
     elif args.scrape_currency_to:
         print("Scraping currency data...")
         scrape_and_store_rates_to(args.scrape_currency_to)
+    elif args.add_rates:
+        add_rates_to_history(*args.add_rates)
     else:
         run_interpreter()
 
-def run_script(path):
+def add_rates_to_history(date, path):
+    date = datetime.date.fromisoformat(date)
     with open(path, "r") as f:
+        currencies = parse_currency_data(f.read())
+    if not currencies:
+        sys.exit(f"Failed to parse currency data from {path}.")
+    add_rates(ka.config.get(ConfigProperties.CURRENCY_HISTORY_PATH),
+              date, currencies)
+
+def run_script(path, stream=False, print_all=False, use_cache=True,
+               out=sys.stdout, errout=sys.stderr):
+    """Returns the exit status."""
+    with open(path, "r") as f:
+        if stream:
+            return stream_script(f, print_all=print_all,
+                                 out=out, errout=errout)
         s = f.read()
-        execute(s)
+    tree = load_parse_tree(path, s) if use_cache else None
+    if tree is None:
+        tree = compile_source(s, errout)
+        if tree is None:
+            return 1
+        if use_cache:
+            store_parse_tree(path, s, tree)
+    return execute_parse_tree(tree, EvalEnvironment(track_dependencies=False),
+                              s, out=out, errout=errout,
+                              limits=limits_from_config())
+
+def stream_script(lines, print_all=False, out=sys.stdout, errout=sys.stderr):
+    """Executes statements as they're read, so the whole script never has
+    to be in memory. Stops at the first statement that fails."""
+    env = EvalEnvironment(track_dependencies=False)
+    # Shared by all the statements, as if they were one command.
+    limits = limits_from_config()
+    last_output = None
+    for statement, line_number in split_statements(lines):
+        statement_out = io.StringIO()
+        statement_err = io.StringIO()
+        assigned_box = ResultBox()
+        status = execute(statement, env, out=statement_out,
+                         errout=statement_err, assigned_box=assigned_box,
+                         limits=limits)
+        if status != 0:
+            print(f"Error on line {line_number}:", file=errout)
+            print(statement_err.getvalue(), end="", file=errout)
+            return status
+        last_output = statement_out.getvalue()
+        if print_all and assigned_box.value is None:
+            print(last_output, end="", file=out)
+    if last_output is not None and not print_all:
+        print(last_output, end="", file=out)
+    return 0
 
 if __name__ == "__main__":
     main()
@@ -12,6 +12,8 @@ else:
 CONFIG_PATH = SYSTEM_CONFIG_DIR.joinpath("config")
 DEFAULT_HISTORY_PATH = SYSTEM_CONFIG_DIR.joinpath("history")
 DEFAULT_CURRENCY_PATH = SYSTEM_CONFIG_DIR.joinpath("currency")
+DEFAULT_CURRENCY_HISTORY_PATH = SYSTEM_CONFIG_DIR.joinpath("currency-history")
+DEFAULT_SNAPSHOT_PATH = SYSTEM_CONFIG_DIR.joinpath("snapshots")
 
 CONFIG = dict()
 HAVE_READ = False
@@ -25,20 +27,35 @@ class ConfigProperty:
 
 class ConfigProperties:
     PRECISION = ConfigProperty("precision", 6, num=True)
+    DECIMAL_PRECISION = ConfigProperty("decimal-precision", 0, num=True)
     FONT_SIZE = ConfigProperty("font-size", 15, num=True)
     WINDOW_WIDTH = ConfigProperty("window-width", 600, num=True)
     WINDOW_HEIGHT = ConfigProperty("window-height", 400, num=True)
+    SCROLLBACK = ConfigProperty("scrollback", 0, num=True)
     DEFAULT_SHORTCUT_UP = ConfigProperty("shortcut-up", "Ctrl+Up")
     DEFAULT_SHORTCUT_DOWN = ConfigProperty("shortcut-down", "Ctrl+Down")
+    DEFAULT_SHORTCUT_SEARCH = ConfigProperty("shortcut-search", "Ctrl+R")
     DEFAULT_SHORTCUT_FUNCTIONS = ConfigProperty("shortcut-functions", "Ctrl+F")
     DEFAULT_SHORTCUT_UNITS = ConfigProperty("shortcut-units", "Ctrl+Q")
     DEFAULT_SHORTCUT_PREFIXES = ConfigProperty("shortcut-prefixes", "Ctrl+P")
     DEFAULT_SHORTCUT_CLOSE = ConfigProperty("shortcut-close", "Ctrl+W")
+    DEFAULT_SHORTCUT_CANCEL = ConfigProperty("shortcut-cancel", "Esc")
     SAVE_HISTORY = ConfigProperty("save-history", True, boolean=True)
     HISTORY_PATH = ConfigProperty("history-path", DEFAULT_HISTORY_PATH)
+    HISTORY_SIZE = ConfigProperty("history-size", 1000, num=True)
     PROMPT = ConfigProperty("prompt", ">>>")
+    AUTO_RECOMPUTE = ConfigProperty("auto-recompute", False, boolean=True)
+    SNAPSHOT_PATH = ConfigProperty("snapshot-path", DEFAULT_SNAPSHOT_PATH)
     CURRENCY_PATH = ConfigProperty("currency-path", DEFAULT_CURRENCY_PATH)
+    CURRENCY_SOURCE = ConfigProperty("currency-source", "")
+    CURRENCY_MAX_AGE = ConfigProperty("currency-max-age", 24, num=True)
+    CURRENCY_HISTORY_PATH = ConfigProperty("currency-history-path",
+                                           DEFAULT_CURRENCY_HISTORY_PATH)
     BASE_CURRENCY = ConfigProperty("base-currency", "eur")
+    MAX_STEPS = ConfigProperty("max-steps", 0, num=True)
+    TIMEOUT = ConfigProperty("timeout", 0, num=True)
+    MAX_INT_BITS = ConfigProperty("max-int-bits", 0, num=True)
+    MAX_ELEMENTS = ConfigProperty("max-elements", 0, num=True)
 
 def get(prop):
     global HAVE_READ
@@ -60,7 +77,7 @@ def read_config(path, error_out=None):
              if not x.startswith("_")]
     with open(path, "r") as f:
         for line in f.readlines():
-            items = line.split("=")
+            items = line.split("=", 1)
             if len(items) < 2:
                 continue
             name, val = map(lambda x: x.strip(), items)
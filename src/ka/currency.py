@@ -1,16 +1,21 @@
 """
-Contains utilities for scraping currency exchange rates.
+Contains utilities for scraping currency exchange rates, and for keeping
+the on-disk copy of them up to date.
 """
 
 import datetime
 import argparse
+import os
 import os.path
 import sys
+import tempfile
+import threading
+import time
 
 import ka.config
 from .config import ConfigProperties
 
-SCRAPE_URL = "https://www.xe.com/currencytables/?from=USD&date=${date}"
+SCRAPE_URL = "https://www.xe.com/currencytables/?from=USD&date={date}"
 
 def scrape_exchange_rates():
     from bs4 import BeautifulSoup
@@ -41,6 +46,12 @@ class CurrencyData:
         self.name = name
         self.dollar_rate = dollar_rate
 
+    def __eq__(self, other):
+        return (isinstance(other, CurrencyData)
+                and self.symbol == other.symbol
+                and self.name == other.name
+                and self.dollar_rate == other.dollar_rate)
+
     def __str__(self):
         return f"Currency[symbol='{self.symbol}', name='{self.name}', rate={self.dollar_rate}]"
 
@@ -48,11 +59,146 @@ class CurrencyData:
         return str(self)
 
 def scrape_and_store_rates_to(path):
-    currencies = scrape_exchange_rates()
-    with open(path, "w") as f:
-        for c in currencies:
-            f.write(",".join([c.symbol, c.name, str(c.dollar_rate)]))
-            f.write("\n")
+    store_rates_to(path, scrape_exchange_rates())
+
+def format_currency_data(currencies):
+    return "\n".join(",".join([c.symbol, c.name, str(c.dollar_rate)])
+                     for c in currencies)
+
+def store_rates_to(path, currencies):
+    """Writes to a temporary file and then moves it into place, so that
+    anyone reading the file sees either the old rates or the new ones,
+    never half of each."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".currency-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(format_currency_data(currencies))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+class RateProvider:
+    """A source of exchange rates."""
+    def fetch(self):
+        """Returns a list of CurrencyData."""
+        raise NotImplementedError()
+
+class ScrapingRateProvider(RateProvider):
+    def fetch(self):
+        return scrape_exchange_rates()
+
+    def __str__(self):
+        return "xe"
+
+class FileRateProvider(RateProvider):
+    """Reads rates (in the same format as the currency file) from a
+    local file. Handy for testing, or if some other process keeps the
+    rates up to date."""
+    def __init__(self, path):
+        self.path = path
+
+    def fetch(self):
+        with open(self.path) as f:
+            return parse_currency_data(f.read())
+
+    def __str__(self):
+        return "file:" + str(self.path)
+
+class HttpRateProvider(RateProvider):
+    """Fetches rates (in the same format as the currency file) from a URL."""
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def fetch(self):
+        import urllib.request
+        with urllib.request.urlopen(self.url, timeout=self.timeout) as r:
+            return parse_currency_data(r.read().decode("utf-8"))
+
+    def __str__(self):
+        return self.url
+
+def make_rate_provider(source):
+    """Source can be "xe" (scrape xe.com), a http(s) URL, or a path
+    (optionally prefixed by "file:"). Returns None if no source is given."""
+    if not source:
+        return None
+    source = str(source)
+    if source == "xe":
+        return ScrapingRateProvider()
+    if source.startswith("http://") or source.startswith("https://"):
+        return HttpRateProvider(source)
+    if source.startswith("file:"):
+        source = source[len("file:"):]
+    return FileRateProvider(source)
+
+def rates_are_stale(path, max_age_hours):
+    """The modification time of the currency file is used as the time at
+    which the rates were fetched."""
+    try:
+        age = time.time() - os.path.getmtime(path)
+    except OSError:
+        return True
+    return age > max_age_hours*3600
+
+REFRESH_LOCK = threading.Lock()
+REFRESH_THREAD = None
+# Only processes that stay around for a while, like the interpreter and
+# the GUI, refresh rates. A one-off `ka EXPR` would exit and kill the
+# refresh thread before it had finished, maybe halfway through writing
+# the currency file.
+REFRESH_IN_BACKGROUND = False
+# Refreshing happens in the background, so there's nobody to report
+# errors to. They're kept here instead, for debugging.
+LAST_REFRESH_ERROR = None
+
+def maybe_refresh_rates(on_refresh, source=None, path=None, max_age_hours=None):
+    """If the currency file is older than the configured maximum age, fetch
+    new rates in a background thread, store them, and then pass them
+    to `on_refresh`. Returns the thread, or None if there was no need to
+    refresh (or background refreshes aren't enabled, see
+    `enable_background_refresh`). Never blocks."""
+    global REFRESH_THREAD
+    if not REFRESH_IN_BACKGROUND:
+        return None
+    if source is None:
+        source = ka.config.get(ConfigProperties.CURRENCY_SOURCE)
+    if path is None:
+        path = ka.config.get(ConfigProperties.CURRENCY_PATH)
+    if max_age_hours is None:
+        max_age_hours = ka.config.get(ConfigProperties.CURRENCY_MAX_AGE)
+    provider = make_rate_provider(source)
+    if provider is None or not rates_are_stale(path, max_age_hours):
+        return None
+    with REFRESH_LOCK:
+        if REFRESH_THREAD is not None and REFRESH_THREAD.is_alive():
+            return None
+        REFRESH_THREAD = threading.Thread(
+            target=refresh_rates,
+            args=(provider, path, on_refresh),
+            name="ka-currency-refresh",
+            daemon=True)
+        REFRESH_THREAD.start()
+        return REFRESH_THREAD
+
+def enable_background_refresh():
+    global REFRESH_IN_BACKGROUND
+    REFRESH_IN_BACKGROUND = True
+
+def refresh_rates(provider, path, on_refresh):
+    global LAST_REFRESH_ERROR
+    try:
+        currencies = provider.fetch()
+        if not currencies:
+            raise ValueError(f"No rates received from {provider}.")
+        store_rates_to(path, currencies)
+        on_refresh(currencies)
+        LAST_REFRESH_ERROR = None
+    except Exception as e:
+        LAST_REFRESH_ERROR = e
 
 DEFAULT_CURRENCY_DATA = """usd,usdollar,1.0
 eur,euro,0.9613451479177936
@@ -249,14 +395,14 @@ def load_currency_data():
                 data = parse_currency_data(f.read())
         except Exception:
             print("Failed to parse currency data, falling back to default...",
-                  out=sys.stderr)
+                  file=sys.stderr)
     if data is None:
         # Fall back to the default.
         data = parse_currency_data(DEFAULT_CURRENCY_DATA)
     return data
 
 def parse_currency_data(s):
-    cs = map(lambda line: line.split(","), s.split("\n"))
+    cs = [line.split(",") for line in s.split("\n") if line.strip()]
     result = []
     for c in cs:
         if len(c) < 3:
@@ -268,4 +414,4 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--save-path", required=True)
     args = parser.parse_args()
-    scrape_and_store_rates(args.path)
+    scrape_and_store_rates_to(args.save_path)
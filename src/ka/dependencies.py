@@ -0,0 +1,118 @@
+"""
+Keeps track of which commands in a session read which variables, so
+that after a variable is assigned a new value, only the commands that
+depend on it have to be run again (`%recompute`).
+
+Each variable is defined by the most recent command that assigned it.
+A command depends on the definers of the variables it read, and it's
+stale if one of them was run after it, or if one of them is stale
+itself. Stale commands are re-run in dependency order, so a command
+only sees up-to-date values, and the rest keep their results.
+
+A command that assigns a variable in terms of itself, like `x = x+1`,
+can't be re-run (the value it started from is gone), so it's treated
+as if it didn't read anything.
+"""
+
+class VariableAccess:
+    """The variables read and assigned while running a command. A
+    variable that the command assigned (or bound as a loop variable)
+    before reading it doesn't count as read."""
+    def __init__(self):
+        self.reads = set()
+        self.writes = set()
+        self.bound = set()
+
+    def read(self, name):
+        if name not in self.writes and name not in self.bound:
+            self.reads.add(name)
+
+def independent_reads(access):
+    if access.reads & access.writes:
+        return set()
+    return access.reads
+
+class Command:
+    def __init__(self, source, tree, access, seq):
+        self.source = source
+        self.tree = tree
+        self.writes = access.writes
+        self.reads = independent_reads(access)
+        self.seq = seq
+
+    def __repr__(self):
+        return f"Command({self.source!r})"
+
+class Dependencies:
+    def __init__(self):
+        # In the order they were entered. (A dict, as an ordered set).
+        self.commands = {}
+        # Variable name -> command that most recently assigned it.
+        self.definers = {}
+        self.seq = 0
+
+    def add(self, source, tree, access):
+        self.seq += 1
+        command = Command(source, tree, access, self.seq)
+        for name in command.writes:
+            previous = self.definers.get(name)
+            self.definers[name] = command
+            if previous is not None and not self.defines_anything(previous):
+                # All its assignments have been overridden, so it'll
+                # never have to be re-run.
+                self.commands.pop(previous, None)
+        self.commands[command] = None
+        return command
+
+    def defines_anything(self, command):
+        return any(self.definers.get(name) is command
+                   for name in command.writes)
+
+    def update(self, command, access):
+        """Records that `command` has been re-run."""
+        self.seq += 1
+        command.seq = self.seq
+        command.reads = independent_reads(access)
+        for name in access.writes - command.writes:
+            # A new assignment, but don't override a later one.
+            self.definers.setdefault(name, command)
+        command.writes = command.writes | access.writes
+
+    def inputs(self, command):
+        """The commands that `command` depends on."""
+        return [d for d in (self.definers.get(name) for name in command.reads)
+                if d is not None and d is not command]
+
+    def stale(self):
+        """The commands that need to be re-run, in the order to run
+        them."""
+        dependents = {}
+        stale = set()
+        for command in self.commands:
+            for d in self.inputs(command):
+                dependents.setdefault(d, []).append(command)
+                if d.seq > command.seq:
+                    stale.add(command)
+        unvisited = list(stale)
+        while unvisited:
+            for command in dependents.get(unvisited.pop(), []):
+                if command not in stale:
+                    stale.add(command)
+                    unvisited.append(command)
+        return self.dependency_order([c for c in self.commands if c in stale])
+
+    def dependency_order(self, commands):
+        # Each command goes after the stale commands it depends on.
+        # Ties (and cycles) are broken by the order they were entered.
+        waiting_on = {c: set(self.inputs(c)).intersection(commands)
+                      for c in commands}
+        order = []
+        remaining = list(commands)
+        while remaining:
+            ready = next((c for c in remaining if not waiting_on[c]),
+                         remaining[0])
+            remaining.remove(ready)
+            order.append(ready)
+            for c in remaining:
+                waiting_on[c].discard(ready)
+        return order
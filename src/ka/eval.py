@@ -1,8 +1,29 @@
+import contextlib
+import decimal
 import math
-from .types import Quantity, is_number, get_external_type_name, Array
-from .functions import dispatch
-from .units import lookup_unit, QSPACE, InvalidPrefixError
+import threading
+from decimal import Decimal
+from .types import (Quantity, is_number, get_external_type_name, Array, Set,
+    is_hashable, is_true, simplify_number)
+from .functions import (dispatch, call_header, define_user_function,
+    user_functions_in_effect, current_user_functions, call_primitive_op,
+    PRIMITIVE_OPS, PRIMITIVE_NUMBER_TYPES)
+from .units import lookup_unit, suggest_units, QSPACE, InvalidPrefixError
 from .probability import ComparisonOp
+from .limits import (check as check_limits, allocate, current_limits,
+    limits_in_effect)
+from . import functions, precision
+from .dependencies import Dependencies, VariableAccess
+from .utils import ResultCache
+
+# Each call to a user-defined function takes about a dozen Python
+# frames, so with Python's default recursion limit of 1000, a thread
+# only has room for ~80 nested calls. Rather than raising the limit for
+# the whole process (which can overflow the C stack), deeper calls
+# carry on in a new thread, with a stack of its own, every
+# CALLS_PER_THREAD calls.
+CALLS_PER_THREAD = 25
+MAX_CALL_DEPTH = 10000
 
 CONSTANTS = {
     "e": math.e,
@@ -11,6 +32,10 @@ CONSTANTS = {
     "false": 0
 }
 
+# Constants that have more digits in precision mode, as long as they
+# haven't been overridden.
+PRECISE_CONSTANTS = {"e", "pi"}
+
 class EvalModes:
     LEAF = "leaf"
     VARIABLE = "variable"
@@ -22,48 +47,129 @@ class EvalModes:
     ARRAY = "array"
     ARRAY_WITH_CONDITION = "array-with-condition"
     KEYWORD_ARG = "keyword-arg"
+    FUNCTION_DEFINITION = "function-definition"
+    CONDITIONAL = "conditional"
 
 class EvalError(Exception):
     def __init__(self, message):
         self.message = message
 
 class EvalEnvironment:
-    def __init__(self):
+    def __init__(self, track_dependencies=True):
         self._variables = CONSTANTS.copy()
+        # Not needed when running a script, and it would use memory for
+        # every statement.
+        self.dependencies = Dependencies() if track_dependencies else None
+        # VariableAccess of the command being run, if it's being recorded.
+        self._access = None
+        # The functions defined with `f(x) = ...`, see
+        # `define_user_function`.
+        self.functions = {}
 
     def set_variable(self, name, value):
         self._variables[name] = value
+        if self._access is not None:
+            self._access.writes.add(name)
         return value
 
+    def bind_variable(self, name, value):
+        """Like set_variable, but for loop variables, which don't count
+        as assignments when tracking dependencies."""
+        self._variables[name] = value
+        if self._access is not None:
+            self._access.bound.add(name)
+
     def get_variable(self, name):
+        if self._access is not None:
+            # Even if it's unassigned, so that the command can be re-run
+            # once it is.
+            self._access.read(name)
         if name not in self._variables:
             raise EvalError(f"Unassigned variable: '{name}'")
         return self._variables[name]
 
+    def define_function(self, function):
+        define_user_function(self.functions, function, function.name,
+                             len(function.params))
+        if self._access is not None:
+            self._access.writes.add(function_key(function.name))
+
+    def note_call(self, name):
+        """Records a call, if it's to a user-defined function, since the
+        command then depends on the function's definition."""
+        if self._access is not None and name in self.functions:
+            self._access.read(function_key(name))
+
+    @contextlib.contextmanager
+    def recording(self):
+        """Records the variables read and assigned within the context."""
+        access = VariableAccess()
+        previous, self._access = self._access, access
+        try:
+            yield access
+        finally:
+            self._access = previous
+
+def function_key(name):
+    # How a function definition is tracked as a dependency. Can't clash
+    # with a variable name.
+    return name + "()"
+
 def eval_parse_tree(root, env=None):
+    # ka.infer imports this module.
+    from .infer import bind_calls
     if env is None:
         env = EvalEnvironment()
+    bind_calls(root, env)
     try:
-        return eval_node(root, env)
+        with precision.precision_in_effect(), \
+                user_functions_in_effect(env.functions):
+            return eval_node(root, env)
     except ZeroDivisionError:
         raise EvalError("Attempted to divide by zero.")
     except OverflowError:
         raise EvalError("Overflow, numerical result out of range!")
+    except RecursionError:
+        raise EvalError("Too many nested function calls.")
 
 def eval_node(node, env):
+    check_limits()
+    if (node.eval_mode == EvalModes.FUNCALL
+            and len(node.children) == 2
+            and node.value in PRIMITIVE_OPS):
+        return eval_primitive_op(node, env)
     return eval_based_on_mode(
         node,
         env,
         [eval_node(child, env) if node.eval_children else None
          for child in node.children])
 
+def eval_primitive_op(node, env):
+    """Arithmetic and comparisons on plain numbers skip `dispatch`.
+    Other operands go the usual way."""
+    x = eval_node(node.children[0], env)
+    y = eval_node(node.children[1], env)
+    if (type(x) in PRIMITIVE_NUMBER_TYPES
+            and type(y) in PRIMITIVE_NUMBER_TYPES):
+        return call_primitive_op(node.value, x, y)
+    return eval_based_on_mode(node, env, [x, y])
+
 def eval_based_on_mode(node, env, child_values):
     mode = node.eval_mode
     if mode == EvalModes.LEAF:
+        if "literal" in node.meta and precision.is_enabled():
+            return simplify_number(
+                precision.from_literal(node.meta["literal"]))
         return node.value
     if mode == EvalModes.VARIABLE:
-        return env.get_variable(node.value)
+        value = env.get_variable(node.value)
+        if (node.value in PRECISE_CONSTANTS
+                and value is CONSTANTS[node.value]
+                and precision.is_enabled()):
+            return precision.constant(node.value)
+        return value
     if mode == EvalModes.FUNCALL:
+        env.note_call(node.value)
         return eval_funcall(node, child_values)
     if mode == EvalModes.ASSIGNMENT:
         return env.set_variable(node.value, child_values[0])
@@ -79,9 +185,18 @@ def eval_based_on_mode(node, env, child_values):
         return eval_comprehension(node, env)
     if mode == EvalModes.KEYWORD_ARG:
         return child_values[0]
+    if mode == EvalModes.CONDITIONAL:
+        return eval_conditional(node, env)
+    if mode == EvalModes.FUNCTION_DEFINITION:
+        env.define_function(UserFunction(node.value, node.meta["params"],
+                                         node.children[0], env))
+        return None
     raise EvalError(f"Unknown evaluation mode: '{mode}' (This is a bug!)")
 
 def eval_funcall(node, child_values):
+    binding = node.binding
+    if binding is not None and binding.matches(child_values):
+        return call_header(node.value, binding.header, child_values)
     num_pos_args = sum(1 for child in node.children
                          if child.eval_mode != EvalModes.KEYWORD_ARG)
     return dispatch(
@@ -92,10 +207,126 @@ def eval_funcall(node, child_values):
                      in zip(node.children[num_pos_args:],
                             child_values[num_pos_args:])))
 
+def eval_conditional(node, env):
+    if (len(node.children) != 3
+            or any(child.eval_mode == EvalModes.KEYWORD_ARG
+                   for child in node.children)):
+        raise EvalError("'if' takes 3 arguments: a condition, the value if it's true, and the value if it's false.")
+    condition = eval_node(node.children[0], env)
+    if not is_number(condition):
+        raise EvalError(f"Expected a Bool as the condition of 'if', got {get_external_type_name(condition)}.")
+    return eval_node(node.children[1] if is_true(condition) else node.children[2],
+                     env)
+
+class UserFunction:
+    """A function defined with `f(x) = ...`. Each call evaluates the
+    body in a scope where the parameters have the values of the
+    arguments, so they don't overwrite variables with the same names.
+    Other variables are looked up when the function is called."""
+    def __init__(self, name, params, body, env):
+        self.name = name
+        self.params = params
+        self.body = body
+        self.env = env
+        # Results of previous calls, if memoized.
+        self.cache = None
+
+    def memoize(self, size):
+        if self.cache is None:
+            self.cache = ResultCache(size)
+        else:
+            self.cache.resize(size)
+
+    def __call__(self, *args):
+        if self.cache is None or not all(is_hashable(x) for x in args):
+            return self.evaluate(args)
+        # Otherwise f(1) and f(1.0) would share a result.
+        key = tuple((type(x), x) for x in args)
+        result = self.cache.get(key)
+        if result is ResultCache.MISSING:
+            result = self.evaluate(args)
+            self.cache.put(key, result)
+        return result
+
+    def evaluate(self, args):
+        env = LocalEnvironment(self.env, dict(zip(self.params, args)))
+        depth = getattr(_calls, "depth", 0) + 1
+        if depth > MAX_CALL_DEPTH:
+            raise EvalError("Too many nested function calls.")
+        if depth % CALLS_PER_THREAD == 0:
+            return call_on_new_thread(
+                lambda: self.evaluate_at_depth(env, depth))
+        return self.evaluate_at_depth(env, depth)
+
+    def evaluate_at_depth(self, env, depth):
+        previous = getattr(_calls, "depth", 0)
+        _calls.depth = depth
+        try:
+            return eval_node(self.body, env)
+        finally:
+            _calls.depth = previous
+
+# Depth of the calls to user-defined functions in each thread.
+_calls = threading.local()
+
+def call_on_new_thread(f):
+    """Calls f on a new thread, with the same limits, precision and
+    user-defined functions as this one, and waits for the result."""
+    limits = current_limits()
+    user_functions = current_user_functions()
+    context = decimal.getcontext()
+    outcome = []
+    def run():
+        try:
+            with limits_in_effect(limits), \
+                    user_functions_in_effect(user_functions), \
+                    decimal.localcontext(context):
+                outcome.append((f(), None))
+        except BaseException as e:
+            outcome.append((None, e))
+    # A daemon, so that it doesn't keep the process alive if the wait
+    # is interrupted.
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join()
+    result, error = outcome[0]
+    if error is not None:
+        raise error
+    return result
+
+class LocalEnvironment:
+    """The parameters and loop variables of a call to a UserFunction.
+    Other variables come from the environment it was defined in."""
+    def __init__(self, parent, variables):
+        self.parent = parent
+        self._variables = variables
+
+    def set_variable(self, name, value):
+        self._variables[name] = value
+        return value
+
+    bind_variable = set_variable
+
+    def get_variable(self, name):
+        if name in self._variables:
+            return self._variables[name]
+        return self.parent.get_variable(name)
+
+    def note_call(self, name):
+        self.parent.note_call(name)
+
+    def define_function(self, function):
+        raise EvalError("Functions can only be defined at the top level.")
+
 def make_quantity(magnitude, unit_signature):
     if not is_number(magnitude):
         raise EvalError(f"Tried to add units on top of existing units. Only a magnitude can be tagged with units.")
     qv, multiple, offset = compose_units(unit_signature)
+    if isinstance(magnitude, Decimal):
+        # The unit multiples are floats and fractions, which don't mix
+        # with Decimals.
+        multiple = precision.to_decimal(multiple)
+        offset = precision.to_decimal(offset)
     return Quantity(multiple*magnitude + offset, qv)
 
 def convert_quantity(quantity, unit_sig):
@@ -123,7 +354,11 @@ def compose_units(unit_sig):
         except InvalidPrefixError:
             raise EvalError(f"Can't apply a prefix to unit '{name}', as it has an offset!")
         if unit is None:
-            raise EvalError(f"Unknown unit '{name}'. (Remember that it's case-sensitive).")
+            message = f"Unknown unit '{name}'. (Remember that it's case-sensitive)."
+            alternatives = suggest_units(name)
+            if alternatives:
+                message += "\n  You may have meant: " + ", ".join(alternatives)
+            raise EvalError(message)
         if invert:
             exp = -exp
         qv *= unit.quantity_vector ** exp
@@ -162,32 +397,107 @@ def eval_comprehension(node, env):
     assignment_nodes = [node.children[i] for i in range(1, 1+num_assignments)]
     assign_names = [child.meta["name"] for child in assignment_nodes]
     subarrays = [eval_node(assign_node, env) for assign_node in assignment_nodes]
+    subarrays = [Array(list(subarray)) if isinstance(subarray, Set) else subarray
+                 for subarray in subarrays]
     if any(not isinstance(subarray, Array) for subarray in subarrays):
         raise EvalError("Expected an array for variable assignment in complex array subclause.")
+    bind_comprehension(node, assign_names, subarrays, env)
     condition_nodes = [node.children[i] for i in range(1+num_assignments, len(node.children))]
+    loop_variables = set(assign_names).union(assigned_variables(node))
+    condition_nodes = [hoist_membership(condition, loop_variables) or condition
+                       for condition in condition_nodes]
     subarray_index = 0
     output = Array([])
     while True:
+        check_limits()
         subarrays_exhausted = False
         for name, subarray in zip(assign_names, subarrays):
             if subarray_index >= len(subarray):
                 subarrays_exhausted = True
                 break
-            env.set_variable(name, subarray[subarray_index])
+            env.bind_variable(name, subarray[subarray_index])
         if subarrays_exhausted:
             break
         success = True
         for condition in condition_nodes:
-            result = eval_node(condition, env)
+            if isinstance(condition, HoistedMembership):
+                result = condition.evaluate(env)
+            else:
+                result = eval_node(condition, env)
             if not bool_like(result):
                 raise EvalError("Expected boolean-interpretable result in array condition.")
             if result == 0:
                 success = False
         if success:
+            allocate(1)
             output.append(eval_node(body_node, env))
         subarray_index += 1
     return output
 
+def bind_comprehension(node, assign_names, subarrays, env):
+    """Picks the overloads of the calls in the body and conditions,
+    for loop variables of the types of the elements of the arrays. Only
+    done again if the types, or the functions, have changed since last
+    time."""
+    from .infer import bind_loop
+    loop_types = {}
+    for name, subarray in zip(assign_names, subarrays):
+        types = set(map(type, subarray.contents))
+        loop_types[name] = types.pop() if len(types) == 1 else None
+    key = (functions.REGISTRY_VERSION, loop_types)
+    if key != node.loop_types:
+        bind_loop(node, loop_types, env)
+        node.loop_types = key
+
+class HoistedMembership:
+    """A condition `(x in A)` where A is the same on every iteration of
+    a comprehension. A is evaluated once, and if it's an array of values
+    that can go in a set, it's turned into one, so that each check is a
+    hash lookup rather than a scan of the array."""
+    def __init__(self, element_node, collection_node):
+        self.element_node = element_node
+        self.collection_node = collection_node
+        self.collection = None
+
+    def evaluate(self, env):
+        if self.collection is None:
+            # Not done up front, so that a comprehension with no
+            # iterations doesn't evaluate it.
+            collection = eval_node(self.collection_node, env)
+            if (isinstance(collection, Array)
+                    and all(is_hashable(x) for x in collection.contents)):
+                collection = Set.from_values(collection.contents)
+            self.collection = collection
+        return dispatch("in", (eval_node(self.element_node, env), self.collection))
+
+def hoist_membership(condition, loop_variables):
+    if (condition.eval_mode == EvalModes.FUNCALL
+            and condition.value == "in"
+            and len(condition.children) == 2
+            and is_loop_invariant(condition.children[1], loop_variables)):
+        return HoistedMembership(*condition.children)
+    return None
+
+def is_loop_invariant(node, loop_variables):
+    """Conservative: only variables and array literals of them. Function
+    calls could have side effects, or be random."""
+    if node.eval_mode == EvalModes.LEAF:
+        return True
+    if node.eval_mode == EvalModes.VARIABLE:
+        return node.value not in loop_variables
+    if node.eval_mode in (EvalModes.ARRAY, EvalModes.QUANTITY):
+        return all(is_loop_invariant(child, loop_variables)
+                   for child in node.children)
+    return False
+
+def assigned_variables(node):
+    names = set()
+    if node.eval_mode == EvalModes.ASSIGNMENT:
+        names.add(node.value)
+    for child in node.children:
+        names.update(assigned_variables(child))
+    return names
+
 def bool_like(x):
     return x == 1 or x == 0
 
@@ -1,31 +1,54 @@
 import collections
+import contextlib
 import operator
 import math
+import threading
 from numbers import Number, Integral, Rational
 from fractions import Fraction as frac
 import random
+from decimal import Decimal
 
-from .types import (simplify_type, Quantity, get_external_type_name,
-    Array, Combinatoric, IntRange, fraction_divide, is_true,
-    String, Bool, get_type_as_string, is_type, now, Instant,
+from .types import (simplify_type, simplify_number, Quantity,
+    get_external_type_name, Array, Combinatoric, IntRange, fraction_divide,
+    is_true, String, Bool, get_type_as_string, is_type, now, Instant,
     instant_plus_quantity, instant_plus_int, instant_minus_quantity,
     instant_minus_int, today, floor_instant, ceil_instant,
     instant_minus_instant, Interval, Any, KaRuntimeError,
     instant_lt, instant_leq, instant_gt, instant_geq,
     interval_get_upper, interval_get_lower, get_year, get_month,
-    get_day, get_hour, get_minute, get_second, TypeAlias)
-from .units import QSPACE
+    get_day, get_hour, get_minute, get_second, TypeAlias, Set, is_hashable)
+from .units import QSPACE, SPECIAL_CURRENCY_SYMBOLS
+from .ratehistory import convert_at, RateHistoryError
 from .probability import (Binomial, Poisson, Geometric, Bernoulli,
                           UniformInt, Exponential, Uniform, Gaussian,
                           RandomVariable, Event, DoubleEvent, ComparisonOp,
                           DiscreteRandomVariable, unit)
-from .utils import lazy_choose, lazy_factorial, _g, separate_kwargs
+from .limits import check as check_limits, allocate, check_int_bits
+from .selection import select
+from .rational import exact_sum, exact_prod
+from . import precision
+from .binning import (bin_edges, bin_counts, BinningError,
+    cumulative as cumulative_counts)
+from .suggest import SuggestionIndex
+from .utils import (lazy_choose, lazy_factorial, _g, separate_kwargs,
+    ResultCache)
 from .plot import (plot, line, check_all_numerical, Plot, PlotDrawing,
-    only_not_none, vline, hline, scatter, text, options, get_plt)
-from functools import cmp_to_key
+    only_not_none, vline, hline, scatter, text, options, save)
 
 FUNCTIONS = collections.defaultdict(list)
 FUNCTION_DOCUMENTATION = {}
+# Names of functions with at least one pure overload, and the cache for
+# the results of calling them.
+PURE_FUNCTION_NAMES = set()
+PURE_RESULTS_SIZE = 4096
+PURE_RESULTS = ResultCache(PURE_RESULTS_SIZE)
+# Changes whenever an overload is added or replaced, so that overloads
+# picked in advance (see `resolve_header_for_types`) can be checked.
+REGISTRY_VERSION = 0
+# (name, argument types) -> the result of `resolve_header_for_types`.
+RESOLVED_HEADERS = {}
+# For suggesting alternatives to unknown function names.
+FUNCTION_NAME_INDEX = SuggestionIndex()
 
 class FunctionSignature:
     def __init__(self, args, vararg=None, kw_args=None):
@@ -33,6 +56,18 @@ class FunctionSignature:
         self.vararg = vararg
         self.kw_args = kw_args or dict()
 
+    def matches_types(self, types):
+        """Like `matches`, for arguments of these (exact) types."""
+        def below(t1, t2):
+            return issubclass(t1, t2.actual_type if isinstance(t2, TypeAlias) else t2)
+        if len(types) < len(self.args):
+            return False
+        if not all(below(t, arg) for t, arg in zip(types, self.args)):
+            return False
+        return (len(types) == len(self.args)
+                or (self.vararg is not None
+                    and all(below(t, self.vararg) for t in types)))
+
     def matches(self, args):
         i = 0
         while i < len(self.args):
@@ -82,10 +117,13 @@ class FunctionSignature:
         return coerce_to(v, self.kw_args[k])
 
 class FunctionHeader:
-    def __init__(self, name, f, sig):
+    def __init__(self, name, f, sig, pure=False):
         self.name = name
         self.f = f
         self.sig = sig
+        # Whether the result depends only on the arguments (and the
+        # precision), so it can be cached.
+        self.pure = pure
 
     def sig_matches(self, args):
         return self.sig.matches(args)
@@ -141,19 +179,10 @@ def make_sig_printable(sig):
 
 def dispatch(name, args, kw_args=None):
     global FUNCTIONS
-    if kw_args is None:
-        kw_args = dict()
-    if name not in FUNCTIONS:
-        raise UnknownFunctionError(name)
-    matching_headers = lookup_function(name, args)
-    if not matching_headers:
-        all_signatures = list(map(lambda x: x.sig, FUNCTIONS[name]))
-        all_sig_names = [str(sig) for sig in all_signatures]
-        raise NoMatchingFunctionSignatureError(
-            name,
-            list(map(get_external_type_name, args)),
-            all_sig_names)
-    header = get_closest_match(matching_headers)
+    if not kw_args:
+        return call_header(name, None, args)
+    check_limits()
+    header = resolve_header(name, args)
     for k, v in kw_args.items():
         expected_type = header.sig.kw_args.get(k, None)
         if expected_type is None:
@@ -165,9 +194,88 @@ def dispatch(name, args, kw_args=None):
                  **dict((k, header.coerce_kwarg(k, v))
                         for k, v in kw_args.items())))
 
-def lookup_function(name, args):
-    return [header for header in FUNCTIONS[name]
-            if header.sig_matches(args)]
+def call_header(name, header, args):
+    """Calls function `name` without keyword arguments. `header` is the
+    overload to call, if it's already known, or None to look it up."""
+    check_limits()
+    key = None
+    if name in PURE_FUNCTION_NAMES:
+        key = result_key(name, args)
+        if key is not None:
+            result = PURE_RESULTS.get(key)
+            if result is not ResultCache.MISSING:
+                return result
+    if header is None:
+        header = resolve_header(name, args)
+    result = simplify_type(header.f(*header.coerce_args(args)))
+    if key is not None and header.pure:
+        PURE_RESULTS.put(key, result)
+    return result
+
+def result_key(name, args):
+    """Key for the result of a call in PURE_RESULTS, or None if it
+    can't be cached."""
+    if not all(is_hashable(x) or isinstance(x, Decimal) for x in args):
+        return None
+    # The type is part of the key, since e.g. 1 == 1.0 but sqrt(1) is
+    # an int and sqrt(1.0) is a float. Likewise, 0.0 == -0.0.
+    return (name, precision.digits(),
+            tuple((type(x), x, str(x) if isinstance(x, float) else None)
+                  for x in args))
+
+def suggest_functions(name):
+    """Names of functions with a name like `name`."""
+    return FUNCTION_NAME_INDEX.suggest(name, exists=FUNCTIONS.__contains__)
+
+def resolve_header(name, args):
+    if name in FUNCTIONS:
+        overloads = FUNCTIONS[name]
+    else:
+        overloads = current_user_functions().get(name)
+        if overloads is None:
+            raise UnknownFunctionError(name)
+    matching_headers = [header for header in overloads
+                        if header.sig_matches(args)]
+    if not matching_headers:
+        all_signatures = list(map(lambda x: x.sig, overloads))
+        all_sig_names = [str(sig) for sig in all_signatures]
+        raise NoMatchingFunctionSignatureError(
+            name,
+            list(map(get_external_type_name, args)),
+            all_sig_names)
+    return get_closest_match(matching_headers)
+
+def resolve_header_for_types(name, types):
+    """The overload that would be called for arguments of these exact
+    types, or None if there isn't one. Resolution only depends on the
+    types of the arguments, so this can be done before the call."""
+    key = (name, types)
+    if key in RESOLVED_HEADERS:
+        return RESOLVED_HEADERS[key]
+    matching_headers = [header for header in FUNCTIONS.get(name, ())
+                        if header.sig.matches_types(types)]
+    header = get_closest_match(matching_headers) if matching_headers else None
+    RESOLVED_HEADERS[key] = header
+    return header
+
+class OverloadCache:
+    """Calls a function like `dispatch`, but only looks up the overload
+    once for each combination of argument types. Which overload gets
+    picked depends only on the types of the arguments, so this is safe,
+    as long as no functions get registered in the meantime. For
+    applying the same function many times, e.g. over an array."""
+    def __init__(self, name):
+        self.name = name
+        self.headers = {}
+
+    def __call__(self, *args):
+        check_limits()
+        key = tuple(map(type, args))
+        header = self.headers.get(key)
+        if header is None:
+            header = resolve_header(self.name, args)
+            self.headers[key] = header
+        return simplify_type(header.f(*header.coerce_args(args)))
 
 def get_closest_match(matching_headers):
     # (Integral, Integral) should come before
@@ -194,15 +302,24 @@ def type_below(t1, t2):
 def register_function(f, name, arg_types,
         docstring=None,
         kw_args=None,
-        vararg_type=None):
-    """kwargs should be a mapping from names to types."""
-    global FUNCTIONS
+        vararg_type=None,
+        pure=False):
+    """kwargs should be a mapping from names to types. If `pure`, the
+    result depends only on the arguments, and recent results are
+    cached."""
+    global FUNCTIONS, REGISTRY_VERSION
+    REGISTRY_VERSION += 1
+    RESOLVED_HEADERS.clear()
     FUNCTIONS[name].append(
         FunctionHeader(name,
                        f,
                        FunctionSignature(arg_types,
                                          vararg=vararg_type,
-                                         kw_args=kw_args)))
+                                         kw_args=kw_args),
+                       pure=pure))
+    if pure:
+        PURE_FUNCTION_NAMES.add(name)
+    FUNCTION_NAME_INDEX.add(name)
     if docstring is not None and name not in FUNCTION_DOCUMENTATION:
         FUNCTION_DOCUMENTATION[name] = docstring
 
@@ -215,8 +332,10 @@ def register_commutative_op(f, name, type1, type2):
     register_function(f, name, (type1, type2))
     register_function(reverse_f, name, (type2, type1))
 
-def register_numeric_function(name, f, num_args=1, docstring=None):
-    register_function(f, name, num_args*(Number,), docstring=docstring)
+def register_numeric_function(name, f, num_args=1, docstring=None,
+                              pure=False):
+    register_function(f, name, num_args*(Number,), docstring=docstring,
+                      pure=pure)
     if num_args == 1:
         def quantity_function(quantity):
             return Quantity(f(quantity.mag), quantity.qv)
@@ -243,12 +362,35 @@ def strict_pow(x, y):
     # Fractional power, and negative number.
     if is_fractional(y) and is_true(dispatch("<", (x, 0))):
         raise KaRuntimeError("Tried to take fractional power of a negative number.")
+    if precision.is_enabled() and is_fractional(y):
+        return precision.power(x, y)
+    if isinstance(y, Integral) and isinstance(x, Rational):
+        check_int_bits(pow_bits(x, y))
     return x**y
 
+def pow_bits(x, n):
+    """Roughly how many bits the numerator or denominator of x^n will
+    take, where x is rational and n is an integer."""
+    return abs(n)*math.log2(max(abs(x.numerator), x.denominator))
+
+def multiply(x, y):
+    # Checked like powers, since squaring a number over and over makes
+    # it just as big.
+    if type(x) is int and type(y) is int:
+        bits = x.bit_length() + y.bit_length()
+        # Small numbers are by far the most common.
+        if bits > 64:
+            check_int_bits(bits)
+    elif isinstance(x, Rational) and isinstance(y, Rational):
+        check_int_bits(max(
+            abs(x.numerator).bit_length() + abs(y.numerator).bit_length(),
+            x.denominator.bit_length() + y.denominator.bit_length()))
+    return x*y
+
 BINARY_OPS = [
     ("+", operator.add, "Addition binary operator."),
     ("-", operator.sub, "Subtraction binary operator."),
-    ("*", operator.mul, "Multiplication binary operator."),
+    ("*", multiply, "Multiplication binary operator."),
     ("/", operator.truediv, "Division binary operator. Passing 2 integers results in a fraction."),
     ("%", operator.mod, "Modulo binary operator. 4%3=1."),
     ("^", strict_pow, "Exponentiation binary operator. 2^3=8."),
@@ -295,24 +437,129 @@ register_function(comb_div_frac, "/", (Combinatoric, Rational))
 register_function(frac_times_comb, "*", (Rational, Combinatoric))
 register_function(frac_div_comb, "/", (Rational, Combinatoric))
 
-def ka_ln(x): return ka_log(x, math.e)
-def ka_log10(x): return ka_log(x, 10)
-def ka_log2(x): return ka_log(x, 2)
+#######################
+# Primitive operators #
+#######################
+# Operators on two plain numbers (see PRIMITIVE_NUMBER_TYPES), which
+# the evaluator calls directly rather than through `dispatch`. They do
+# what the overloads above do for those types, but most of the time of
+# a call like `1+1` would go on finding the overload.
+def primitive_divide(x, y):
+    if type(x) is int and type(y) is int:
+        return fraction_divide(x, y)
+    return x / y
+
+def primitive_pow(x, y):
+    if type(y) is not int:
+        return strict_pow(x, y)
+    # Integer powers can't be fractional, so there's nothing for
+    # strict_pow to check apart from the size of the result.
+    if type(x) is not float:
+        check_int_bits(pow_bits(x, y))
+    return x**y
+
+PRIMITIVE_OPS = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": multiply,
+    "/": primitive_divide,
+    "%": operator.mod,
+    "^": primitive_pow,
+    "<": intify(operator.lt),
+    "<=": intify(operator.le),
+    "==": intify(operator.eq),
+    "!=": intify(operator.ne),
+    ">": intify(operator.gt),
+    ">=": intify(operator.ge),
+}
+
+def call_primitive_op(name, x, y):
+    """The result of `dispatch(name, (x, y))`, where `name` is in
+    PRIMITIVE_OPS and x and y are plain numbers."""
+    check_limits()
+    result = PRIMITIVE_OPS[name](x, y)
+    return result if type(result) is int else simplify_number(result)
+
+#############
+# Precision #
+#############
+# In precision mode, Reals are Decimals (see ka.precision). Arithmetic
+# that involves a Decimal converts the other operand to a Decimal too.
+def uses_decimal(*args):
+    return precision.is_enabled() or any(isinstance(x, Decimal) for x in args)
+
+def decimal_op(op):
+    def f(x, y):
+        return op(precision.to_decimal(x), precision.to_decimal(y))
+    return f
+
+def decimal_mod(x, y):
+    r = precision.to_decimal(x) % precision.to_decimal(y)
+    # Decimal's remainder has the sign of x, but Python's (and Ka's)
+    # has the sign of y.
+    if r and (r < 0) != (y < 0):
+        r += y
+    return r
+
+def decimal_pow(x, y):
+    if is_fractional(y) and is_true(dispatch("<", (x, 0))):
+        raise KaRuntimeError("Tried to take fractional power of a negative number.")
+    return precision.power(x, y)
+
+DECIMAL_OPS = [
+    ("+", decimal_op(operator.add)),
+    ("-", decimal_op(operator.sub)),
+    ("*", decimal_op(operator.mul)),
+    ("/", decimal_op(operator.truediv)),
+    ("%", decimal_mod),
+    ("^", decimal_pow),
+    ("<", intify(decimal_op(operator.lt))),
+    ("<=", intify(decimal_op(operator.le))),
+    ("==", intify(decimal_op(operator.eq))),
+    ("!=", intify(decimal_op(operator.ne))),
+    (">", intify(decimal_op(operator.gt))),
+    (">=", intify(decimal_op(operator.ge))),
+]
+for name, op in DECIMAL_OPS:
+    for arg_types in [(Decimal, Number), (Number, Decimal), (Decimal, Decimal)]:
+        register_function(op, name, arg_types)
+
+def real_function(float_f, decimal_f):
+    """A function with a Real result, computed as a Decimal in
+    precision mode."""
+    def f(x):
+        return decimal_f(x) if uses_decimal(x) else float_f(x)
+    return f
+
+def ka_ln(x):
+    check_log_arg(x)
+    return precision.ln(x) if uses_decimal(x) else math.log(x)
+
+def ka_log10(x):
+    check_log_arg(x)
+    return precision.log10(x) if uses_decimal(x) else math.log(x, 10)
+
+def ka_log2(x):
+    check_log_arg(x)
+    return precision.log2(x) if uses_decimal(x) else math.log(x, 2)
 
 def ka_log(x, base):
+    check_log_arg(x)
+    return precision.log(x, base) if uses_decimal(x, base) else math.log(x, base)
+
+def check_log_arg(x):
     if dispatch("<=", (x, 0)):
         raise KaRuntimeError(f"Non-positive value passed to log: {x}")
-    return math.log(x, base)
 
 def ka_sqrt(x):
     if dispatch("<", (x, 0)):
         raise KaRuntimeError(f"Negative value passed to sqrt: {x}")
-    return math.sqrt(x)
+    return precision.sqrt(x) if uses_decimal(x) else math.sqrt(x)
 
 NUMERIC_FUNCTIONS = [
-    ("sin", math.sin, "Trigonometric sine function."),
-    ("cos", math.cos, "Trigonometric cosine function."),
-    ("tan", math.tan, "Trigonometric tangent function."),
+    ("sin", real_function(math.sin, precision.sin), "Trigonometric sine function."),
+    ("cos", real_function(math.cos, precision.cos), "Trigonometric cosine function."),
+    ("tan", real_function(math.tan, precision.tan), "Trigonometric tangent function."),
     ("sqrt", ka_sqrt, "Square root of a number."),
     ("ln", ka_ln, "Natural log, base e."),
     ("log10", ka_log10, "Logarithm base 10."),
@@ -326,12 +573,17 @@ NUMERIC_FUNCTIONS = [
     ("+", operator.pos, None),
     ("-", operator.neg, None),
 ]
+# Slow enough that it's worth caching their results.
+EXPENSIVE_NUMERIC_FUNCTIONS = {"sin", "cos", "tan", "sqrt", "ln", "log10",
+                               "log2"}
 for name, f, docstring in NUMERIC_FUNCTIONS:
-    register_numeric_function(name, f, docstring=docstring)
+    register_numeric_function(name, f, docstring=docstring,
+                              pure=name in EXPENSIVE_NUMERIC_FUNCTIONS)
 register_numeric_function("log",
                           ka_log,
                           num_args=2,
-                          docstring="Logarithm function. The first argument determines the base.")
+                          docstring="Logarithm function. The first argument determines the base.",
+                          pure=True)
 
 def max_vararg(*args):
     return max(*args)
@@ -343,11 +595,13 @@ register_function(min_vararg, "min", tuple(), vararg_type=Number)
 register_function(lazy_choose,
                   "C",
                   (Integral, Integral),
-                  "Binomial coefficient function from combinatorics. It returns how many ways there are to select k items (second argument) from a total of n items (first argument).")
+                  "Binomial coefficient function from combinatorics. It returns how many ways there are to select k items (second argument) from a total of n items (first argument).",
+                  pure=True)
 register_function(lazy_factorial,
                   "!",
                   (Integral,),
-                  "Factorial postfix operator.")
+                  "Factorial postfix operator.",
+                  pure=True)
 def register_quantities_op(name,
                            quantity_vector_combiner=None,
                            wrap_in_quantity=True):
@@ -367,7 +621,7 @@ def register_quantities_op(name,
     def left_is_number(n, q):
         return f(Quantity(n, QSPACE.get_zero()), q)
     def right_is_number(q, n):
-        return left_is_number(n, q)
+        return f(q, Quantity(n, QSPACE.get_zero()))
     register_function(left_is_number, name, (Number, Quantity))
     register_function(right_is_number, name, (Quantity, Number))
 
@@ -410,15 +664,28 @@ RVS = (
     (Gaussian, (Number, Number),
      "Gaussian/normal random variable parameterised by mean and standard deviation.")
 )
+def with_float_args(f):
+    """Random variables are worked out with floats, so the Decimals of
+    precision mode are converted on the way in."""
+    def f_new(*args):
+        return f(*[float(x) if isinstance(x, Decimal) else x for x in args])
+    return f_new
+
 for rvname, args, doc in RVS:
-    register_function(rvname, rvname.__name__, args, docstring=doc)
+    register_function(with_float_args(rvname), rvname.__name__, args,
+                      docstring=doc)
 
 register_function(lambda rv: rv.mean(), "mean", (RandomVariable,), "Get the mean of a random variable.")
 register_function(lambda rv: rv.mean(), "E", (RandomVariable,), "Expectation of a random variable.")
 register_function(lambda rv: rv.sample(), "sample", (RandomVariable,), "Sample a value from a random distribution.")
 
 def sample_multiple(rv, n):
-    return Array([rv.sample() for _ in range(n)])
+    allocate(max(0, n))
+    result = []
+    for _ in range(n):
+        check_limits()
+        result.append(rv.sample())
+    return Array(result)
 register_function(sample_multiple,
                   "sample",
                   (RandomVariable, Integral),
@@ -443,12 +710,12 @@ for op1 in [ComparisonOp.LEQ, ComparisonOp.LT]:
     for args in [(Number, RandomVariable), (RandomVariable, Number)]:
         # Can't use a lambda here because it doesn't have
         # proper lexical closure. Annoying Python.
-        register_function(make_event_fun(op1),
+        register_function(with_float_args(make_event_fun(op1)),
                           op1,
                           args,
                           "Comparison operator.")
     for op2 in [ComparisonOp.LEQ, ComparisonOp.LT]:
-        register_function(make_double_event_fun(op1, op2),
+        register_function(with_float_args(make_double_event_fun(op1, op2)),
                           "_".join([op1, op2]),
                           (Number, RandomVariable, Number),
                           "Double comparison operator.")
@@ -459,18 +726,64 @@ for etype in [Event, DoubleEvent]:
 ##########
 # Arrays #
 ##########
+# Arrays of plain numbers are common and can be big, so the reductions
+# below hand them straight to Python rather than dispatching on every
+# element. The results are the same as dispatching, except that floats
+# are summed with `math.fsum`, which is more accurate.
+PRIMITIVE_NUMBER_TYPES = frozenset([int, float, frac])
+
+def has_floats_and_fractions(types):
+    # Dispatching simplifies after every step, so a float that becomes a
+    # whole number turns back into an exact value, e.g. 0.5 + 0.5 + 1/3
+    # is 4/3. Python would give a float.
+    return float in types and frac in types
+
+def primitive_types(xs):
+    """The set of types of the elements, or None if some of them
+    aren't plain numbers."""
+    types = set(map(type, xs))
+    if types <= PRIMITIVE_NUMBER_TYPES:
+        # Charge for the elements as if they had been dispatched on.
+        check_limits(len(xs))
+        return types
+    return None
+
+def common_quantity_vector(xs):
+    """If the elements are all quantities with the same units and plain
+    number magnitudes, returns those units. They can then be reduced
+    by reducing the magnitudes."""
+    if not xs or type(xs[0]) is not Quantity:
+        return None
+    qv = xs[0].qv
+    for x in xs:
+        if (type(x) is not Quantity
+                or type(x.mag) not in PRIMITIVE_NUMBER_TYPES
+                or x.qv != qv):
+            return None
+    return qv
+
 def array_prod(arr):
+    types = primitive_types(arr.contents)
+    if types is not None and not has_floats_and_fractions(types):
+        return math.prod(arr.contents) if float in types else exact_prod(arr.contents)
+    mul = OverloadCache("*")
     result = 1
     for e in arr.contents:
-        result = dispatch("*", (e, result))
+        result = mul(e, result)
     return result
 
 def array_min(arr):
     if len(arr.contents) == 0:
         raise FunctionArgError("Tried to get minimum of empty array.")
+    if primitive_types(arr.contents) is not None:
+        return min(arr.contents)
+    if common_quantity_vector(arr.contents) is not None:
+        check_limits(len(arr.contents))
+        return min(arr.contents, key=lambda q: q.mag)
+    less = OverloadCache("<")
     result = arr.contents[0]
     for e in arr.contents:
-        if dispatch("<", (e, result)):
+        if less(e, result):
             result = e
     return result
 
@@ -478,9 +791,15 @@ def array_min(arr):
 def array_max(arr):
     if len(arr.contents) == 0:
         raise FunctionArgError("Tried to get maximum of empty array.")
+    if primitive_types(arr.contents) is not None:
+        return max(arr.contents)
+    if common_quantity_vector(arr.contents) is not None:
+        check_limits(len(arr.contents))
+        return max(arr.contents, key=lambda q: q.mag)
+    less = OverloadCache("<")
     result = arr.contents[0]
     for e in arr.contents:
-        if dispatch("<", (result, e)):
+        if less(result, e):
             result = e
     return result
 
@@ -489,9 +808,22 @@ def array_max(arr):
 def array_sum(arr):
     if len(arr.contents) == 0:
         return 0
+    types = primitive_types(arr.contents)
+    if types is not None and not has_floats_and_fractions(types):
+        if float in types:
+            try:
+                return math.fsum(arr.contents)
+            except (OverflowError, ValueError):
+                # Infinities, or an intermediate sum that overflowed.
+                return sum(arr.contents)
+        return exact_sum(arr.contents)
+    qv = common_quantity_vector(arr.contents)
+    if qv is not None:
+        return Quantity(array_sum(Array([q.mag for q in arr.contents])), qv)
+    add = OverloadCache("+")
     result = arr.contents[0]
     for i in range(1, len(arr.contents)):
-        result = dispatch("+", (result, arr.contents[i]))
+        result = add(result, arr.contents[i])
     return result
 
 def array_size(arr):
@@ -505,44 +837,113 @@ def array_mean(arr):
 def in_array(x, arr):
     return any(dispatch("==", (x, e)) for e in arr)
 
-def ka_cmp(x, y):
-    if dispatch("<", (x, y)):
-        return -1
-    if dispatch("==", (x, y)):
-        return 0
-    return 1
+class DispatchOrdered:
+    """Wraps a value so that `<` is dispatched, for ordering values
+    that Python can't compare by itself."""
+    __slots__ = ("value", "less")
+
+    def __init__(self, value, less):
+        self.value = value
+        self.less = less
+
+    def __lt__(self, other):
+        return is_true(self.less(self.value, other.value))
+
+def order_statistics(xs, ranks):
+    """Returns a dict from each rank to the element of `xs` that would
+    have that index if `xs` were sorted."""
+    if primitive_types(xs) is not None:
+        return select(xs, ranks)
+    if common_quantity_vector(xs) is not None:
+        # The index breaks ties, so the quantities themselves are
+        # never compared.
+        items = [(q.mag, i, q) for i, q in enumerate(xs)]
+        return dict((r, item[2]) for r, item in select(items, ranks).items())
+    less = OverloadCache("<")
+    items = [DispatchOrdered(x, less) for x in xs]
+    return dict((r, item.value) for r, item in select(items, ranks).items())
 
 def array_median(arr):
-    if len(arr.contents) == 0:
+    n = len(arr.contents)
+    if n == 0:
         raise FunctionArgError("Tried to take median of empty array.")
-    arr_sorted = list(sorted(arr.contents, key=cmp_to_key(ka_cmp)))
-    if len(arr_sorted)%2 == 0:
-        mid_i = len(arr_sorted) // 2
-        return dispatch("/", (dispatch("+",
-                                       (arr_sorted[mid_i-1],
-                                        arr_sorted[mid_i])),
-                              2))
-    return arr_sorted[len(arr_sorted)//2]
-    
+    if n%2 == 0:
+        mid = order_statistics(arr.contents, [n//2-1, n//2])
+        return dispatch("/", (dispatch("+", (mid[n//2-1], mid[n//2])), 2))
+    return order_statistics(arr.contents, [n//2])[n//2]
+
+def percentile_position(n, p):
+    """Where the p-th percentile falls between the elements of a sorted
+    array of size n, as (index, fraction of the way to the next index)."""
+    if not 0 <= p <= 100:
+        raise FunctionArgError(f"Percentile must be between 0 and 100, but was {p}.")
+    position = (n-1)*p
+    position = fraction_divide(position, 100) if isinstance(position, Rational) else position/100
+    i = math.floor(position)
+    return min(i, n-1), position-i
+
+def interpolate_percentiles(xs, ps):
+    """Linearly interpolates between the closest ranks, like the
+    default method of NumPy's `percentile`."""
+    n = len(xs)
+    if n == 0:
+        raise FunctionArgError("Tried to take percentile of empty array.")
+    positions = [percentile_position(n, p) for p in ps]
+    ranks = []
+    for i, t in positions:
+        ranks.append(i)
+        if t:
+            ranks.append(i+1)
+    values = order_statistics(xs, ranks)
+    result = []
+    for i, t in positions:
+        if t:
+            lo, hi = values[i], values[i+1]
+            result.append(dispatch("+", (lo, dispatch("*", (t, dispatch("-", (hi, lo)))))))
+        else:
+            result.append(values[i])
+    return result
+
+def array_percentile(arr, p):
+    return interpolate_percentiles(arr.contents, [p])[0]
+
+def array_quantiles(arr, k):
+    if k < 1:
+        raise FunctionArgError(f"Number of quantiles must be at least 1, but was {k}.")
+    return Array(interpolate_percentiles(arr.contents,
+                                         [fraction_divide(100*i, k) for i in range(1, k)]))
+
 register_function(array_prod, "prod", (Array,), "Product of the elements of an array.")
 register_function(array_sum, "sum", (Array,), "Sum of the elements of an array.")
 register_function(array_mean, "mean", (Array,), "Mean of the elements of an array.")
 register_function(array_median, "median", (Array,), "Median of the elements of an array.")
+register_function(array_percentile, "percentile", (Array, Number), "The p-th percentile of the elements of an array, where p is between 0 and 100. Interpolates linearly between elements.")
+register_function(array_quantiles, "quantiles", (Array, Integral), "The k-1 cut points that divide the elements of an array into k groups of equal size. quantiles(xs, 4) gives the quartiles.")
 register_function(array_size, "size", (Array,), "Number of elements in an array.")
 register_function(array_max, "max", (Array,), "Maximum of a selection of numbers.")
 register_function(array_min, "min", (Array,), "Minimum of a selection of numbers.")
 register_function(in_array, "in", (Any, Array), "Whether an element is present in a set/array.")
 
-register_function(lambda lo, hi: Array(list(range(lo, hi+1))),
+def int_range(lo, hi):
+    # Building the list happens in one go, so charge for it up front.
+    size = max(0, hi-lo+1)
+    allocate(size)
+    check_limits(size)
+    return Array(list(range(lo, hi+1)))
+
+register_function(int_range,
                   "range",
                   (Integral, Integral),
                   "Returns an array of the integers lo, lo+1, ..., hi.")
 def ka_range(lo, hi, step):
     if not dispatch("<=", (lo, hi)):
         raise FunctionArgError(f"Lower bound of range (was {lo}) must be less than or equal to upper bound (was {hi}).")
+    if is_true(dispatch(">", (step, 0))):
+        allocate(int(dispatch("/", (dispatch("-", (hi, lo)), step))) + 1)
     result = []
     curr = lo
     while dispatch("<=", (curr, hi)):
+        check_limits()
         result.append(curr)
         curr = dispatch("+", (curr, step))
     return Array(result)
@@ -550,39 +951,89 @@ def ka_range(lo, hi, step):
 register_function(ka_range, "range", (Number, Number, Number),
                   "Generates array of all numbers between lower bound (1st arg) and upper bound (2nd arg) with given step size (3rd arg).")
 
+########
+# Sets #
+########
+def make_set(arr):
+    for x in arr.contents:
+        if not is_hashable(x):
+            raise FunctionArgError(f"Can't put a value of type {get_external_type_name(x)} in a set, only numbers, strings and instants.")
+    allocate(len(arr.contents))
+    check_limits(len(arr.contents))
+    return Set.from_values(arr.contents)
+
+def in_set(x, s):
+    if is_hashable(x):
+        return 1 if x in s else 0
+    # Could still be equal to something in the set, according to
+    # dispatch. A dimensionless quantity, say.
+    return 1 if any(is_true(dispatch("==", (x, e))) for e in s) else 0
+
+def set_union(s1, s2):
+    allocate(len(s2))
+    check_limits(len(s2))
+    elements = s1.elements.copy()
+    elements.update(s2.elements)
+    return Set(elements)
+
+def set_intersection(s1, s2):
+    small, big = (s1, s2) if len(s1) <= len(s2) else (s2, s1)
+    check_limits(len(small))
+    return Set(dict((e, None) for e in small if e in big))
+
+def set_difference(s1, s2):
+    check_limits(len(s1))
+    return Set(dict((e, None) for e in s1 if e not in s2))
+
+def set_to_array(s):
+    allocate(len(s))
+    return Array(list(s))
+
+register_function(make_set, "set", (Array,), "Creates a set from the elements of an array, dropping duplicates. Sets can contain numbers, strings and instants.")
+register_function(lambda: Set({}), "set", tuple())
+register_function(in_set, "in", (Any, Set))
+register_function(set_union, "union", (Set, Set), "Set of the elements that are in either set.")
+register_function(set_intersection, "intersection", (Set, Set), "Set of the elements that are in both sets.")
+register_function(set_difference, "difference", (Set, Set), "Set of the elements of the first set that aren't in the second.")
+register_function(len, "size", (Set,))
+register_function(set_to_array, "array", (Set,), "Array of the elements of a set.")
+register_function(intify(operator.eq), "==", (Set, Set))
+register_function(intify(operator.ne), "!=", (Set, Set))
+# Strings were only ever compared by the catch-all "==" above, which
+# made them all unequal.
+register_function(intify(operator.eq), "==", (String, String))
+register_function(intify(operator.ne), "!=", (String, String))
+
 ############
 # Plotting #
 ############
 # Had to move this here so it could use `dispatch` without a circular
 # dependency.
+def compute_bins(xs, num_bins=10, bin_width=None, start=0):
+    """Returns the bin edges and the number of values in each bin."""
+    xs = xs.contents
+    check_limits(len(xs))
+    try:
+        edges = bin_edges(xs, num_bins=num_bins, bin_width=bin_width,
+                          start=start)
+    except BinningError as e:
+        raise KaRuntimeError(e.msg)
+    allocate(len(edges))
+    return edges, bin_counts(xs, edges)
+
 def histogram(xs, **kwargs):
     check_all_numerical(xs)
     sel, o = separate_kwargs(kwargs,
         ["label", "cumulative", "normalise", "colour",
          "num_bins", "bin_width", "start", "align", "border_colour"])
-    start = _g(sel, "start", 0)
-    bin_width = _g(sel, "bin_width")
-    num_bins = _g(sel, "num_bins", 10)
-    def do():
-        nonlocal start
-        if num_bins <= 0:
-            raise KaRuntimeError("Number of bins  must be positive but was " + str(num_bins))
-        if bin_width:
-            if bin_width <= 0:
-                raise KaRuntimeError("Bin width must be positive but was " + str(bin_width))
-            lo = dispatch("min", (xs,))
-            if dispatch("<", (lo, start)):
-                start -= bin_width*math.ceil(dispatch("-", (start, lo))/bin_width)
-            hi = dispatch("max", (xs,))
-            bins = []
-            b = start
-            while True:
-                if b > hi:
-                    break
-                bins.append(b)
-                b += bin_width
-        else:
-            bins = num_bins
+    # Counting is done up front, so matplotlib only has to draw one
+    # bar per bin rather than going through all the values again.
+    edges, bin_counts = compute_bins(
+        xs,
+        num_bins=_g(sel, "num_bins", 10),
+        bin_width=_g(sel, "bin_width"),
+        start=_g(sel, "start", 0))
+    def do(ax):
         normalise = _g(sel, "normalise", False)
         params = dict(
             label=_g(sel, "label"),
@@ -592,9 +1043,10 @@ def histogram(xs, **kwargs):
             # Don't pass unless necessary.
             stacked=True if is_true(normalise) else None,
             align=_g(sel, "align", "mid"),
-            bins=bins,
+            bins=edges,
+            weights=bin_counts,
             edgecolor=_g(sel, "border_colour"))
-        get_plt().hist(xs, **only_not_none(params))
+        ax.hist(edges[:-1], **only_not_none(params))
     return PlotDrawing(do, o)
 
 plot_option_types = dict(
@@ -639,19 +1091,47 @@ register_function(
         cumulative=Bool,
         normalise=Bool,
         colour=String,
-        num_bins=Number,
+        num_bins=Integral,
         bin_width=Number,
         start=Number,
         align=String,
         border_colour=String,
         **plot_option_types))
 
+def ka_counts(xs, normalise=None, cumulative=None, **kwargs):
+    check_all_numerical(xs, action="count")
+    edges, counts = compute_bins(xs, **kwargs)
+    if cumulative and is_true(cumulative):
+        counts = cumulative_counts(counts)
+    if normalise and is_true(normalise):
+        total = len(xs)
+        counts = [simplify_type(fraction_divide(c, total)) for c in counts]
+    return Array([Array(edges), Array(counts)])
+
+register_function(
+    ka_counts,
+    "counts",
+    (Array,),
+    "Divides the values into bins like `histogram`, without plotting. Returns an array of 2 arrays: the bin edges, and the number of values in each bin.",
+    dict(
+        cumulative=Bool,
+        normalise=Bool,
+        num_bins=Integral,
+        bin_width=Number,
+        start=Number))
+
 register_function(plot,
     "plot",
     tuple(),
-    "Plots a series of plottable things.",
+    "Plots a series of plottable things. If `output` is given, the plot is saved to that file instead of being displayed.",
+    kw_args=dict(output=String),
     vararg_type=Plot)
 
+register_function(save,
+    "save",
+    (Plot, String),
+    "Saves a plot to a file (e.g. \"plot.png\"), without displaying it.")
+
 register_function(
     scatter,
     "scatter",
@@ -708,6 +1188,26 @@ register_function(get_hour, "hour", (Instant,))
 register_function(get_minute, "minute", (Instant,))
 register_function(get_second, "second", (Instant,))
 
+##############
+# Currencies #
+##############
+def currency_code(name):
+    for code, symbol in SPECIAL_CURRENCY_SYMBOLS.items():
+        if name == symbol:
+            return code
+    return name.lower()
+
+def convert_currency_at(amount, from_currency, to_currency, instant):
+    try:
+        return convert_at(amount, currency_code(from_currency),
+                          currency_code(to_currency), instant.dt.date())
+    except RateHistoryError as e:
+        raise KaRuntimeError(str(e))
+
+register_function(
+    convert_currency_at, "convert", (Number, String, String, Instant),
+    "Converts an amount between currencies (given by their codes, like \"usd\") using the exchange rates on a past date.")
+
 #############
 # Intervals #
 #############
@@ -858,6 +1358,69 @@ def interval_plusminus(x, y):
 register_function(interval_plusminus, "±", (Number, Number))
 register_function(interval_plusminus, "tol", (Number, Number))
 
+##########################
+# User-defined functions #
+##########################
+# The functions defined with `f(x) = ...` belong to an environment (a
+# table of name -> overloads), so that sessions don't see each other's
+# functions. While an environment's commands are evaluated, its table is
+# in effect for the thread, and `dispatch` finds them there. They can't
+# have the same names as built-in functions.
+_user_functions = threading.local()
+USER_FUNCTION_DOCSTRING = "User-defined function."
+DEFAULT_MEMO_SIZE = 10000
+
+@contextlib.contextmanager
+def user_functions_in_effect(table):
+    previous = getattr(_user_functions, "table", None)
+    _user_functions.table = table
+    try:
+        yield table
+    finally:
+        _user_functions.table = previous
+
+def current_user_functions():
+    table = getattr(_user_functions, "table", None)
+    return {} if table is None else table
+
+def define_user_function(table, f, name, num_params):
+    """Adds f to `table` for calls to `name` with `num_params` arguments,
+    replacing any previous definition with that many parameters."""
+    if name in FUNCTIONS:
+        raise KaRuntimeError(f"Can't redefine built-in function '{name}'.")
+    overloads = table.get(name, [])
+    for header in overloads:
+        if len(header.sig.args) == num_params and header.f.cache is not None:
+            # Stays memoized, but previous results are forgotten.
+            f.memoize(header.f.cache.size)
+    table[name] = [header for header in overloads
+                   if len(header.sig.args) != num_params]
+    table[name].append(
+        FunctionHeader(name, f, FunctionSignature((Any,)*num_params)))
+
+def memoize(name, size=DEFAULT_MEMO_SIZE):
+    overloads = current_user_functions().get(name)
+    if overloads is None:
+        raise FunctionArgError(f"'{name}' isn't a user-defined function.")
+    if size <= 0:
+        raise FunctionArgError(f"Cache size must be positive but was {size}.")
+    for header in overloads:
+        header.f.memoize(size)
+
+register_function(
+    memoize, "memoize", (String,),
+    kw_args={"size": Integral},
+    docstring="Remember the results of a user-defined function, e.g. memoize(\"fib\"). Only for functions that depend on nothing but their arguments. The size keyword limits how many results are kept (default: 10000).")
+
+def ka_if(condition, x, y):
+    return x if is_true(condition) else y
+
+# Calls to `if` are evaluated by `eval`, which only evaluates the branch
+# that's taken. This is for the documentation.
+register_function(
+    ka_if, "if", (Bool, Any, Any),
+    docstring="If the first argument is true, returns the second argument, otherwise the third. Only the one that's returned is evaluated.")
+
 FUNCTION_NAMES = list(FUNCTIONS.keys())
 
 if __name__ == "__main__":
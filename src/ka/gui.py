@@ -2,21 +2,26 @@ import sys
 import io
 import html
 import re
+import traceback
 
 from PyQt5.QtCore import QT_VERSION_STR, PYQT_VERSION_STR, Qt
 from PyQt5.QtGui import QKeySequence
 from PyQt5 import QtCore, QtGui
 from PyQt5.QtWidgets import (QApplication, QWidget, QLineEdit, QLabel,
     QScrollArea, QVBoxLayout, QMainWindow, QAction, QSizePolicy,
-    QShortcut, QHBoxLayout, QComboBox)
+    QShortcut, QHBoxLayout, QComboBox, QTextEdit)
 
 from .interpret import (KA_VERSION, execute, ResultBox, stringify_result,
     get_functions_string, get_units_string, format_unit_info,
-    format_function_info, load_history, save_history)
+    format_function_info)
+from .history import open_history
 from .eval import EvalEnvironment
+from .limits import EvalLimits
+import ka.plot
 from .functions import FUNCTION_NAMES
-from .units import UNITS, PREFIXES
+from .units import UNITS, PREFIXES, load_currencies
 from .config import ConfigProperties
+from .currency import enable_background_refresh
 import ka.config
 
 REPO_URL = "https://github.com/Kevinpgalligan/ka"
@@ -100,6 +105,7 @@ class ShortcutsWindow(QWidget):
 * Open list of functions: {ka.config.get(ConfigProperties.DEFAULT_SHORTCUT_FUNCTIONS)}.
 * Open list of units: {ka.config.get(ConfigProperties.DEFAULT_SHORTCUT_UNITS)}.
 * Open list of prefixes: {ka.config.get(ConfigProperties.DEFAULT_SHORTCUT_PREFIXES)}.
+* Cancel the running command: {ka.config.get(ConfigProperties.DEFAULT_SHORTCUT_CANCEL)} or Ctrl+C.
 """)
         add_exit_shortcut(self)
 
@@ -115,6 +121,9 @@ class HintBar(QWidget):
         self.cb_functions.addItems(FUNCTION_NAMES)
         self.cb_units = QComboBox(self)
         self.cb_units.addItem("Units")
+        # The currencies are usually registered lazily, but we want them
+        # in this list.
+        load_currencies()
         self.cb_units.addItems([f"{u.singular_name} ({u.symbol})" for u in UNITS])
         self.cb_prefixes = QComboBox(self)
         self.cb_prefixes.addItem("Prefixes")
@@ -139,8 +148,54 @@ class HintBar(QWidget):
     def show_prefixes(self):
         self.cb_prefixes.showPopup()
  
+class EvalOutcome:
+    def __init__(self, txt, status, output, result, assigned,
+                 post_display_action):
+        self.txt = txt
+        self.status = status
+        self.output = output
+        self.result = result
+        self.assigned = assigned
+        self.post_display_action = post_display_action
+
+class EvalWorker(QtCore.QObject):
+    """Evaluates commands on its own thread, so that the window stays
+    responsive (and the command can be cancelled) during a long
+    computation. Only one command runs at a time."""
+    finished = QtCore.pyqtSignal(object)
+
+    def __init__(self, env):
+        super().__init__()
+        self.env = env
+
+    @QtCore.pyqtSlot(str, object)
+    def evaluate(self, txt, limits):
+        out = io.StringIO()
+        result_box = ResultBox()
+        assigned_box = ResultBox()
+        post_display_action_box = ResultBox()
+        status = 1
+        try:
+            status = execute(txt, out=out, errout=out, env=self.env,
+                             result_box=result_box, brackets_for_frac=True,
+                             assigned_box=assigned_box,
+                             post_display_action_box=post_display_action_box,
+                             unit_format_fn=gui_unit_format,
+                             limits=limits)
+        except Exception as e:
+            traceback.print_exc()
+            print(f"Unexpected error: {e!r}", file=out)
+        finally:
+            # Otherwise the window would wait for the command forever.
+            self.finished.emit(EvalOutcome(
+                txt, status, out.getvalue(), result_box.value,
+                assigned_box.value, post_display_action_box.value))
+
 class KaWidget(QWidget):
     key_pressed = QtCore.pyqtSignal(int)
+    evaluate_signal = QtCore.pyqtSignal(str, object)
+    eval_finished = QtCore.pyqtSignal(object)
+    display_requested = QtCore.pyqtSignal(object)
     display_fn_signal = QtCore.pyqtSignal(int)
     display_unit_signal = QtCore.pyqtSignal(int)
 
@@ -157,17 +212,21 @@ class KaWidget(QWidget):
 
         font = QtGui.QFont(FONT, font_size)
         
-        #self.output_box.resize(*wsize)
-        self.output_box = QLabel()
+        # Output is appended to the document rather than re-rendering
+        # the whole session each time, so a command costs the same in
+        # a long session as in a short one.
+        self.output_box = QTextEdit()
+        self.output_box.setReadOnly(True)
         self.output_box.setFont(font)
         self.output_box.setStyleSheet("background-color: white;")
         self.output_box.setTextInteractionFlags(Qt.TextSelectableByMouse)
-        self.output_box.setWordWrap(True)
-        #self.output_box.setAlignment(Qt.AlignLeft)
-
-        # Make output area scrollable.
-        self.scroll_area = make_scroll(self.output_box)
-        self.scroll_area.verticalScrollBar() \
+        self.output_box.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        scrollback = ka.config.get(ConfigProperties.SCROLLBACK)
+        if scrollback > 0:
+            # Each line of output is its own block, so this caps the
+            # number of lines. Qt throws away the oldest ones.
+            self.output_box.document().setMaximumBlockCount(scrollback)
+        self.output_box.verticalScrollBar() \
             .rangeChanged \
             .connect(self.scroll_to_bottom)
 
@@ -181,11 +240,20 @@ class KaWidget(QWidget):
         self.hint_bar.display_unit_signal.connect(self.display_unit_signal)
 
         layout = QVBoxLayout()
-        layout.addWidget(self.scroll_area)
+        layout.addWidget(self.output_box)
         layout.addWidget(self.input_widget)
         layout.addWidget(self.hint_bar)
         self.setLayout(layout)
 
+    @QtCore.pyqtSlot(object)
+    def on_eval_finished(self, outcome):
+        # Relays the worker's result so that it's handled on the GUI thread.
+        self.eval_finished.emit(outcome)
+
+    @QtCore.pyqtSlot(object)
+    def run_display_action(self, f):
+        f()
+
     def show_functions(self):
         self.hint_bar.show_functions()
 
@@ -196,8 +264,8 @@ class KaWidget(QWidget):
         self.hint_bar.show_prefixes()
 
     def scroll_to_bottom(self):
-        self.scroll_area.verticalScrollBar().setValue(
-            self.scroll_area.verticalScrollBar().maximum())
+        self.output_box.verticalScrollBar().setValue(
+            self.output_box.verticalScrollBar().maximum())
 
 def get_version_string():
     return f"ka version {KA_VERSION}, QT version {QT_VERSION_STR}, PyQT version {PYQT_VERSION_STR}"
@@ -229,6 +297,7 @@ def gui_unit_format(qv):
 
 def run_gui():
     print(get_version_string())
+    enable_background_refresh()
     size = (ka.config.get(ConfigProperties.WINDOW_WIDTH),
             ka.config.get(ConfigProperties.WINDOW_HEIGHT))
     font_size = ka.config.get(ConfigProperties.FONT_SIZE)
@@ -238,92 +307,137 @@ def run_gui():
     app = QApplication([])
     w = MainWindow(size, font_size)
     env = EvalEnvironment()
-    displayed_stuff = []
-
-    command_history = load_history()
-    new_command_history = []
-    command_index = len(command_history)
-    def add_command_history(txt):
-        nonlocal command_history, new_command_history
-        txt = txt.strip()
-        if len(txt) > 0:
-            command_history.append(txt)
-            new_command_history.append(txt)
+
+    history = open_history()
+    # Sequence number of the history entry being shown, or None if the
+    # user is composing a new command.
+    shown_seq = None
+    # Whatever the user had typed before they started going through the
+    # history. Only commands starting with it are shown.
+    composing = ""
 
     def add_display_text(txt, colour="gray"):
-        displayed_stuff.extend([
-            f"<font color=\"{colour}\">",
-            escape_whitespace(html.escape(txt)) \
-                .replace("\n", "<br>") \
+        for line in txt.split("\n"):
+            formatted = escape_whitespace(html.escape(line)) \
                 .replace(SUP_START, "<sup>") \
-                .replace(SUP_END, "</sup>"),
-            '</font>',
-            '<br>'
-        ])
-    def update_display():
-        displayed_str = "".join(displayed_stuff)
-        w.ka_widget.output_box.setText(displayed_str)
+                .replace(SUP_END, "</sup>")
+            w.ka_widget.output_box.append(
+                f"<font color=\"{colour}\">{formatted}</font>")
+
+    eval_thread = QtCore.QThread()
+    worker = EvalWorker(env)
+    worker.moveToThread(eval_thread)
+    w.ka_widget.evaluate_signal.connect(worker.evaluate)
+    worker.finished.connect(w.ka_widget.on_eval_finished)
+    eval_thread.start()
+    running_limits = None
+
+    def display_safely(f):
+        try:
+            f()
+        except Exception as e:
+            add_display_text("Error in call to plotting lib...\n" + str(e),
+                             colour="red")
+    # Plots opened during evaluation (by calling plot(...)) have to be
+    # shown on this thread.
+    w.ka_widget.display_requested.connect(w.ka_widget.run_display_action)
+    ka.plot.run_on_display_thread = \
+        lambda f: w.ka_widget.display_requested.emit(lambda: display_safely(f))
+
+    def set_running(running):
+        input_widget = w.ka_widget.input_widget
+        input_widget.setEnabled(not running)
+        for shortcut in cancel_shortcuts:
+            shortcut.setEnabled(running)
+        if running:
+            w.statusBar().showMessage("Running... ("
+                + ka.config.get(ConfigProperties.DEFAULT_SHORTCUT_CANCEL)
+                + " to cancel)")
+        else:
+            w.statusBar().clearMessage()
+            input_widget.setFocus()
 
     def on_key(key):
-        nonlocal command_index, command_history
-        if key == QtCore.Qt.Key_Return:
-            out = io.StringIO()
+        nonlocal shown_seq, running_limits
+        if key == QtCore.Qt.Key_Return and running_limits is None:
             txt = w.ka_widget.input_widget.text()
-            add_command_history(txt)
-            command_index = len(command_history)
-            result_box = ResultBox()
-            assigned_box = ResultBox()
-            post_display_action_box = ResultBox()
-            status = execute(txt, out=out, errout=out, env=env,
-                             result_box=result_box, brackets_for_frac=True,
-                             assigned_box=assigned_box,
-                             post_display_action_box=post_display_action_box,
-                             unit_format_fn=gui_unit_format)
-            add_display_text("  " + txt)
-            add_display_text(out.getvalue(), colour="red" if status != 0 else "gray")
-            update_display()
-            if assigned_box.value is not None:
-                w.ka_widget.input_widget.setText(assigned_box.value)
-            elif result_box.value is not None:
-                w.ka_widget.input_widget.setText(
-                    stringify_result(result_box.value, brackets_for_frac=True))
-            else:
-                w.ka_widget.input_widget.clear()
-            if post_display_action_box.value is not None:
-                post_display_action_box.value()
+            history.add(txt)
+            shown_seq = None
+            running_limits = EvalLimits.from_config()
+            set_running(True)
+            w.ka_widget.evaluate_signal.emit(txt, running_limits)
+
+    def on_eval_finished(outcome):
+        nonlocal running_limits
+        running_limits = None
+        set_running(False)
+        add_display_text("  " + outcome.txt)
+        add_display_text(outcome.output,
+                         colour="red" if outcome.status != 0 else "gray")
+        if outcome.assigned is not None:
+            w.ka_widget.input_widget.setText(outcome.assigned)
+        elif outcome.result is not None:
+            w.ka_widget.input_widget.setText(
+                stringify_result(outcome.result, brackets_for_frac=True))
+        else:
+            w.ka_widget.input_widget.clear()
+        # Plotting has to happen on the GUI thread.
+        if outcome.post_display_action is not None:
+            outcome.post_display_action()
+
+    def cancel():
+        if running_limits is not None:
+            running_limits.cancel()
 
     def previous_command():
-        nonlocal command_index, command_history
-        if command_index > 0:
-            if command_index == len(command_history):
-                # User might be currently composing a command, don't
-                # wanna lose it.
-                txt = w.ka_widget.input_widget.text()
-                add_command_history(txt)
-            command_index -= 1
-            w.ka_widget.input_widget.setText(command_history[command_index])
+        nonlocal shown_seq, composing
+        if shown_seq is None:
+            # User might be currently composing a command, don't
+            # wanna lose it.
+            composing = w.ka_widget.input_widget.text()
+        cmd = history.search_prefix(composing.strip(), before=shown_seq)
+        if cmd is not None:
+            shown_seq = history.seq(cmd)
+            w.ka_widget.input_widget.setText(cmd)
+    def search_command():
+        # Like previous_command, but for commands that contain what's
+        # being composed anywhere, not just at the start.
+        nonlocal shown_seq, composing
+        if shown_seq is None:
+            composing = w.ka_widget.input_widget.text()
+        cmd = history.search_substring(composing.strip(), before=shown_seq)
+        if cmd is not None:
+            shown_seq = history.seq(cmd)
+            w.ka_widget.input_widget.setText(cmd)
     def next_command():
-        nonlocal command_index, command_history
-        if command_index < len(command_history)-1:
-            command_index += 1
-            w.ka_widget.input_widget.setText(command_history[command_index])
+        nonlocal shown_seq
+        if shown_seq is None:
+            return
+        cmd = history.search_prefix(composing.strip(), after=shown_seq)
+        if cmd is None:
+            shown_seq = None
+            w.ka_widget.input_widget.setText(composing)
+        else:
+            shown_seq = history.seq(cmd)
+            w.ka_widget.input_widget.setText(cmd)
 
     def display_fn(i):
         if i > 0:
             add_display_text(format_function_info(FUNCTION_NAMES[i-1]))
             add_display_text("")
-            update_display()
     def display_unit(i):
         if i > 0:
             add_display_text(format_unit_info(UNITS[i-1]))
             add_display_text("\n")
-            update_display()
     QShortcut(QKeySequence(ka.config.get(ConfigProperties.DEFAULT_SHORTCUT_UP)), w) \
         .activated \
         .connect(previous_command)
     QShortcut(QKeySequence(ka.config.get(ConfigProperties.DEFAULT_SHORTCUT_DOWN)), w) \
         .activated \
         .connect(next_command)
+    QShortcut(QKeySequence(ka.config.get(ConfigProperties.DEFAULT_SHORTCUT_SEARCH)), w) \
+        .activated \
+        .connect(search_command)
     QShortcut(QKeySequence(ka.config.get(ConfigProperties.DEFAULT_SHORTCUT_FUNCTIONS)), w) \
         .activated \
         .connect(w.ka_widget.show_functions)
@@ -333,12 +447,25 @@ def run_gui():
     QShortcut(QKeySequence(ka.config.get(ConfigProperties.DEFAULT_SHORTCUT_PREFIXES)), w) \
         .activated \
         .connect(w.ka_widget.show_prefixes)
+    cancel_shortcuts = [
+        QShortcut(QKeySequence(ka.config.get(ConfigProperties.DEFAULT_SHORTCUT_CANCEL)), w),
+        QShortcut(QKeySequence("Ctrl+C"), w)
+    ]
+    for shortcut in cancel_shortcuts:
+        # Only enabled while a command is running, so that they
+        # don't get in the way of copying text.
+        shortcut.setEnabled(False)
+        shortcut.activated.connect(cancel)
     w.ka_widget.key_pressed.connect(on_key)
+    w.ka_widget.eval_finished.connect(on_eval_finished)
     w.ka_widget.display_fn_signal.connect(display_fn)
     w.ka_widget.display_unit_signal.connect(display_unit)
     w.show()
     code = app.exec()
-    save_history(new_command_history)
+    cancel()
+    eval_thread.quit()
+    eval_thread.wait()
+    history.save()
     sys.exit(code)
 
 if __name__ == "__main__":
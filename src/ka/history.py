@@ -0,0 +1,202 @@
+"""
+Command history, shared by the interpreter and the GUI.
+
+The history file is a log with one command per line, and new commands
+are appended to it at the end of a session. Only the tail of the file
+is read, enough to get the most recent `history-size` distinct
+commands, so start-up doesn't get slower as the file grows. Once the
+file is a lot bigger than that, it's compacted: rewritten with just the
+entries we'd load anyway.
+"""
+
+import bisect
+import os
+import os.path
+import sys
+import tempfile
+
+import ka.config
+from .config import ConfigProperties
+
+READ_BLOCK_SIZE = 1 << 16
+# How big the file can get, as a multiple of the size of the entries
+# we keep, before it gets compacted.
+COMPACTION_FACTOR = 2
+
+class HistoryStore:
+    def __init__(self, path, max_entries, enabled=True):
+        self.path = path
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self.loaded = False
+        # Command -> sequence number. Newer commands have bigger numbers,
+        # and a repeated command takes the number of its latest use.
+        # The dict is kept in order of sequence number.
+        self.seqs = {}
+        self.next_seq = 0
+        # All the commands, sorted alphabetically, for prefix search.
+        self.sorted = []
+        self.pending = []
+        self.needs_compaction = False
+
+    def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        if not self.enabled:
+            return
+        # Loading is non-essential, so don't let a bug here stop the app
+        # from running.
+        try:
+            lines, file_size = read_tail_lines(self.path, self.max_entries)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            print("Failed to load history because: " + str(e), file=sys.stderr)
+            return
+        for line in lines:
+            self.record(line)
+        kept_size = sum(len(cmd.encode("utf-8"))+1 for cmd in self.seqs)
+        self.needs_compaction = file_size > COMPACTION_FACTOR*kept_size
+
+    def record(self, cmd):
+        cmd = cmd.strip()
+        if not cmd:
+            return False
+        if cmd in self.seqs:
+            del self.seqs[cmd]
+            del self.sorted[bisect.bisect_left(self.sorted, cmd)]
+        bisect.insort(self.sorted, cmd)
+        self.seqs[cmd] = self.next_seq
+        self.next_seq += 1
+        if len(self.seqs) > self.max_entries:
+            oldest = next(iter(self.seqs))
+            del self.seqs[oldest]
+            del self.sorted[bisect.bisect_left(self.sorted, oldest)]
+        return True
+
+    def add(self, cmd):
+        self.load()
+        if self.record(cmd):
+            self.pending.append(cmd.strip())
+
+    def entries(self):
+        """All the commands, oldest first."""
+        self.load()
+        return list(self.seqs)
+
+    def seq(self, cmd):
+        return self.seqs.get(cmd)
+
+    def __len__(self):
+        self.load()
+        return len(self.seqs)
+
+    def search_prefix(self, prefix, before=None, after=None):
+        """Returns the most recent command that starts with `prefix`
+        and has a sequence number less than `before`, or the oldest
+        one with a sequence number greater than `after`. Returns None
+        if there's no such command."""
+        self.load()
+        i = bisect.bisect_left(self.sorted, prefix)
+        best = None
+        while i < len(self.sorted) and self.sorted[i].startswith(prefix):
+            cmd = self.sorted[i]
+            seq = self.seqs[cmd]
+            if after is not None:
+                if seq > after and (best is None or seq < self.seqs[best]):
+                    best = cmd
+            elif before is None or seq < before:
+                if best is None or seq > self.seqs[best]:
+                    best = cmd
+            i += 1
+        return best
+
+    def search_substring(self, s, before=None):
+        """Most recent command containing `s` with a sequence number less
+        than `before`, or None."""
+        self.load()
+        for cmd in reversed(self.seqs):
+            if (before is None or self.seqs[cmd] < before) and s in cmd:
+                return cmd
+        return None
+
+    def save(self):
+        if not self.enabled or not self.pending:
+            return
+        try:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            if self.needs_compaction:
+                self.compact()
+            else:
+                text = "".join(cmd + "\n" for cmd in self.pending)
+                with open(self.path, "a+b") as f:
+                    # Older versions didn't end the file with a newline.
+                    if f.tell() > 0:
+                        f.seek(-1, os.SEEK_END)
+                        if f.read(1) != b"\n":
+                            text = "\n" + text
+                    f.write(text.encode("utf-8"))
+            self.pending = []
+        except Exception as e:
+            print("Failed to save history because: " + str(e), file=sys.stderr)
+
+    def compact(self):
+        # Another session might have added to the file since we
+        # loaded it, so start from what's there now.
+        fresh = HistoryStore(self.path, self.max_entries)
+        fresh.load()
+        for cmd in self.pending:
+            fresh.record(cmd)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".history-")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write("".join(cmd + "\n" for cmd in fresh.entries()))
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.needs_compaction = False
+
+def read_tail_lines(path, max_distinct):
+    """Reads non-empty lines from the end of the file until it has found
+    `max_distinct` different ones (or reached the start of the file).
+    Returns the lines in file order, and the size of the file."""
+    lines = []
+    distinct = set()
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        file_size = f.tell()
+        pos = file_size
+        leftover = b""
+        while pos > 0 and len(distinct) < max_distinct:
+            size = min(READ_BLOCK_SIZE, pos)
+            pos -= size
+            f.seek(pos)
+            block = f.read(size) + leftover
+            parts = block.split(b"\n")
+            # The first part might be the end of a line that started in
+            # an earlier block.
+            leftover = parts[0]
+            for part in reversed(parts[1:]):
+                add_line(part, lines, distinct)
+                if len(distinct) >= max_distinct:
+                    break
+        if pos == 0 and len(distinct) < max_distinct:
+            add_line(leftover, lines, distinct)
+    lines.reverse()
+    return lines, file_size
+
+def add_line(raw, lines, distinct):
+    line = raw.decode("utf-8", errors="replace").strip()
+    if line:
+        lines.append(line)
+        distinct.add(line)
+
+def open_history():
+    """The history store described by the config."""
+    return HistoryStore(ka.config.get(ConfigProperties.HISTORY_PATH),
+                        ka.config.get(ConfigProperties.HISTORY_SIZE),
+                        enabled=ka.config.get(ConfigProperties.SAVE_HISTORY))
@@ -0,0 +1,172 @@
+"""
+Picks the overloads of function calls before they're evaluated, where
+the types of the arguments can be worked out in advance.
+
+Which overload `dispatch` calls depends only on the types of the
+arguments, but finding it means checking the argument types against
+every overload of the function. For a call like `sin(2)`, `x^2` where
+x was assigned a fraction, or `C(n, k)` in the body of a comprehension
+over arrays of integers, the types are known before the call happens,
+so the overload can be picked once, when the parse tree is analysed,
+and stored in the node (as a Binding).
+
+The analysis is a guess, not a guarantee: a variable might be assigned
+something else halfway through a command, and `sqrt(x)` is an int when
+x is a square. So when a bound call is evaluated, the types of
+the arguments are compared with the ones the overload was picked for,
+and if they're different (or functions have been defined since), the
+call goes through `dispatch` as usual.
+"""
+
+from fractions import Fraction
+
+from . import functions
+from .functions import resolve_header_for_types
+from .types import Quantity, Array
+from .eval import EvalModes, assigned_variables
+
+class Binding:
+    def __init__(self, types, header):
+        self.types = types
+        self.header = header
+        self.version = functions.REGISTRY_VERSION
+
+    def matches(self, args):
+        return (self.version == functions.REGISTRY_VERSION
+                and tuple(map(type, args)) == self.types)
+
+class Scope:
+    """Types of variables. A type of None means unknown. Variables that
+    haven't been given a type have the type of their current value in
+    `env`, if there is one."""
+    def __init__(self, env=None, types=None):
+        self.env = env
+        self.types = types if types is not None else {}
+
+    def get(self, name):
+        if name in self.types:
+            return self.types[name]
+        if self.env is None:
+            return None
+        return env_variable_type(self.env, name)
+
+    def set(self, name, t):
+        self.types[name] = t
+
+def env_variable_type(env, name):
+    variables = getattr(env, "_variables", None)
+    if variables is None or name not in variables:
+        return None
+    return type(variables[name])
+
+def bind_calls(node, env):
+    """Analyses a parse tree that's about to be evaluated in `env`."""
+    infer(node, Scope(env=env))
+
+def bind_loop(node, loop_types, env):
+    """Analyses the body and conditions of a comprehension, given the
+    types of its loop variables (None if they're not all the same)."""
+    scope = Scope(env=env, types=dict(loop_types))
+    # Could be different on the next iteration.
+    for name in assigned_variables(node):
+        scope.set(name, None)
+    for i, child in enumerate(node.children):
+        if i == 0 or i > node.meta["num_assignments"]:
+            infer(child, scope)
+
+def infer(node, scope):
+    """Binds the calls in `node` and returns its type, or None if it
+    can't be guessed."""
+    mode = node.eval_mode
+    if mode == EvalModes.LEAF:
+        return type(node.value)
+    if mode == EvalModes.VARIABLE:
+        return scope.get(node.value)
+    if mode == EvalModes.FUNCALL:
+        types = tuple(infer(child, scope) for child in node.children)
+        if (None in types
+                or any(child.eval_mode == EvalModes.KEYWORD_ARG
+                       for child in node.children)):
+            node.binding = None
+            return None
+        header = resolve_header_for_types(node.value, types)
+        node.binding = None if header is None else Binding(types, header)
+        return result_type(node.value, types)
+    if mode == EvalModes.ASSIGNMENT:
+        t = infer(node.children[0], scope)
+        scope.set(node.value, t)
+        return t
+    if mode == EvalModes.STATEMENTS:
+        t = None
+        for child in node.children:
+            t = infer(child, scope)
+        return t
+    if mode == EvalModes.QUANTITY:
+        infer(node.children[0], scope)
+        return Quantity
+    if mode == EvalModes.ARRAY:
+        for child in node.children:
+            infer(child, scope)
+        return Array
+    if mode == EvalModes.ARRAY_WITH_CONDITION:
+        # The arrays are evaluated before the loop. The rest is analysed
+        # when the loop starts, and the types of the elements are known.
+        for child in node.children[1:1+node.meta["num_assignments"]]:
+            infer(child, scope)
+        forget_assignments(node, scope)
+        return Array
+    if mode == EvalModes.KEYWORD_ARG:
+        return infer(node.children[0], scope)
+    if mode == EvalModes.CONDITIONAL:
+        types = [infer(child, scope) for child in node.children]
+        forget_assignments(node, scope)
+        if len(types) == 3 and types[1] == types[2]:
+            return types[1]
+        return None
+    if mode == EvalModes.FUNCTION_DEFINITION:
+        # Only its parameters are known when it's called; other
+        # variables could have been assigned anything by then.
+        body_scope = Scope(types={name: None for name in node.meta["params"]})
+        infer(node.children[0], body_scope)
+        return None
+    for child in node.children:
+        infer(child, scope)
+    forget_assignments(node, scope)
+    return None
+
+def forget_assignments(node, scope):
+    # Assignments that might not have happened, or happened any number
+    # of times.
+    for name in assigned_variables(node):
+        scope.set(name, None)
+
+EXACT_TYPES = (int, Fraction)
+# Operators whose result is an int for ints, a fraction for fractions and
+# a float for floats.
+ARITHMETIC = {"+", "-", "*", "%", "^"}
+# Functions of a number that return a float, unless it's a whole number.
+REAL_FUNCTIONS = {"sin", "cos", "tan", "sqrt", "ln", "log10", "log2", "log"}
+INTEGER_FUNCTIONS = {"floor", "ceil", "round", "int"}
+COMPARISONS = {"<", "<=", ">", ">=", "==", "!="}
+
+def result_type(name, types):
+    """A guess at the type of the result of a call, which is right
+    often enough to be worth binding the calls that use it."""
+    if not all(t in EXACT_TYPES or t is float for t in types):
+        return None
+    if name in ARITHMETIC and len(types) in (1, 2):
+        if all(t is int for t in types):
+            return int
+        if all(t in EXACT_TYPES for t in types):
+            return Fraction
+        return float
+    if name == "/" and len(types) == 2:
+        return Fraction if all(t in EXACT_TYPES for t in types) else float
+    if name in REAL_FUNCTIONS:
+        return float
+    if name in INTEGER_FUNCTIONS:
+        return int
+    # Chained comparisons are called "<_<=" and so on.
+    if all(op in COMPARISONS for op in name.split("_")):
+        return int
+    return None
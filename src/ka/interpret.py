@@ -1,5 +1,6 @@
 import readline
 from fractions import Fraction as frac
+from decimal import Decimal
 import sys
 import os
 import os.path
@@ -9,16 +10,22 @@ from .tokens import (tokenise, UnknownTokenError, BadNumberError,
 from .parse import parse_tokens, ParsingError
 from .eval import eval_parse_tree, EvalError, EvalEnvironment, EvalModes
 from .types import (Quantity, Array, Combinatoric, KaRuntimeError,
-                    Interval, Instant)
+                    Interval, Instant, Set)
 from .functions import (FUNCTIONS, UnknownFunctionError,
     UnknownKeywordError, BadTypeKeywordError,
     NoMatchingFunctionSignatureError, IncompatibleQuantitiesError,
     make_sig_printable, ExitKaSignal, FUNCTION_DOCUMENTATION,
-    FunctionArgError, resolve_combinatoric)
+    FunctionArgError, resolve_combinatoric, PURE_RESULTS,
+    suggest_functions, USER_FUNCTION_DOCSTRING)
 from .plot import Plot
-from .units import UNITS, PREFIXES, lookup_unit
+from .units import UNITS, PREFIXES, lookup_unit, load_currencies
 from .probability import InvalidParameterException
+from .history import open_history
+from .limits import limits_in_effect, limits_from_config, EvalCancelledError
 from .config import ConfigProperties
+from .currency import enable_background_refresh
+from .snapshot import snapshot_path, save, load, restore, SnapshotError
+from . import precision
 import ka.config
 
 INTERPRETER_COMMAND_PREFIX = "%"
@@ -29,17 +36,22 @@ INDENT = 2
 
 DEFAULT_DOCSTRING = "n/a"
 
-def interp_cmd(f, nargs, description):
-    return InterpreterCommand(f, nargs, description)
+def interp_cmd(f, nargs, description, uses_env=False):
+    return InterpreterCommand(f, nargs, description, uses_env)
 
 class InterpreterCommand:
-    def __init__(self, f, nargs, desc):
+    def __init__(self, f, nargs, desc, uses_env=False):
         self.f = f
         self.nargs = nargs
         self.desc = desc
+        # Whether f takes the EvalEnvironment as its first argument.
+        self.uses_env = uses_env
 
-    def execute(self, args):
-        self.f(*args)
+    def execute(self, args, env=None):
+        if self.uses_env:
+            self.f(env, *args)
+        else:
+            self.f(*args)
 
 def interp_quit():
     raise ExitKaSignal()
@@ -55,6 +67,7 @@ def print_units():
                             if "cash" not in unit.quantities])))
 
 def print_cash_units():
+    load_currencies()
     print("\n".join(sorted(["  " + format_unit(unit, with_mul=True)
                             for unit in UNITS
                             if "cash" in unit.quantities])))
@@ -90,23 +103,34 @@ def format_unit_info(unit):
         f"Offset: {unit.offset}",
     ])
 
-def print_functions():
-    print(get_functions_string())
+def print_functions(env=None):
+    print(get_functions_string(env))
 
-def get_functions_string():
-    return ", ".join(name for name in FUNCTIONS.keys())
+def get_functions_string(env=None):
+    names = list(FUNCTIONS.keys())
+    if env is not None:
+        names.extend(env.functions.keys())
+    return ", ".join(names)
 
-def print_function_info(name):
-    if name not in FUNCTIONS:
+def print_function_info(name, env=None):
+    if name not in FUNCTIONS and (env is None or name not in env.functions):
         print("Unknown function.")
     else:
-        print(format_function_info(name))
+        print(format_function_info(name, env))
+
+def interp_function_info(env, name):
+    print_function_info(name, env)
 
-def format_function_info(name):
-    des = (FUNCTION_DOCUMENTATION[name]
-           if name in FUNCTION_DOCUMENTATION
-           else DEFAULT_DOCSTRING)
-    sigs = list(map(lambda h: h.sig, FUNCTIONS[name]))
+def format_function_info(name, env=None):
+    if name in FUNCTIONS:
+        headers = FUNCTIONS[name]
+        des = (FUNCTION_DOCUMENTATION[name]
+               if name in FUNCTION_DOCUMENTATION
+               else DEFAULT_DOCSTRING)
+    else:
+        headers = env.functions[name]
+        des = USER_FUNCTION_DOCSTRING
+    sigs = list(map(lambda h: h.sig, headers))
     return "\n".join([
         f"Name: {name}",
         f"Description: {des}",
@@ -115,83 +139,110 @@ def format_function_info(name):
                   for sig in sigs)
     ])
 
+def set_precision(n):
+    try:
+        n = int(n)
+    except ValueError:
+        n = -1
+    if n < 0:
+        print("Precision should be a number of digits, or 0 to turn off precision mode.")
+        return
+    ka.config.CONFIG[ConfigProperties.DECIMAL_PRECISION.name] = n
+
+def interp_recompute(env):
+    if recompute(env, limits=limits_from_config()) == 0:
+        print("Nothing to recompute.")
+
+def interp_save(env, name):
+    path = snapshot_path(name)
+    try:
+        unsaved = save(env, path)
+    except OSError as e:
+        print(f"Couldn't save to {path}: {e.strerror}")
+        return
+    if unsaved:
+        print("Couldn't save these variables, because of their type:",
+              ", ".join(unsaved))
+
+def interp_load(env, name):
+    path = snapshot_path(name)
+    try:
+        variables = load(path)
+    except SnapshotError as e:
+        print(e.msg)
+        return
+    except OSError as e:
+        print(f"Couldn't load {path}: {e.strerror}")
+        return
+    restore(env, variables, f"{INTERPRETER_COMMAND_PREFIX}load {name}")
+    print(f"Loaded {len(variables)} variable{'' if len(variables) == 1 else 's'}.")
+
+def print_cache_stats():
+    print(format_cache_stats(PURE_RESULTS))
+
+def format_cache_stats(cache):
+    calls = cache.hits + cache.misses
+    hit_rate = f"{100*cache.hits/calls:.1f}%" if calls else "n/a"
+    return "\n".join([
+        f"Cached results: {len(cache)} (max {cache.size})",
+        f"Hits: {cache.hits}",
+        f"Misses: {cache.misses}",
+        f"Hit rate: {hit_rate}",
+    ])
+
 INTERPRETER_COMMANDS = [
     (("q", "quit"), interp_cmd(interp_quit, 0, "exit the interpreter")),
     (("h", "help"), interp_cmd(interp_help, 0, "display help")),
     (("u", "unit"), interp_cmd(print_unit_info, 1, "describe given unit")),
     (("us", "units"), interp_cmd(print_units, 0, "list all units (except currencies)")),
     (("cs", "currencies"), interp_cmd(print_cash_units, 0, "list all currency units")),
-    (("f", "function"), interp_cmd(print_function_info, 1, "describe given function")),
-    (("fs", "functions"), interp_cmd(print_functions, 0, "list all functions")),
+    (("f", "function"), interp_cmd(interp_function_info, 1, "describe given function", uses_env=True)),
+    (("fs", "functions"), interp_cmd(print_functions, 0, "list all functions", uses_env=True)),
+    (("p", "precision"), interp_cmd(set_precision, 1, "compute to given number of digits (0 for floats)")),
+    (("r", "recompute"), interp_cmd(interp_recompute, 0, "re-run commands that use variables that have since been reassigned", uses_env=True)),
+    (("s", "save"), interp_cmd(interp_save, 1, "save the variables to a snapshot with the given name", uses_env=True)),
+    (("l", "load"), interp_cmd(interp_load, 1, "load the variables from a snapshot", uses_env=True)),
+    (("c", "cache"), interp_cmd(print_cache_stats, 0, "show how often cached function results were reused")),
 ]
 
 def run_interpreter():
+    enable_background_refresh()
     env = EvalEnvironment()
     print("ka version", KA_VERSION)
     prompt = ka.config.get(ConfigProperties.PROMPT) + " "
-    readline_load_history()
-    history = []
+    history = open_history()
+    readline_load_history(history)
     while True:
         try:
             s = input(prompt).strip()
         except KeyboardInterrupt:
             print()
-            save_history(history)
+            history.save()
             break
-        if len(s) > 0:
-            history.append(s)
+        history.add(s)
         try:
             if s.startswith(INTERPRETER_COMMAND_PREFIX):
-                execute_interpreter_command(s)
+                execute_interpreter_command(s, env)
             else:
                 execute(s, env, reraise_signals=True)
         except ExitKaSignal:
-            save_history(history)
+            history.save()
             break
         except KeyboardInterrupt:
             print()
             pass
 
-def readline_load_history():
-    for line in load_history():
-        readline.add_history(line.strip())
-
-def load_history():
-    path = ka.config.get(ConfigProperties.HISTORY_PATH)
-    # Wrap everything in try-except because this is non-essential, don't
-    # want to crash the whole app and prevent it from running because of
-    # a bug here.
-    if history_enabled():
-        try:
-            if os.path.exists(path):
-                with open(path, "r") as f:
-                    return [line.strip() for line in f.readlines()
-                            if len(line.strip())>0]
-        except Exception as e:
-            print("Failed to load history because: " + str(e), out=sys.stderr)
-    return []
-
-def history_enabled():
-    return ka.config.get(ConfigProperties.SAVE_HISTORY)
-
-def save_history(history):
-    try:
-        path = ka.config.get(ConfigProperties.HISTORY_PATH)
-        if history_enabled():
-            if os.path.exists(path):
-                with open(path, "a") as f:
-                    f.write("\n")
-                    f.write("\n".join(history))
-            else:
-                base, filename = os.path.split(path)
-                if not os.path.exists(base):
-                    os.makedirs(base)
-                with open(path, "w") as f:
-                    f.write("\n".join(history))
-    except Exception as e:
-        print("Failed to save history because: " +  str(e), out=sys.stderr)
-
-def execute_interpreter_command(s):
+def readline_load_history(history):
+    for line in history.entries():
+        readline.add_history(line)
+    # Up/down search the history for commands starting with whatever's
+    # been typed so far, and Ctrl+R does a substring search. libedit
+    # (macOS) has a different syntax for this, so leave it alone.
+    if "libedit" not in (readline.__doc__ or ""):
+        readline.parse_and_bind(r'"\e[A": history-search-backward')
+        readline.parse_and_bind(r'"\e[B": history-search-forward')
+
+def execute_interpreter_command(s, env=None):
     args = s[len(INTERPRETER_COMMAND_PREFIX):].split()
     cmd_name = args[0]
     args = args[1:]
@@ -200,7 +251,7 @@ def execute_interpreter_command(s):
             if cmd.nargs != len(args):
                 print(f"Expected {cmd.nargs} arguments for command {names}, got {len(args)}.")
             else:
-                cmd.execute(args)
+                cmd.execute(args, env)
             return
     print("Unknown interpreter command. You may have meant one of the following...")
     interp_help()
@@ -222,25 +273,55 @@ def execute(s, env=None, out=sys.stdout,
             brackets_for_frac=False,
             assigned_box=None,
             post_display_action_box=None,
-            unit_format_fn=default_unit_format):
+            unit_format_fn=default_unit_format,
+            # EvalLimits, if the evaluation should be cancellable.
+            limits=None):
     if env is None:
         env = EvalEnvironment()
+    if limits is None:
+        limits = limits_from_config()
+    parse_tree = compile_source(s, errout)
+    if parse_tree is None:
+        return 1
+    statements = parse_tree.children
+    if len(statements)>0:
+        last_one = statements[-1]
+        if last_one.eval_mode == EvalModes.ASSIGNMENT and assigned_box is not None:
+            assigned_box.value = last_one.value
+    status = execute_parse_tree(parse_tree, env, s, out=out, errout=errout,
+                                reraise_signals=reraise_signals,
+                                result_box=result_box,
+                                brackets_for_frac=brackets_for_frac,
+                                post_display_action_box=post_display_action_box,
+                                unit_format_fn=unit_format_fn,
+                                limits=limits)
+    if (ka.config.get(ConfigProperties.AUTO_RECOMPUTE)
+            and env.dependencies is not None):
+        recompute(env, out=out, errout=errout,
+                  brackets_for_frac=brackets_for_frac,
+                  unit_format_fn=unit_format_fn,
+                  limits=limits)
+    return status
+
+def compile_source(s, errout=sys.stderr):
+    """Tokenises and parses a command. Returns the parse tree, or None
+    if there was an error, after displaying it."""
     try:
         tokens = tokenise(s)
     except UnknownTokenError as e:
         error("Unknown token!", e.index, s, errout)
-        return 1
+        return None
     except BadNumberError as e:
         error("Bad number! (Probably mixing number bases).", e.index, s, errout)
-        return 1
+        return None
     except UnclosedStringError as e:
         error("String is missing closing delimiter.", e.index, s, errout)
-        return 1
+        return None
     except UnclosedInstantError as e:
         error("Instant/date is missing closing delimiter.", e.index, s, errout)
-        return 1
+        return None
     try:
-        parse_tree = parse_tokens(tokens)
+        return parse_tokens(tokens)
     except ParsingError as e:
         # 3 cases:
         #  a) there are no tokens, it's the empty string.
@@ -253,18 +334,34 @@ def execute(s, env=None, out=sys.stdout,
         else:
             index = tokens[e.token_index].begin_index_incl
         error(e.message, index, s, errout)
-        return 1
+        return None
     except KaRuntimeError as e:
         print_err(errout, e.msg)
-        return 1
-    statements = parse_tree.children
-    if len(statements)>0:
-        last_one = statements[-1]
-        if last_one.eval_mode == EvalModes.ASSIGNMENT and assigned_box is not None:
-            assigned_box.value = last_one.value
+        return None
+
+def execute_parse_tree(parse_tree, env, source, out=sys.stdout,
+                       errout=sys.stderr, reraise_signals=False,
+                       result_box=None, brackets_for_frac=False,
+                       post_display_action_box=None,
+                       unit_format_fn=default_unit_format,
+                       limits=None,
+                       # The Command, if this is re-running one.
+                       command=None):
+    """Evaluates a parsed command and displays its result, or the error.
+    Returns a status code, like `execute`."""
     try:
-        result = eval_parse_tree(parse_tree, env)
-        reduced = reduce_result(result)
+        with limits_in_effect(limits), env.recording() as access:
+            try:
+                result = eval_parse_tree(parse_tree, env)
+                reduced = reduce_result(result)
+            finally:
+                # Even if it failed, it might have assigned variables.
+                if env.dependencies is None:
+                    pass
+                elif command is not None:
+                    env.dependencies.update(command, access)
+                elif access.reads or access.writes:
+                    env.dependencies.add(source, parse_tree, access)
         if reduced is None:
             print(file=out)
         else:
@@ -290,6 +387,9 @@ def execute(s, env=None, out=sys.stdout,
             raise e
         print(file=out)
         return 0
+    except EvalCancelledError:
+        print_err(errout, "Cancelled.")
+        return 1
     except EvalError as e:
         print_err(errout, e.message)
         return 1
@@ -298,8 +398,7 @@ def execute(s, env=None, out=sys.stdout,
         return 1
     except UnknownFunctionError as e:
         print_err(errout, f"Unknown function: '{e.name}'")
-        global FUNCTIONS
-        alternatives = find_close_matches(e.name, FUNCTIONS.keys())
+        alternatives = suggest_functions(e.name)
         if alternatives:
             print_err(errout, "  You may have meant:", ", ".join(alternatives))
         return 1
@@ -334,6 +433,24 @@ def execute(s, env=None, out=sys.stdout,
         print_err(errout, e.msg)
         return 1
 
+def recompute(env, out=sys.stdout, errout=sys.stderr,
+              brackets_for_frac=False,
+              unit_format_fn=default_unit_format,
+              limits=None):
+    """Re-runs the commands that depend on variables which have been
+    assigned since they ran, showing each one and its new result.
+    Returns the number of commands that were re-run."""
+    stale = env.dependencies.stale()
+    for command in stale:
+        print("  " + command.source, file=out)
+        execute_parse_tree(command.tree, env, command.source,
+                           out=out, errout=errout,
+                           brackets_for_frac=brackets_for_frac,
+                           unit_format_fn=unit_format_fn,
+                           limits=limits,
+                           command=command)
+    return len(stale)
+
 def reduce_result(r):
     if isinstance(r, Plot):
         return None
@@ -351,22 +468,6 @@ def execute_plot(plot, errout):
 def print_err(errout, *msgs):
     print(*msgs, file=errout)
 
-def find_close_matches(s, ss):
-    return set(ss) & adjacent_strings([s])
-
-def adjacent_strings(xs):
-    alphabet = "abcdefghijklmnopqrstuvwxyz"
-    final = set()
-    for x in xs:
-        final |= set([x[:i] + x[i+1:] for i in range(len(x))])
-        final |= set([x[:i] + c + x[i:]
-                     for c in alphabet
-                     for i in range(len(x)+1)])
-        final |= set([x[:i] + c + x[i+1:]
-                      for c in alphabet
-                      for i in range(len(x))])
-    return final
-
 def printable_signature(sig):
     return "(" + ", ".join(sig) + ")"
 
@@ -399,18 +500,20 @@ def display_result(r, out, brackets_for_frac=False, newline=True, unit_format_fn
             print(unit_format_fn(r.qv), end="", file=out)
         if isinstance(r.mag, frac):
             print("    ("
-                    + str(precisionify_float(float(r.mag))) + " "
+                    + approximate_frac(r.mag) + " "
                     + unit_format_fn(r.qv) + ")",
                   end="",
                   file=out)
         print(file=out, **newline_args)
     elif isinstance(r, frac):
         print(prettify_frac(r),
-              "    (" + str(precisionify_float(float(r))) + ")",
+              "    (" + approximate_frac(r) + ")",
               file=out,
               **newline_args)
     elif isinstance(r, float):
         print(precisionify_float(r), file=out, **newline_args)
+    elif isinstance(r, Decimal):
+        print(precision.format_decimal(r), file=out, **newline_args)
     elif isinstance(r, Array):
         print("{", file=out, end="")
         for i, e in enumerate(r.contents):
@@ -418,6 +521,8 @@ def display_result(r, out, brackets_for_frac=False, newline=True, unit_format_fn
             if i < len(r)-1:
                 print(", ", file=out, end="")
         print("}", file=out, **newline_args)
+    elif isinstance(r, Set):
+        print(stringify_result(r), file=out, **newline_args)
     else:
         print(r, file=out, **newline_args)
 
@@ -434,6 +539,8 @@ def stringify_result(r, brackets_for_frac=False):
         return s
     elif isinstance(r, float):
         return precisionify_float(r)
+    elif isinstance(r, Decimal):
+        return precision.format_decimal(r)
     elif isinstance(r, Array):
         return ("{"
                 + ", ".join(stringify_result(x,
@@ -446,12 +553,23 @@ def stringify_result(r, brackets_for_frac=False):
         return "[" + stringify_result(r.a) + ", " + stringify_result(r.b) + "]"
     elif isinstance(r, Instant):
         return "#" + str(r) + "#"
+    elif isinstance(r, Set):
+        return ("set({"
+                + ", ".join(stringify_result(x,
+                                             brackets_for_frac=brackets_for_frac)
+                            for x in r)
+                + "})")
     return str(r)
 
 def precisionify_float(f):
     fstring = "{:." + str(ka.config.get(ConfigProperties.PRECISION)) + "g}"
     return fstring.format(f)
 
+def approximate_frac(f):
+    if precision.is_enabled():
+        return precision.format_number(f)
+    return precisionify_float(float(f))
+
 def prettify_frac(f, brackets=False):
     sign = 1 if f >= 0 else -1
     whole_part = abs(f.numerator) // abs(f.denominator)
@@ -0,0 +1,126 @@
+"""
+Cooperative limits on evaluation. Evaluation can't be interrupted from
+another thread, so instead the evaluator calls `check()` at the points
+where it can spend a long time (every node of the parse tree, and the
+loops that build big results), and that raises an exception if the
+evaluation should stop: because it was cancelled, because it has taken
+too many steps, or because it has run past its deadline.
+
+There are also limits on memory. Before building a big integer or
+array, the evaluator estimates its size and calls `check_int_bits()` or
+`allocate()`, so that something like 2^10^9 fails straight away rather
+than after eating all the memory.
+"""
+
+import contextlib
+import threading
+import time
+
+import ka.config
+from .config import ConfigProperties
+
+# Looking at the clock on every step would be wasteful.
+STEPS_BETWEEN_CLOCK_CHECKS = 1000
+
+class EvalCancelledError(Exception):
+    pass
+
+class EvalLimits:
+    def __init__(self, max_steps=0, timeout=0, max_int_bits=0, max_elements=0):
+        """A limit of 0 means there's no limit. The timeout is in seconds,
+        and max_elements is the total number of array elements that
+        can be created during an evaluation."""
+        self.cancelled = threading.Event()
+        self.max_steps = max_steps
+        self.timeout = timeout
+        self.max_int_bits = max_int_bits
+        self.max_elements = max_elements
+        self.elements = 0
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.steps = 0
+        self.next_clock_check = STEPS_BETWEEN_CLOCK_CHECKS
+
+    @staticmethod
+    def from_config():
+        return EvalLimits(
+            max_steps=ka.config.get(ConfigProperties.MAX_STEPS),
+            timeout=ka.config.get(ConfigProperties.TIMEOUT),
+            max_int_bits=ka.config.get(ConfigProperties.MAX_INT_BITS),
+            max_elements=ka.config.get(ConfigProperties.MAX_ELEMENTS))
+
+    def is_limited(self):
+        return bool(self.max_steps or self.timeout
+                    or self.max_int_bits or self.max_elements)
+
+    def cancel(self):
+        """Can be called from any thread."""
+        self.cancelled.set()
+
+    def check(self, steps=1):
+        self.steps += steps
+        if self.max_steps and self.steps > self.max_steps:
+            raise_runtime_error(
+                f"Evaluation took more than the maximum of {self.max_steps} steps.")
+        if self.steps >= self.next_clock_check:
+            self.next_clock_check = self.steps + STEPS_BETWEEN_CLOCK_CHECKS
+            if self.deadline is not None and time.monotonic() > self.deadline:
+                raise_runtime_error(
+                    f"Evaluation took longer than the time limit of {self.timeout} seconds.")
+        if self.cancelled.is_set():
+            raise EvalCancelledError()
+
+    def allocate(self, elements):
+        self.elements += elements
+        if self.max_elements and self.elements > self.max_elements:
+            raise_runtime_error(
+                f"Evaluation tried to create more than the maximum of {self.max_elements} array elements.")
+
+    def check_int_bits(self, bits):
+        if self.max_int_bits and bits > self.max_int_bits:
+            raise_runtime_error(
+                f"Result would be a number with about {int(bits)} bits, more than the maximum of {self.max_int_bits}.")
+
+def raise_runtime_error(msg):
+    # Imported here because ka.types depends on this module.
+    from .types import KaRuntimeError
+    raise KaRuntimeError(msg)
+
+# Limits apply to the thread that's doing the evaluation.
+_state = threading.local()
+
+def check(steps=1):
+    """Charges `steps` against the limits of the current thread, if
+    it has any."""
+    limits = getattr(_state, "limits", None)
+    if limits is not None:
+        limits.check(steps)
+
+def allocate(elements):
+    """Call before creating `elements` array elements."""
+    limits = getattr(_state, "limits", None)
+    if limits is not None:
+        limits.allocate(elements)
+
+def check_int_bits(bits):
+    """Call before computing an integer (or the numerator/denominator
+    of a fraction) with roughly this many bits."""
+    limits = getattr(_state, "limits", None)
+    if limits is not None:
+        limits.check_int_bits(bits)
+
+def limits_from_config():
+    """Returns None if the config doesn't set any limits."""
+    limits = EvalLimits.from_config()
+    return limits if limits.is_limited() else None
+
+def current_limits():
+    return getattr(_state, "limits", None)
+
+@contextlib.contextmanager
+def limits_in_effect(limits):
+    previous = getattr(_state, "limits", None)
+    _state.limits = limits
+    try:
+        yield limits
+    finally:
+        _state.limits = previous
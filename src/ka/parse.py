@@ -16,6 +16,19 @@ class ParseNode:
         self.eval_mode = eval_mode
         self.meta = meta if meta else dict()
         self.eval_children = eval_children
+        # Set by ka.infer: for a function call, the overload to call if
+        # the arguments have the expected types; for a comprehension,
+        # the types of the loop variables when its body was analysed.
+        self.binding = None
+        self.loop_types = None
+
+    def __getstate__(self):
+        # The bindings refer to functions, which can't be pickled, and
+        # are only valid while the same functions are registered.
+        state = self.__dict__.copy()
+        state["binding"] = None
+        state["loop_types"] = None
+        return state
 
     def __repr__(self):
         return str(self)
@@ -32,6 +45,17 @@ def funcall_node(name, children):
                      children=children,
                      eval_mode=EvalModes.FUNCALL)
 
+# Only one of its branches is evaluated, so it can't be evaluated like
+# other function calls.
+CONDITIONAL_FUNCTION = "if"
+
+def conditional_node(name, children):
+    return ParseNode(label=name,
+                     value=name,
+                     children=children,
+                     eval_mode=EvalModes.CONDITIONAL,
+                     eval_children=False)
+
 def quantity_node(term, unit_sig):
     return ParseNode(label=str(unit_sig),
                      children=[term],
@@ -120,6 +144,12 @@ class BagOfTokens:
     def check_type(self, i, t):
         return self.ptr+i < len(self.tokens) and t == self.tokens[self.ptr+i].tag
 
+    def peek(self, i=0):
+        """Tag of the token `i` places ahead, or None if there isn't one."""
+        if self.ptr+i < len(self.tokens):
+            return self.tokens[self.ptr+i].tag
+        return None
+
     def read(self, tag):
         token = self._read_single_token(f"Expected '{tag}' but reached end.")
         if token.tag != tag:
@@ -154,8 +184,44 @@ def parse_statements(t):
 def parse_statement(t):
     if t.next_are(Tokens.VAR, Tokens.ASSIGNMENT_OP):
         return parse_assignment(t)
+    if t.next_are(Tokens.VAR, Tokens.LBRACKET) and is_function_definition(t):
+        return parse_function_definition(t)
     return parse_expression(t)
 
+def is_function_definition(t):
+    # Whether it's `f(...) = ...`, rather than a call like `f(x) == 1`.
+    depth = 0
+    i = 1
+    while t.peek(i) is not None:
+        if t.peek(i) == Tokens.LBRACKET:
+            depth += 1
+        elif t.peek(i) == Tokens.RBRACKET:
+            depth -= 1
+            if depth == 0:
+                return t.peek(i+1) == Tokens.ASSIGNMENT_OP
+        i += 1
+    return False
+
+def parse_function_definition(t):
+    name = t.read(Tokens.VAR).meta('name')
+    t.read(Tokens.LBRACKET)
+    params = []
+    while not t.next_is(Tokens.RBRACKET):
+        if params:
+            t.read(Tokens.FUNCTION_ARG_SEPARATOR)
+        param = t.read(Tokens.VAR).meta('name')
+        if param in params:
+            raise ParsingError(f"Parameter '{param}' appears more than once.", t.ptr-1)
+        params.append(param)
+    t.read(Tokens.RBRACKET)
+    t.read(Tokens.ASSIGNMENT_OP)
+    return ParseNode(label=name,
+                     value=name,
+                     children=[parse_expression(t)],
+                     eval_mode=EvalModes.FUNCTION_DEFINITION,
+                     meta=dict(params=params),
+                     eval_children=False)
+
 def parse_unit_convert(t, sum_node):
     t.read(Tokens.UNIT_CONVERT)
     unit_signature = parse_unit_signature(t)
@@ -310,13 +376,23 @@ def parse_unsigned_term_without_factorial(t):
         raise ParsingError("Unexpected token.", t.ptr)
 
 def parse_number(t):
-    v = t.read(Tokens.NUM).meta('value')
-    return ParseNode(label=str(v), value=simplify_number(v))
+    token = t.read(Tokens.NUM)
+    v = token.meta('value')
+    value = simplify_number(v)
+    meta = None
+    # Even if it's a whole number, like 1.5e300, which as a float is
+    # only roughly 15*10^299.
+    if isinstance(v, float):
+        meta = dict(literal=token.meta('literal'))
+    return ParseNode(label=str(v), value=value, meta=meta)
 
 def parse_function(t):
     name = t.read(Tokens.VAR).meta('name')
     t.read(Tokens.LBRACKET)
-    node = funcall_node(name, parse_args(t))
+    if name == CONDITIONAL_FUNCTION:
+        node = conditional_node(name, parse_args(t))
+    else:
+        node = funcall_node(name, parse_args(t))
     t.read(Tokens.RBRACKET)
     return node
 
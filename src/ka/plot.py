@@ -2,10 +2,37 @@ from .types import KaRuntimeError, is_true
 from .utils import _g, separate_kwargs
 from numbers import Number
 import itertools
+import threading
 
 plt = None
 ticker = None
 
+# Figure that's reused for rendering to files. Creating a new one every
+# time is slow, if you're generating lots of charts.
+file_figure = None
+file_figure_lock = threading.Lock()
+
+# Whether plots can be shown in a window or saved to a file. The HTTP
+# service turns this off: its workers have no display, and its clients
+# shouldn't be able to write files on the server.
+OUTPUT_ENABLED = True
+
+def disable_output():
+    global OUTPUT_ENABLED
+    OUTPUT_ENABLED = False
+
+def check_output_enabled():
+    if not OUTPUT_ENABLED:
+        # Imported here because ka.eval depends on this module.
+        from .eval import EvalError
+        raise EvalError("Plots can't be shown or saved here.")
+
+def run_on_display_thread(f):
+    """Plot windows have to be opened on the GUI thread. The GUI evaluates
+    commands on another thread, so it replaces this with something that
+    passes `f` over to its own thread."""
+    f()
+
 class Plot:
     pass
 
@@ -31,40 +58,40 @@ class PlotOptions(Plot):
         self.integer_x_ticks = integer_x_ticks
         self.integer_y_ticks = integer_y_ticks
 
-    def pre_plot_do(self):
-        if self.xlo or self.ylo:
-            plt.xlim(left=self.xlo, right=self.xhi)
+    def pre_plot_do(self, ax):
+        if self.xlo or self.xhi:
+            ax.set_xlim(left=self.xlo, right=self.xhi)
         if self.ylo or self.yhi:
-            plt.ylim(bottom=self.ylo, top=self.yhi)
+            ax.set_ylim(bottom=self.ylo, top=self.yhi)
         if self.xlog and is_true(self.xlog):
-            plt.xscale("log")
+            ax.set_xscale("log")
         if self.ylog and is_true(self.ylog):
-            plt.yscale("log")
+            ax.set_yscale("log")
         if self.grid and is_true(self.grid):
-            plt.grid(linestyle="--")
+            ax.grid(linestyle="--")
         if self.title:
-            plt.title(self.title)
+            ax.set_title(self.title)
         if self.xlabel:
-            plt.xlabel(self.xlabel)
+            ax.set_xlabel(self.xlabel)
         if self.ylabel:
-            plt.ylabel(self.ylabel)
+            ax.set_ylabel(self.ylabel)
         if self.xticks:
-            plt.xticks(ticks=self.xticks,
-                       labels=format_tick_labels(self.yticks))
+            ax.set_xticks(self.xticks,
+                          labels=format_tick_labels(self.xticks))
         if self.yticks:
-            plt.yticks(ticks=self.yticks,
-                       labels=format_tick_labels(self.yticks))
+            ax.set_yticks(self.yticks,
+                          labels=format_tick_labels(self.yticks))
         if self.integer_x_ticks and is_true(self.integer_x_ticks):
-            set_integer_ticks(plt.gcf().gca().xaxis)
+            set_integer_ticks(ax.xaxis)
         if self.integer_y_ticks and is_true(self.integer_y_ticks):
-            set_integer_ticks(plt.gcf().gca().yaxis)
+            set_integer_ticks(ax.yaxis)
         # So that gridlines appear behind plot. zorder wasn't working
         # for some reason.
-        plt.gcf().gca().set_axisbelow(True)
+        ax.set_axisbelow(True)
 
-    def post_plot_do(self):
+    def post_plot_do(self, ax):
         if self.legend and is_true(self.legend):
-            plt.legend()
+            ax.legend()
 
 def format_tick_labels(ticks):
     return [(format_float_tick(x) if isinstance(x, float) else x)
@@ -91,19 +118,25 @@ def options(**kwargs):
 
 class PlotDrawing(Plot):
     def __init__(self, func, option_kwargs=None):
+        """`func` draws on the matplotlib Axes that it's passed."""
         self.func = func
         self.options = PlotOptions(**option_kwargs) if option_kwargs else None
 
     def do(self):
-        load_pyplot()
-        if self.options:
-            self.options.pre_plot_do()
-        self.func()
-        if self.options:
-            self.options.post_plot_do()
-        plt.show()
-            
-def plot(*plots):
+        show([self])
+
+def plot(*plots, output=None):
+    """Opens a window with the plots, or, if `output` is given, renders
+    them to that file."""
+    if output is None:
+        run_on_display_thread(lambda: show(plots))
+    else:
+        save_plots(plots, output)
+
+def save(p, path):
+    save_plots([p], path)
+
+def draw(plots, ax):
     options = []
     actual_plots = []
     for p in plots:
@@ -113,32 +146,57 @@ def plot(*plots):
             if p.options:
                 options.append(p.options)
             actual_plots.append(p)
-    load_pyplot()
     for o in options:
-        o.pre_plot_do()
+        o.pre_plot_do(ax)
     for p in actual_plots:
-        p.func()
+        p.func(ax)
     for o in options:
-        o.post_plot_do()
+        o.post_plot_do(ax)
+
+def show(plots):
+    check_output_enabled()
+    load_pyplot()
+    fig = plt.figure()
+    draw(plots, fig.add_subplot())
     plt.show()
 
+def save_plots(plots, path):
+    """Renders with Agg, which doesn't need a display. Doesn't touch
+    pyplot, so the interactive backend (e.g. Qt) isn't loaded."""
+    global file_figure
+    check_output_enabled()
+    load_ticker()
+    with file_figure_lock:
+        if file_figure is None:
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            file_figure = Figure()
+            FigureCanvasAgg(file_figure)
+        else:
+            file_figure.clear()
+        try:
+            draw(plots, file_figure.add_subplot())
+            file_figure.savefig(path)
+        except (OSError, ValueError) as e:
+            raise KaRuntimeError(f"Failed to save plot to '{path}': {e}")
+
 def load_pyplot():
-    global plt, ticker
+    global plt
     if plt is None:
         import matplotlib.pyplot as plt
+    load_ticker()
+
+def load_ticker():
+    global ticker
     if ticker is None:
         import matplotlib.ticker as ticker
 
-def get_plt():
-    global plt
-    return plt
-
 def line(xs, ys, **kwargs):
     check_all_numerical(xs)
     check_all_numerical(ys)
     sel, o = separate_kwargs(kwargs,
         ["label", "colour", "marker", "markercolour"])
-    def do():
+    def do(ax):
         params = dict(
             # This is ugly and error-prone.
             label=_g(sel, "label"),
@@ -146,53 +204,53 @@ def line(xs, ys, **kwargs):
             marker=_g(sel, "marker"),
             markerfacecolor=_g(sel, "markercolour"),
             markeredgecolor=_g(sel, "markercolour"))
-        plt.plot(xs, ys, **only_not_none(params))
+        ax.plot(xs, ys, **only_not_none(params))
     return PlotDrawing(do, o)
 
 def only_not_none(dictionary):
     return dict((k, v) for k, v in dictionary.items()
                        if v is not None)
 
-def check_all_numerical(xs):
+def check_all_numerical(xs, action="plot"):
     if any(not isinstance(x, Number) for x in xs):
-        raise KaRuntimeError("Tried to plot a non-numerical value.")
+        raise KaRuntimeError(f"Tried to {action} a non-numerical value.")
 
 def scatter(xs, ys, **kwargs):
     check_all_numerical(xs)
     check_all_numerical(ys)
     sel, o = separate_kwargs(kwargs,
         ["label", "colour", "marker", "size"])
-    def do():
+    def do(ax):
         params = dict(
             label=_g(sel, "label"),
             c=_g(sel, "colour"),
             marker=_g(sel, "marker"),
             s=_g(sel, "size"))
-        plt.scatter(xs, ys, **only_not_none(params))
+        ax.scatter(xs, ys, **only_not_none(params))
     return PlotDrawing(do, o)
 
 def vline(x, colour=None, weight=None, style=None):
-    def do():
+    def do(ax):
         params = dict(
             color=colour,
             linewidth=weight,
             linestyle=style)
-        plt.axvline(x, **only_not_none(params))
+        ax.axvline(x, **only_not_none(params))
     return PlotDrawing(do)
 
 def hline(y, colour=None, weight=None, style=None):
-    def do():
+    def do(ax):
         params = dict(
             color=colour,
             linewidth=weight,
             linestyle=style)
-        plt.axhline(y, **only_not_none(params))
+        ax.axhline(y, **only_not_none(params))
     return PlotDrawing(do)
     
 def text(x, y, s, colour=None, size=None):
-    def do():
+    def do(ax):
         params = dict(
             color=colour,
             fontsize=size)
-        plt.text(x, y, s, **only_not_none(params))
+        ax.text(x, y, s, **only_not_none(params))
     return PlotDrawing(do)
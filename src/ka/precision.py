@@ -0,0 +1,212 @@
+"""
+Arbitrary-precision mode. When the `decimal-precision` config property
+is set to N > 0 (or after `%precision N` in the interpreter), Ka works
+out Real numbers to N significant digits, using `decimal.Decimal`
+instead of floats. Decimal literals, the constants e and pi, and the
+results of sin, cos, tan, sqrt, ln, log and fractional powers are
+Decimals, and arithmetic on Decimals stays in Decimal. Integers and
+fractions are still exact.
+
+Everything is computed with a few guard digits more than N, so that
+the N digits that get printed are right. Most of the functions are
+built into `decimal`; sin, cos, tan and pi use mpmath if it's
+installed, and otherwise series that converge at a fixed number of
+digits per term, so the time they take grows predictably with N.
+"""
+
+import contextlib
+import decimal
+from decimal import Decimal
+from fractions import Fraction
+
+import ka.config
+from .config import ConfigProperties
+
+GUARD_DIGITS = 10
+# Significant digits of a float that survive a round trip through
+# decimal.
+FLOAT_FORMAT = ".15g"
+
+mpmath = None
+
+def load_mpmath():
+    """Returns the mpmath module, or None if it's not installed."""
+    global mpmath
+    if mpmath is None:
+        try:
+            import mpmath as module
+            mpmath = module
+        except ImportError:
+            mpmath = False
+    return mpmath or None
+
+def digits():
+    """Number of significant digits, or 0 if precision mode is off."""
+    return ka.config.get(ConfigProperties.DECIMAL_PRECISION)
+
+def is_enabled():
+    return digits() > 0
+
+@contextlib.contextmanager
+def precision_in_effect():
+    """Decimal arithmetic in the current thread uses the configured
+    precision until the context exits."""
+    n = digits()
+    if n <= 0:
+        yield
+        return
+    with decimal.localcontext() as ctx:
+        ctx.prec = n + GUARD_DIGITS
+        yield
+
+def working_digits():
+    return decimal.getcontext().prec
+
+def to_decimal(x):
+    if isinstance(x, Decimal):
+        return x
+    if isinstance(x, int):
+        return Decimal(int(x))
+    if isinstance(x, Fraction):
+        return Decimal(x.numerator) / Decimal(x.denominator)
+    if isinstance(x, float):
+        # Only the digits that a float can be trusted to have, rather
+        # than its exact binary value. Unit multiples are often worked
+        # out with floats, e.g. 0.30479999999999996 for feet.
+        return Decimal(format(x, FLOAT_FORMAT))
+    raise TypeError(f"Can't convert {type(x).__name__} to a decimal.")
+
+def from_literal(text):
+    return Decimal(text)
+
+def is_integral(x):
+    """Whether x is a whole number with no digits lost to rounding, so
+    that it can be turned into an int."""
+    return (x.is_finite()
+            and x == x.to_integral_value()
+            and x.adjusted() < working_digits())
+
+CONSTANTS = {}
+
+def constant(name):
+    """e or pi, to the current precision."""
+    key = (name, working_digits())
+    if key not in CONSTANTS:
+        CONSTANTS[key] = +(compute_e() if name == "e" else compute_pi())
+    return CONSTANTS[key]
+
+def compute_e():
+    return Decimal(1).exp()
+
+def compute_pi():
+    mp = load_mpmath()
+    if mp:
+        return from_mpmath(mp, lambda: mp.pi())
+    with decimal.localcontext() as ctx:
+        ctx.prec += 2
+        # From the recipes in the `decimal` documentation. Each term
+        # adds about 0.6 digits.
+        three = Decimal(3)
+        lasts, t, s, n, na, d, da = 0, three, 3, 1, 0, 0, 24
+        while s != lasts:
+            lasts = s
+            n, na = n+na, na+8
+            d, da = d+da, da+32
+            t = (t * n) / d
+            s += t
+    return +s
+
+def from_mpmath(mp, f):
+    with mp.workdps(working_digits() + 2):
+        return +Decimal(mp.nstr(f(), working_digits() + 2, strip_zeros=False))
+
+def sqrt(x):
+    return to_decimal(x).sqrt()
+
+def ln(x):
+    return to_decimal(x).ln()
+
+def log10(x):
+    return to_decimal(x).log10()
+
+def log2(x):
+    return log(x, 2)
+
+def log(x, base):
+    return ln(x) / ln(base)
+
+def power(x, y):
+    x = to_decimal(x)
+    y = to_decimal(y)
+    if x == constant("e"):
+        # More accurate than raising a rounded e to a power.
+        return y.exp()
+    return x ** y
+
+def sin(x):
+    return trig(x, "sin")
+
+def cos(x):
+    return trig(x, "cos")
+
+def tan(x):
+    x = to_decimal(x)
+    with decimal.localcontext() as ctx:
+        ctx.prec += 2
+        result = sin(x) / cos(x)
+    return +result
+
+def trig(x, name):
+    x = to_decimal(x)
+    mp = load_mpmath()
+    if mp:
+        return from_mpmath(mp, lambda: getattr(mp, name)(mp.mpf(str(x))))
+    with decimal.localcontext() as ctx:
+        # Reducing a big x modulo 2pi cancels out its leading digits.
+        ctx.prec += 2 + max(0, x.adjusted())
+        two_pi = 2*compute_pi()
+        x = x.remainder_near(two_pi)
+        result = sin_series(x) if name == "sin" else cos_series(x)
+    return +result
+
+def sin_series(x):
+    # x - x^3/3! + x^5/5! - ..., for |x| <= pi.
+    return taylor_series(x, x, 1)
+
+def cos_series(x):
+    # 1 - x^2/2! + x^4/4! - ...
+    return taylor_series(x, Decimal(1), 0)
+
+def taylor_series(x, term, i):
+    minus_x_squared = -x*x
+    lasts, s = 0, term
+    while s != lasts:
+        lasts = s
+        i += 2
+        term = term * minus_x_squared / (i*(i-1))
+        s += term
+    return s
+
+def format_decimal(x, n=None):
+    """Rounds x to `n` significant digits (by default, the configured
+    precision) and formats it like a float would be, without trailing
+    zeros."""
+    if n is None:
+        n = digits() or ka.config.get(ConfigProperties.PRECISION)
+    if not x.is_finite():
+        return str(x).lower()
+    with decimal.localcontext() as ctx:
+        ctx.prec = n
+        x = (+x).normalize()
+    if x == 0:
+        return "0"
+    if -5 <= x.adjusted() < n:
+        return format(x, "f")
+    return format(x, "e")
+
+def format_number(x):
+    """Any exact or real number, as a decimal with the configured
+    number of digits."""
+    with decimal.localcontext() as ctx:
+        ctx.prec = digits() + GUARD_DIGITS
+        return format_decimal(to_decimal(x))
@@ -1,9 +1,10 @@
 from abc import ABC, abstractmethod
-from numbers import Integral
+from numbers import Integral, Rational
 import math
 import random
 
 from .utils import choose, factorial, erfinv
+from .rational import exact_sum
 
 def unit():
     return random.random()
@@ -40,7 +41,10 @@ class Binomial(DiscreteRandomVariable):
         self.p = p
 
     def cdf(self, x):
-        return sum(self.pmf(k) for k in range(x+1))
+        terms = [self.pmf(k) for k in range(x+1)]
+        if all(isinstance(t, Rational) for t in terms):
+            return exact_sum(terms)
+        return sum(terms)
 
     def pmf(self, x):
         if x < 0 or x > self.n:
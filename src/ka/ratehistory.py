@@ -0,0 +1,214 @@
+"""
+An on-disk store of daily exchange rate tables, for converting between
+currencies at some date in the past.
+
+Layout of the file (all little-endian):
+
+    magic            8 bytes, b"KARATES\\x01"
+    num_currencies   uint32
+    codes_length     uint32
+    codes            `codes_length` bytes, the currency codes separated by
+                     commas, padded with zeros to a multiple of 8 bytes
+    records          fixed-size, sorted by date. Each one is the date (as
+                     an int64 ordinal, see `datetime.date.toordinal`) followed
+                     by one float64 per currency. The rates are in the same
+                     form as `CurrencyData.dollar_rate`, with NaN for
+                     currencies that are missing on that day.
+
+Since the records have a fixed size, the file is memory-mapped and we
+binary search for a date, so only a handful of pages are ever read no
+matter how long the history is. Adding a day that comes after all the
+others is an append; anything else (an earlier day, or a currency we
+haven't seen before) rewrites the file.
+"""
+
+import bisect
+import math
+import mmap
+import os
+import os.path
+import struct
+import tempfile
+
+import ka.config
+from .config import ConfigProperties
+
+MAGIC = b"KARATES\x01"
+HEADER = struct.Struct("<8sII")
+DATE = struct.Struct("<q")
+
+class RateHistoryError(Exception):
+    pass
+
+def record_struct(num_currencies):
+    return struct.Struct("<q" + num_currencies*"d")
+
+def pad8(n):
+    return n + (-n % 8)
+
+class DateIndex:
+    """Lets `bisect` treat the dates of a RateHistory as a list, without
+    reading them all."""
+    def __init__(self, history):
+        self.history = history
+
+    def __len__(self):
+        return len(self.history)
+
+    def __getitem__(self, i):
+        return self.history.date_ordinal(i)
+
+class RateHistory:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            try:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Can't map an empty file.
+                raise RateHistoryError(f"Exchange rate history at {path} is empty.")
+        try:
+            self.read_header()
+        except BaseException:
+            self.mm.close()
+            raise
+
+    def read_header(self):
+        if len(self.mm) < HEADER.size:
+            raise RateHistoryError(f"Exchange rate history at {self.path} is corrupt.")
+        magic, num_currencies, codes_length = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise RateHistoryError(f"{self.path} is not an exchange rate history.")
+        codes = bytes(self.mm[HEADER.size:HEADER.size+codes_length])
+        self.codes = codes.decode("ascii").split(",") if codes else []
+        if len(self.codes) != num_currencies:
+            raise RateHistoryError(f"Exchange rate history at {self.path} is corrupt.")
+        self.column = dict((code, i) for i, code in enumerate(self.codes))
+        self.record = record_struct(num_currencies)
+        self.start = HEADER.size + pad8(codes_length)
+        # Ignore a partially-written record at the end, if there is one.
+        self.num_records = (len(self.mm) - self.start) // self.record.size
+
+    def close(self):
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.num_records
+
+    def offset(self, i):
+        return self.start + i*self.record.size
+
+    def date_ordinal(self, i):
+        return DATE.unpack_from(self.mm, self.offset(i))[0]
+
+    def read_record(self, i):
+        """Returns (date ordinal, list of rates)."""
+        values = self.record.unpack_from(self.mm, self.offset(i))
+        return values[0], list(values[1:])
+
+    def records(self):
+        return [self.read_record(i) for i in range(len(self))]
+
+    def find(self, date):
+        """Index of the last record on or before the given date,
+        or -1 if there isn't one."""
+        return bisect.bisect_right(DateIndex(self), date.toordinal()) - 1
+
+    def dollar_rate(self, code, date):
+        """Rate of the currency on the given date, or the closest
+        date before it that we have rates for."""
+        if code not in self.column:
+            raise RateHistoryError(f"No exchange rate history for '{code}'.")
+        i = self.find(date)
+        if i < 0:
+            raise RateHistoryError(f"No exchange rates on or before {date.isoformat()}.")
+        offset = self.offset(i) + DATE.size + 8*self.column[code]
+        rate = struct.unpack_from("<d", self.mm, offset)[0]
+        if math.isnan(rate):
+            raise RateHistoryError(
+                f"No exchange rate for '{code}' on {date.isoformat()}.")
+        return rate
+
+def write_history(path, codes, records):
+    """Writes the whole history file. `records` is a list of
+    (date ordinal, rates) sorted by date. Writes to a temporary file
+    and moves it into place, so readers never see a half-written
+    history."""
+    codes_bytes = ",".join(codes).encode("ascii")
+    record = record_struct(len(codes))
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".rates-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(HEADER.pack(MAGIC, len(codes), len(codes_bytes)))
+            f.write(codes_bytes.ljust(pad8(len(codes_bytes)), b"\0"))
+            for ordinal, rates in records:
+                f.write(record.pack(ordinal, *rates))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def add_rates(path, date, currencies):
+    """Adds a day of rates (a list of CurrencyData) to the history
+    at `path`, creating it if it doesn't exist. Replaces any rates
+    that were already there for that date."""
+    ordinal = date.toordinal()
+    try:
+        history = RateHistory(path)
+    except FileNotFoundError:
+        codes = sorted(c.symbol for c in currencies)
+        write_history(path, codes, [(ordinal, rates_row(codes, currencies))])
+        return
+    with history:
+        codes = history.codes
+        is_append = (all(c.symbol in history.column for c in currencies)
+                     and (len(history) == 0
+                          or history.date_ordinal(len(history)-1) < ordinal))
+        if is_append:
+            # Make sure we're appending after the last full record.
+            end = history.offset(len(history))
+            row = history.record.pack(ordinal, *rates_row(codes, currencies))
+        else:
+            records = history.records()
+    if is_append:
+        with open(path, "r+b") as f:
+            f.truncate(end)
+            f.seek(end)
+            f.write(row)
+        return
+    new_codes = sorted(set(codes).union(c.symbol for c in currencies))
+    if new_codes != codes:
+        column = dict((code, i) for i, code in enumerate(codes))
+        records = [(o, [(rates[column[code]] if code in column else math.nan)
+                        for code in new_codes])
+                   for o, rates in records]
+    records = [r for r in records if r[0] != ordinal]
+    i = bisect.bisect([o for o, _ in records], ordinal)
+    records.insert(i, (ordinal, rates_row(new_codes, currencies)))
+    write_history(path, new_codes, records)
+
+def rates_row(codes, currencies):
+    rates = dict((c.symbol, c.dollar_rate) for c in currencies)
+    return [rates.get(code, math.nan) for code in codes]
+
+def convert_at(amount, from_code, to_code, date, path=None):
+    """Converts an amount of one currency to another, using the rates
+    of the given date (or the closest date before it)."""
+    if path is None:
+        path = ka.config.get(ConfigProperties.CURRENCY_HISTORY_PATH)
+    try:
+        history = RateHistory(path)
+    except FileNotFoundError:
+        raise RateHistoryError(f"No exchange rate history found at {path}.")
+    with history:
+        from_rate = history.dollar_rate(from_code, date)
+        to_rate = history.dollar_rate(to_code, date)
+    return amount * (to_rate/from_rate)
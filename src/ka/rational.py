@@ -0,0 +1,94 @@
+"""
+Exact arithmetic on integers and fractions.
+
+Ka's fractions are always `fractions.Fraction`: that's what gets
+printed, compared and passed between functions. But sums and products
+of many fractions (or big integers) are worked out here, where they can
+be done much faster than one operation at a time:
+
+* They're combined in pairs, then the pairs in pairs, and so on, so the
+  numbers stay small for as long as possible. Adding 1/1 + 1/2 + ... +
+  1/n one term at a time makes every step work with a huge fraction.
+* If gmpy2 is installed, the arithmetic is done with its `mpq`/`mpz`
+  types, which use GMP. The result is converted back to a Fraction.
+
+Converting to and from gmpy2 costs about as much as a single operation,
+so it's only worth it for reductions, not for every `+`.
+"""
+
+import numbers
+import operator
+from fractions import Fraction
+
+gmpy2 = None
+
+def load_gmpy2():
+    """Returns the gmpy2 module, or None if it's not installed."""
+    global gmpy2
+    if gmpy2 is None:
+        try:
+            import gmpy2 as module
+            gmpy2 = module
+        except ImportError:
+            gmpy2 = False
+    return gmpy2 or None
+
+def fraction(n, d):
+    """n/d as a Fraction. This is where all of Ka's fractions are made."""
+    return Fraction(n, d)
+
+def is_backend_type(x):
+    """Whether x is exact, but not an int or a Fraction. Values like
+    this shouldn't escape from here, but if one does, it's converted
+    by `simplify_number`."""
+    return (type(x) is not int
+            and type(x) is not Fraction
+            and isinstance(x, numbers.Rational)
+            and not isinstance(x, bool))
+
+def to_backend(x, gmp):
+    if type(x) is int:
+        return gmp.mpz(x)
+    return gmp.mpq(x.numerator, x.denominator)
+
+def from_backend(x):
+    if isinstance(x, int):
+        return x
+    if x.denominator == 1:
+        return int(x.numerator)
+    # Already in lowest terms, so don't make Fraction do another gcd.
+    return from_coprime(int(x.numerator), int(x.denominator))
+
+if hasattr(Fraction, "_from_coprime_ints"):
+    from_coprime = Fraction._from_coprime_ints
+else:
+    # Before Python 3.12.
+    def from_coprime(n, d):
+        return Fraction(n, d, _normalize=False)
+
+def pairwise(xs, op):
+    while len(xs) > 1:
+        combined = [op(xs[i], xs[i+1]) for i in range(0, len(xs)-1, 2)]
+        if len(xs) % 2:
+            combined.append(xs[-1])
+        xs = combined
+    return xs[0]
+
+def reduce_exact(xs, op, identity):
+    if not xs:
+        return identity
+    gmp = load_gmpy2()
+    if gmp:
+        return from_backend(pairwise([to_backend(x, gmp) for x in xs], op))
+    return pairwise(list(xs), op)
+
+def exact_sum(xs):
+    """Sum of a list of ints and Fractions."""
+    if all(type(x) is int for x in xs):
+        # Adding ints doesn't get slower as you go, like with fractions.
+        return sum(xs)
+    return reduce_exact(xs, operator.add, 0)
+
+def exact_prod(xs):
+    """Product of a list of ints and Fractions."""
+    return reduce_exact(xs, operator.mul, 1)
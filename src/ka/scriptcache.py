@@ -0,0 +1,75 @@
+"""
+Caches the parse trees of scripts, so that running the same script
+again skips tokenising and parsing it. Like Python's `__pycache__`, the
+parse tree of `path/to/script.ka` is kept in
+`path/to/__kacache__/script.ka.kac`.
+
+A cache file starts with a key made from the version of Ka and a hash
+of the script's source. If the script or Ka has changed since the file
+was written, the key doesn't match, and the script is parsed again and
+the file replaced. Failing to read or write the cache is never an
+error; the script is just parsed as usual.
+"""
+
+import gc
+import hashlib
+import os
+import pickle
+from pathlib import Path
+
+from .interpret import KA_VERSION
+
+CACHE_DIR = "__kacache__"
+EXTENSION = ".kac"
+MAGIC = b"KAC\n"
+# Bump when the parse tree changes in a way that makes old trees
+# invalid, in between releases of Ka.
+CACHE_VERSION = 3
+
+def cache_path(script_path):
+    script_path = Path(script_path)
+    return script_path.parent.joinpath(CACHE_DIR, script_path.name + EXTENSION)
+
+def cache_key(source):
+    digest = hashlib.sha256(source.encode()).hexdigest()
+    return f"{KA_VERSION}:{CACHE_VERSION}:{digest}".encode()
+
+def load_parse_tree(script_path, source):
+    """The cached parse tree of the script, or None if there isn't an
+    up-to-date one."""
+    key = cache_key(source)
+    try:
+        with open(cache_path(script_path), "rb") as f:
+            if f.readline() != MAGIC or f.readline() != key + b"\n":
+                return None
+            # The garbage collector would otherwise run over and over
+            # while the nodes are being created, which makes loading
+            # several times slower.
+            gc_was_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                return pickle.load(f)
+            finally:
+                if gc_was_enabled:
+                    gc.enable()
+    except Exception:
+        # Missing, unreadable, or written by an incompatible version.
+        return None
+
+def store_parse_tree(script_path, source, tree):
+    path = cache_path(script_path)
+    # Written to a temporary file and then renamed, so that another run
+    # of the script never sees a half-written file.
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        path.parent.mkdir(exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            f.write(MAGIC)
+            f.write(cache_key(source) + b"\n")
+            pickle.dump(tree, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except (OSError, pickle.PicklingError, RecursionError):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
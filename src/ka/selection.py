@@ -0,0 +1,57 @@
+"""
+Finds the elements that would be at given positions of a list if it
+were sorted (its order statistics), without sorting it. Used by
+`median`, `percentile` and `quantiles`.
+
+This is quickselect: pick a random pivot, split the list into the
+elements below it and the elements above it, and keep going on only
+the side(s) containing the positions we want. For a handful of
+positions, that's a linear number of comparisons on average, which
+matters when comparing two elements means dispatching a function.
+"""
+
+import random
+
+from .limits import check as check_limits
+
+# A separate generator, so that picking pivots doesn't change the
+# random numbers the user gets after calling `seed`.
+PIVOT_RANDOM = random.Random(0)
+# Below this size, sorting is quicker.
+SORT_THRESHOLD = 16
+
+def select(xs, ranks):
+    """Returns a dict from each rank (a 0-based index into the sorted
+    list) to the element with that rank. Elements are compared with
+    `<` only, and elements that are neither less nor greater than
+    each other count as equal."""
+    result = {}
+    select_into(xs, 0, sorted(set(ranks)), result)
+    return result
+
+def select_into(xs, offset, ranks, result):
+    # `offset` is the rank of the smallest element of xs in the
+    # original list.
+    while ranks:
+        if len(xs) <= SORT_THRESHOLD:
+            xs = sorted(xs)
+            for r in ranks:
+                result[r] = xs[r-offset]
+            return
+        check_limits(len(xs))
+        pivot = xs[PIVOT_RANDOM.randrange(len(xs))]
+        lows = [x for x in xs if x < pivot]
+        highs = [x for x in xs if pivot < x]
+        first_equal = offset + len(lows)
+        first_high = offset + len(xs) - len(highs)
+        low_ranks = [r for r in ranks if r < first_equal]
+        high_ranks = [r for r in ranks if r >= first_high]
+        for r in ranks:
+            if first_equal <= r < first_high:
+                result[r] = pivot
+        if low_ranks:
+            if high_ranks:
+                select_into(highs, first_high, high_ranks, result)
+            xs, ranks = lows, low_ranks
+        else:
+            xs, offset, ranks = highs, first_high, high_ranks
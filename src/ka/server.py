@@ -0,0 +1,281 @@
+"""
+An HTTP service for evaluating Ka, for programs that would otherwise
+run `ka` once per expression. `ka --http PORT` serves
+
+    POST /eval    {"source": "x = 2 m; x^2", "session": "abc"}
+
+on localhost only. The response is a JSON object: `ok`, and then either
+`value` (the result, in the same syntax that `stringify_result` gives),
+`type` and `output` (what the interpreter would have printed), or
+`error` (the error message, with the context it was found in).
+
+Evaluation is CPU-bound, so it's done by a pool of worker processes,
+started (and made to import everything) when the service starts. Each
+worker has one process, so that a session's variables can live in it:
+a session is assigned to a worker the first time it's used, and all
+its requests go to that worker, in order. Requests without a session
+are evaluated in a fresh environment by whichever worker is next.
+Sessions that haven't been used for a while are forgotten, along with
+their variables and the functions defined in them.
+
+Every request is evaluated with limits on its time, the size of its
+integers and the number of array elements it creates (see
+`request_limits`), and plots can't be shown or saved to files.
+"""
+
+import asyncio
+import concurrent.futures
+import http
+import io
+import json
+import multiprocessing
+import os
+import time
+
+from .interpret import execute, stringify_result, ResultBox
+from .eval import EvalEnvironment
+from .limits import EvalLimits
+from .types import get_external_type_name
+from .currency import enable_background_refresh
+from .plot import disable_output
+
+HOST = "127.0.0.1"
+# Seconds that a session is kept after its last request.
+DEFAULT_IDLE_TIMEOUT = 30*60
+# The limits for evaluating a request, so that a runaway request can't
+# tie up a worker forever, or use up its memory. The config can make
+# them stricter, but not looser. The size of integers and arrays has to
+# be limited too, since one big multiplication can't be interrupted.
+DEFAULT_TIMEOUT = 30
+DEFAULT_MAX_INT_BITS = 1 << 20
+DEFAULT_MAX_ELEMENTS = 10**7
+MAX_BODY_SIZE = 1 << 20
+
+#########################
+# In the worker process #
+#########################
+# Session ID -> EvalEnvironment.
+SESSIONS = {}
+
+def init_worker():
+    enable_background_refresh()
+    disable_output()
+
+def warm_up():
+    # Parsing, evaluating and looking up a unit for the first time is
+    # much slower than afterwards.
+    evaluate("1 m + 1 ft")
+
+def evaluate(source, session=None):
+    env = SESSIONS.get(session)
+    if env is None:
+        env = EvalEnvironment(track_dependencies=False)
+        if session is not None:
+            SESSIONS[session] = env
+    out = io.StringIO()
+    errout = io.StringIO()
+    result_box = ResultBox()
+    try:
+        status = execute(source, env, out=out, errout=errout,
+                         result_box=result_box,
+                         # Keeps plots from being drawn.
+                         post_display_action_box=ResultBox(),
+                         limits=request_limits())
+    except Exception as e:
+        # A bug, rather than a mistake in the source. The worker
+        # carries on with the next request.
+        return {"ok": False, "error": f"Internal error: {e!r}"}
+    if status != 0:
+        return {"ok": False, "error": errout.getvalue().rstrip("\n")}
+    value = result_box.value
+    return {
+        "ok": True,
+        "value": None if value is None else stringify_result(value),
+        "type": None if value is None else get_external_type_name(value),
+        "output": out.getvalue().rstrip("\n"),
+    }
+
+def request_limits():
+    limits = EvalLimits.from_config()
+    def capped(limit, default):
+        return min(limit, default) if limit else default
+    return EvalLimits(
+        max_steps=limits.max_steps,
+        timeout=capped(limits.timeout, DEFAULT_TIMEOUT),
+        max_int_bits=capped(limits.max_int_bits, DEFAULT_MAX_INT_BITS),
+        max_elements=capped(limits.max_elements, DEFAULT_MAX_ELEMENTS))
+
+def forget(sessions):
+    for session in sessions:
+        SESSIONS.pop(session, None)
+
+#################
+# In the server #
+#################
+class Worker:
+    def __init__(self):
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=1,
+            # Forking a process that has threads (like the one that
+            # refreshes exchange rates) isn't safe.
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker)
+        self.sessions = set()
+
+    def submit(self, f, *args):
+        return asyncio.wrap_future(self.executor.submit(f, *args))
+
+    def restart(self):
+        """After the process has died. Its sessions are lost."""
+        self.executor.shutdown(wait=False)
+        self.__init__()
+
+class Session:
+    def __init__(self, worker):
+        self.worker = worker
+        self.last_used = time.monotonic()
+        self.pending = 0
+
+class EvalService:
+    def __init__(self, workers=None, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.workers = [Worker() for _ in range(workers or os.cpu_count() or 1)]
+        self.idle_timeout = idle_timeout
+        # Session ID -> Session.
+        self.sessions = {}
+        self.next_worker = 0
+        self.server = None
+        self.evictor = None
+
+    async def start(self, port):
+        await asyncio.gather(*(w.submit(warm_up) for w in self.workers))
+        self.server = await asyncio.start_server(self.handle, HOST, port)
+        self.evictor = asyncio.create_task(self.evict_periodically())
+
+    @property
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.evictor.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+        for w in self.workers:
+            w.executor.shutdown()
+
+    async def evaluate(self, source, session_id=None):
+        if session_id is None:
+            worker = self.workers[self.next_worker]
+            self.next_worker = (self.next_worker + 1) % len(self.workers)
+            return await self.run(worker, source, None)
+        session = self.sessions.get(session_id)
+        if session is None:
+            worker = min(self.workers, key=lambda w: len(w.sessions))
+            session = self.sessions[session_id] = Session(worker)
+            worker.sessions.add(session_id)
+        session.pending += 1
+        try:
+            return await self.run(session.worker, source, session_id)
+        finally:
+            session.pending -= 1
+            session.last_used = time.monotonic()
+
+    async def run(self, worker, source, session_id):
+        executor = worker.executor
+        try:
+            return await worker.submit(evaluate, source, session_id)
+        except concurrent.futures.process.BrokenProcessPool:
+            # Unless another request has already found out.
+            if worker.executor is executor:
+                for s in worker.sessions:
+                    self.sessions.pop(s, None)
+                worker.restart()
+            raise WorkerCrashedError()
+
+    def evict_idle_sessions(self, now=None):
+        """Forgets the sessions that haven't been used for `idle_timeout`
+        seconds. Returns how many there were."""
+        if now is None:
+            now = time.monotonic()
+        idle = [s for s, session in self.sessions.items()
+                if session.pending == 0
+                and now - session.last_used > self.idle_timeout]
+        for worker in self.workers:
+            forgotten = worker.sessions.intersection(idle)
+            if forgotten:
+                worker.sessions -= forgotten
+                worker.executor.submit(forget, forgotten)
+        for s in idle:
+            del self.sessions[s]
+        return len(idle)
+
+    async def evict_periodically(self):
+        while True:
+            await asyncio.sleep(min(60, self.idle_timeout))
+            self.evict_idle_sessions()
+
+    async def handle(self, reader, writer):
+        try:
+            status, body = await self.respond(reader)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ValueError):
+            status, body = 400, {"ok": False, "error": "Bad request."}
+        data = json.dumps(body).encode()
+        writer.write(
+            (f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n"
+             "Content-Type: application/json\r\n"
+             f"Content-Length: {len(data)}\r\n"
+             "Connection: close\r\n\r\n").encode() + data)
+        try:
+            await writer.drain()
+            writer.close()
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    async def respond(self, reader):
+        """Returns the status code and the JSON response."""
+        method, path, _ = (await reader.readline()).decode("latin-1").split()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if path != "/eval":
+            return 404, {"ok": False, "error": f"Unknown path: {path}"}
+        if method != "POST":
+            return 405, {"ok": False, "error": "Only POST is supported."}
+        length = int(headers.get("content-length", 0))
+        if length > MAX_BODY_SIZE:
+            return 413, {"ok": False, "error": "Request is too big."}
+        request = json.loads(await reader.readexactly(length))
+        source = request.get("source") if isinstance(request, dict) else None
+        session = request.get("session") if isinstance(request, dict) else None
+        if not isinstance(source, str) or not (session is None
+                                               or isinstance(session, str)):
+            return 400, {"ok": False, "error": "Expected {\"source\": string, \"session\": string (optional)}."}
+        try:
+            return 200, await self.evaluate(source, session)
+        except WorkerCrashedError:
+            return 500, {"ok": False, "error": "The worker evaluating this request crashed. Its sessions have been lost."}
+        except Exception as e:
+            # E.g. a result that can't be sent back from the worker.
+            return 500, {"ok": False, "error": f"Internal error: {e!r}"}
+
+class WorkerCrashedError(Exception):
+    pass
+
+def run_server(port, workers=None):
+    async def serve():
+        service = EvalService(workers=workers)
+        await service.start(port)
+        print(f"Serving on http://{HOST}:{service.port}/eval", flush=True)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await service.close()
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,353 @@
+"""
+Saving the variables of a session to a file and loading them back
+(`%save name` and `%load name` in the interpreter).
+
+The file is a header followed by a sequence of (name, value) pairs.
+Each value is a one-byte tag and then its contents; arrays, sets and
+the other compound types hold more values. Arrays of floats, and of
+ints that fit in 64 bits, are stored as raw machine-format buffers, so
+that a big array of samples can be written and read back without going
+through its elements one at a time. Big files are memory-mapped when
+they're read, rather than read into memory first.
+
+Unlike pickle, loading a snapshot can only create Ka values, so it's
+safe to load one from somewhere else.
+"""
+
+import array
+import mmap
+import os
+import struct
+import sys
+from datetime import datetime
+from decimal import Decimal
+from fractions import Fraction
+from pathlib import Path
+
+import ka.config
+from .config import ConfigProperties
+from .types import Quantity, Array, Set, Interval, Instant, Combinatoric, IntRange
+from .units import QSPACE, QuantityVector, Vector
+from .probability import RandomVariable
+
+MAGIC = b"KASNAP"
+VERSION = 1
+HEADER = struct.Struct("<6sBc")
+EXTENSION = ".kasnap"
+# Files bigger than this are memory-mapped.
+MMAP_THRESHOLD = 1 << 20
+
+INT64 = struct.Struct("<q")
+UINT32 = struct.Struct("<I")
+UINT64 = struct.Struct("<Q")
+FLOAT64 = struct.Struct("<d")
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+
+class SnapshotError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+class UnsupportedValueError(Exception):
+    pass
+
+def snapshot_path(name):
+    """A name is looked up in the snapshot directory; anything that
+    looks like a path is used as it is."""
+    if os.sep in name or "/" in name or name.endswith(EXTENSION):
+        return Path(name)
+    directory = Path(ka.config.get(ConfigProperties.SNAPSHOT_PATH))
+    return directory.joinpath(name + EXTENSION)
+
+def save(env, path):
+    """Writes the variables of an EvalEnvironment to a file, apart from
+    the built-in constants. Returns the names of the variables that
+    couldn't be saved, because of their type."""
+    from .eval import CONSTANTS
+    writer = Writer()
+    unsaved = []
+    for name, value in env._variables.items():
+        if name in CONSTANTS and value is CONSTANTS[name]:
+            continue
+        mark = writer.mark()
+        try:
+            writer.write_str(name)
+            writer.write(value)
+        except UnsupportedValueError:
+            writer.rewind(mark)
+            unsaved.append(name)
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, sys.byteorder[0].encode()))
+        f.write(writer.getvalue())
+    return unsaved
+
+def load(path):
+    """Returns a dict of the variables in a snapshot file."""
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < MMAP_THRESHOLD:
+                return read_variables(f.read())
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return read_variables(m)
+    except FileNotFoundError:
+        raise SnapshotError(f"No snapshot at {path}.")
+    except (struct.error, ValueError, IndexError, KeyError,
+            UnicodeDecodeError):
+        raise SnapshotError(f"Snapshot at {path} is corrupted.")
+
+def read_variables(data):
+    with memoryview(data) as view:
+        magic, version, byteorder = HEADER.unpack_from(view, 0)
+        if magic != MAGIC:
+            raise SnapshotError("Not a Ka snapshot.")
+        if version != VERSION:
+            raise SnapshotError(f"Unsupported snapshot version: {version}.")
+        reader = Reader(view, HEADER.size,
+                        swap_bytes=byteorder.decode() != sys.byteorder[0])
+        variables = {}
+        while not reader.at_end():
+            name = reader.read_str()
+            variables[name] = reader.read()
+        reader.view = None
+        return variables
+
+def restore(env, variables, source):
+    """Assigns the loaded variables, as if the command `source` had
+    assigned them, so that %recompute knows they've changed."""
+    with env.recording() as access:
+        for name, value in variables.items():
+            env.set_variable(name, value)
+    if env.dependencies is not None and access.writes:
+        env.dependencies.add(source, None, access)
+
+def random_variable_types():
+    types = {}
+    unvisited = [RandomVariable]
+    while unvisited:
+        t = unvisited.pop()
+        types[t.__name__] = t
+        unvisited.extend(t.__subclasses__())
+    return types
+
+########
+# Tags #
+########
+NONE = b"n"
+BOOL = b"B"
+INT = b"i"
+BIG_INT = b"I"
+FLOAT = b"f"
+FRACTION = b"r"
+DECIMAL = b"d"
+STRING = b"s"
+ARRAY = b"A"
+FLOAT_ARRAY = b"a"
+INT_ARRAY = b"q"
+SET = b"S"
+QUANTITY = b"Q"
+INTERVAL = b"N"
+INSTANT = b"t"
+COMBINATORIC = b"C"
+RANDOM_VARIABLE = b"R"
+
+class Writer:
+    def __init__(self):
+        self.chunks = []
+
+    def mark(self):
+        return len(self.chunks)
+
+    def rewind(self, mark):
+        del self.chunks[mark:]
+
+    def getvalue(self):
+        return b"".join(self.chunks)
+
+    def write_tag(self, tag):
+        self.chunks.append(tag)
+
+    def write_uint(self, n):
+        self.chunks.append(UINT64.pack(n))
+
+    def write_str(self, s):
+        data = s.encode()
+        self.chunks.append(UINT32.pack(len(data)))
+        self.chunks.append(data)
+
+    def write_int(self, n):
+        if INT64_MIN <= n <= INT64_MAX:
+            self.write_tag(INT)
+            self.chunks.append(INT64.pack(n))
+        else:
+            self.write_tag(BIG_INT)
+            data = n.to_bytes((n.bit_length() + 8) // 8, "little", signed=True)
+            self.chunks.append(UINT64.pack(len(data)))
+            self.chunks.append(data)
+
+    def write_values(self, xs):
+        self.write_uint(len(xs))
+        for x in xs:
+            self.write(x)
+
+    def write(self, x):
+        t = type(x)
+        if x is None:
+            self.write_tag(NONE)
+        elif t is bool:
+            self.write_tag(BOOL)
+            self.chunks.append(b"\x01" if x else b"\x00")
+        elif t is int:
+            self.write_int(x)
+        elif t is float:
+            self.write_tag(FLOAT)
+            self.chunks.append(FLOAT64.pack(x))
+        elif t is Fraction:
+            self.write_tag(FRACTION)
+            self.write_int(x.numerator)
+            self.write_int(x.denominator)
+        elif t is Decimal:
+            self.write_tag(DECIMAL)
+            self.write_str(str(x))
+        elif t is str:
+            self.write_tag(STRING)
+            self.write_str(x)
+        elif t is Array:
+            self.write_array(x.contents)
+        elif t is Set:
+            self.write_tag(SET)
+            self.write_values(list(x.elements))
+        elif t is Quantity:
+            self.write_tag(QUANTITY)
+            self.write(x.mag)
+            self.write_values(x.qv.v.xs)
+        elif t is Interval:
+            self.write_tag(INTERVAL)
+            self.write(x.a)
+            self.write(x.b)
+        elif t is Instant:
+            self.write_tag(INSTANT)
+            self.write_str(x.dt.isoformat())
+        elif t is Combinatoric:
+            self.write_tag(COMBINATORIC)
+            for ranges in (x.ns, x.ds):
+                self.write_values([b for r in ranges for b in (r.lo, r.hi)])
+        elif isinstance(x, RandomVariable):
+            self.write_tag(RANDOM_VARIABLE)
+            self.write_str(t.__name__)
+            self.write_uint(len(vars(x)))
+            for attribute, value in vars(x).items():
+                self.write_str(attribute)
+                self.write(value)
+        else:
+            raise UnsupportedValueError()
+
+    def write_array(self, xs):
+        # Quicker than checking the elements one at a time in Python.
+        types = set(map(type, xs))
+        if types == {float}:
+            self.write_tag(FLOAT_ARRAY)
+            self.write_buffer(array.array("d", xs))
+        elif (types == {int}
+                and INT64_MIN <= min(xs) and max(xs) <= INT64_MAX):
+            self.write_tag(INT_ARRAY)
+            self.write_buffer(array.array("q", xs))
+        else:
+            self.write_tag(ARRAY)
+            self.write_values(xs)
+
+    def write_buffer(self, a):
+        self.write_uint(len(a))
+        self.chunks.append(a.tobytes())
+
+class Reader:
+    def __init__(self, view, offset, swap_bytes=False):
+        self.view = view
+        self.offset = offset
+        self.swap_bytes = swap_bytes
+
+    def at_end(self):
+        return self.offset >= len(self.view)
+
+    def read_bytes(self, n):
+        if self.offset + n > len(self.view):
+            raise ValueError("Unexpected end of snapshot.")
+        data = self.view[self.offset:self.offset+n]
+        self.offset += n
+        return data
+
+    def unpack(self, s):
+        value, = s.unpack_from(self.view, self.offset)
+        self.offset += s.size
+        return value
+
+    def read_str(self):
+        return str(self.read_bytes(self.unpack(UINT32)), "utf-8")
+
+    def read_values(self):
+        return [self.read() for _ in range(self.unpack(UINT64))]
+
+    def read_buffer(self, typecode):
+        a = array.array(typecode)
+        a.frombytes(self.read_bytes(self.unpack(UINT64) * a.itemsize))
+        if self.swap_bytes:
+            a.byteswap()
+        return a.tolist()
+
+    def read_ranges(self):
+        bounds = self.read_values()
+        return [IntRange(bounds[i], bounds[i+1])
+                for i in range(0, len(bounds), 2)]
+
+    def read(self):
+        tag = bytes(self.read_bytes(1))
+        if tag == NONE:
+            return None
+        if tag == BOOL:
+            return self.read_bytes(1)[0] == 1
+        if tag == INT:
+            return self.unpack(INT64)
+        if tag == BIG_INT:
+            n = self.unpack(UINT64)
+            return int.from_bytes(self.read_bytes(n), "little", signed=True)
+        if tag == FLOAT:
+            return self.unpack(FLOAT64)
+        if tag == FRACTION:
+            return Fraction(self.read(), self.read())
+        if tag == DECIMAL:
+            return Decimal(self.read_str())
+        if tag == STRING:
+            return self.read_str()
+        if tag == ARRAY:
+            return Array(self.read_values())
+        if tag == FLOAT_ARRAY:
+            return Array(self.read_buffer("d"))
+        if tag == INT_ARRAY:
+            return Array(self.read_buffer("q"))
+        if tag == SET:
+            return Set.from_values(self.read_values())
+        if tag == QUANTITY:
+            mag = self.read()
+            exponents = tuple(self.read_values())
+            if len(exponents) != len(QSPACE.base_units):
+                raise ValueError("Wrong number of dimensions.")
+            return Quantity(mag, QuantityVector(Vector(exponents),
+                                                QSPACE.base_units))
+        if tag == INTERVAL:
+            return Interval(self.read(), self.read())
+        if tag == INSTANT:
+            return Instant(datetime.fromisoformat(self.read_str()))
+        if tag == COMBINATORIC:
+            ns = self.read_ranges()
+            ds = self.read_ranges()
+            return Combinatoric(ns=ns, ds=ds)
+        if tag == RANDOM_VARIABLE:
+            t = random_variable_types()[self.read_str()]
+            rv = t.__new__(t)
+            for _ in range(self.unpack(UINT64)):
+                attribute = self.read_str()
+                setattr(rv, attribute, self.read())
+            return rv
+        raise ValueError(f"Unknown tag: {tag}")
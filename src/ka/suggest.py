@@ -0,0 +1,104 @@
+"""
+"Did you mean" suggestions for misspelt function and unit names.
+
+Names are indexed by every string that can be made by deleting up to
+MAX_DISTANCE of their characters (the symmetric delete approach, as
+used by SymSpell). Two strings within edit distance d of each other
+always have a common deletion of at most d characters each, so the
+candidates for a misspelt name are the indexed names that share one of
+its deletions. That's a handful of dict lookups, however many names
+there are and however long the misspelt one is, compared to generating
+every insertion and substitution of it. The candidates are then checked
+with the actual edit distance, where swapping two adjacent characters
+counts as one edit.
+"""
+
+MAX_DISTANCE = 2
+# Suggest at most this many names.
+MAX_SUGGESTIONS = 5
+
+class SuggestionIndex:
+    """Words are only indexed when the first suggestion is asked for,
+    so that adding them doesn't slow down start-up."""
+    def __init__(self, words=()):
+        self.words = set()
+        self.unindexed = []
+        # Deletion -> the words it comes from.
+        self.deletions = {}
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        if word not in self.words:
+            self.words.add(word)
+            self.unindexed.append(word)
+
+    def index(self):
+        for word in self.unindexed:
+            for d in deletions(word, MAX_DISTANCE):
+                self.deletions.setdefault(d, set()).add(word)
+        self.unindexed = []
+
+    def suggest(self, s, exists=None):
+        """The indexed words closest to `s`, if any are close enough.
+        Short strings have to be closer, otherwise every short word
+        would be suggested for them. `exists` can be used to leave out
+        words that have been removed since they were indexed."""
+        max_distance = allowed_distance(s)
+        if max_distance == 0:
+            return []
+        self.index()
+        candidates = set()
+        for d in deletions(s, max_distance):
+            candidates |= self.deletions.get(d, set())
+        matches = []
+        for word in candidates:
+            if word == s or (exists is not None and not exists(word)):
+                continue
+            distance = edit_distance(s, word, max_distance)
+            if distance <= max_distance:
+                matches.append((distance, word))
+        if not matches:
+            return []
+        closest = min(distance for distance, _ in matches)
+        return sorted(word for distance, word in matches
+                      if distance == closest)[:MAX_SUGGESTIONS]
+
+def allowed_distance(s):
+    if len(s) <= 1:
+        return 0
+    if len(s) <= 4:
+        return 1
+    return MAX_DISTANCE
+
+def deletions(s, n):
+    """s, and every string made by deleting up to n characters of it."""
+    result = {s}
+    frontier = {s}
+    for _ in range(n):
+        frontier = {x[:i] + x[i+1:] for x in frontier for i in range(len(x))}
+        result |= frontier
+    return result
+
+def edit_distance(s, t, limit):
+    """Number of insertions, deletions, substitutions and swaps of
+    adjacent characters that turn s into t (the optimal string
+    alignment distance), or something bigger than `limit` if it's
+    bigger than that."""
+    if abs(len(s) - len(t)) > limit:
+        return limit + 1
+    previous = None
+    row = list(range(len(t) + 1))
+    for i in range(1, len(s) + 1):
+        before, previous, row = previous, row, [i] + [0]*len(t)
+        for j in range(1, len(t) + 1):
+            cost = 0 if s[i-1] == t[j-1] else 1
+            row[j] = min(previous[j] + 1,
+                         row[j-1] + 1,
+                         previous[j-1] + cost)
+            if (i > 1 and j > 1
+                    and s[i-1] == t[j-2] and s[i-2] == t[j-1]):
+                row[j] = min(row[j], before[j-2] + 1)
+        if min(row) > limit:
+            return limit + 1
+    return row[-1]
@@ -132,6 +132,61 @@ def tokenise(s):
         tokens.append(token)
     return tokens
 
+def split_statements(lines):
+    """Splits the text from an iterable of lines (like a file) into
+    statements, without reading more of it than it needs to. Yields
+    each statement as (text, line number), where the line number is
+    where the statement starts, counting from 1. Text that can't be
+    tokenised is yielded as a single statement, so that the error is
+    reported when it's executed."""
+    # The text of the unfinished statement, and the line it starts on.
+    parts = []
+    parts_line = 1
+    line_number = 1
+    # The separators are found by scanning each line once, keeping track
+    # of whether it's inside a string or an instant, rather than
+    # tokenising all of the unfinished statement after every line.
+    quote = None
+    escaped = False
+    for line in lines:
+        start = 0
+        for i, c in enumerate(line):
+            if escaped:
+                escaped = False
+                if c == "\"":
+                    continue
+            if quote is not None:
+                if c == quote:
+                    quote = None
+                elif c == "\\" and quote == "\"":
+                    escaped = True
+            elif c == "\"" or c == "#":
+                quote = c
+            elif c == Tokens.STATEMENT_SEPARATOR:
+                text = "".join(parts) + line[start:i]
+                parts = []
+                try:
+                    tokenise(text)
+                except (UnknownTokenError, BadNumberError):
+                    yield ((text + line[i:]).strip(),
+                           parts_line + leading_newlines(text, 0))
+                    return
+                if text.strip():
+                    yield text.strip(), parts_line + leading_newlines(text, 0)
+                start = i+1
+                parts_line = line_number
+            if c == "\n":
+                line_number += 1
+        parts.append(line[start:])
+    text = "".join(parts)
+    if text.strip():
+        yield text.strip(), parts_line + leading_newlines(text, 0)
+
+def leading_newlines(s, start):
+    # Number of lines before the first non-whitespace character after
+    # `start`.
+    return s.count("\n", 0, skip_whitespace(start, s))
+
 def skip_whitespace(i, s):
     while i < len(s) and s[i].isspace():
         i += 1
@@ -224,4 +279,8 @@ def read_num_token(i, s):
             value *= frac(1, 10**-exponent)
         else:
             value *= 10**exponent
+    if isinstance(value, float):
+        # Keep the digits as written, for precision mode.
+        return Token(Tokens.NUM, m.start(), m.end(), value=value,
+                     literal=m.group(0))
     return Token(Tokens.NUM, m.start(), m.end(), value=value)
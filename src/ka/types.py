@@ -1,11 +1,15 @@
 import math
 import numbers
+from decimal import Decimal
 from fractions import Fraction as frac
 from numbers import Number
 from datetime import datetime, timedelta
 import re
 
 from .units import S as SECONDS
+from .limits import check as check_limits
+from .rational import fraction, from_backend, is_backend_type
+from .precision import is_integral
 
 class KaRuntimeError(Exception):
     def __init__(self, msg):
@@ -38,7 +42,7 @@ def simplify_type(x):
     return x
 
 def fraction_divide(n1, n2):
-    return frac(n1, n2)
+    return fraction(n1, n2)
 
 def simplify_number(x):
     if isinstance(x, float):
@@ -48,15 +52,21 @@ def simplify_number(x):
             # to rationals results in ugly-looking fractions
             # due to rounding issues.
             return int(whole)
-    elif isinstance(x, frac) and x.numerator % x.denominator == 0:
-        return x.numerator // x.denominator
+    elif isinstance(x, frac):
+        if x.numerator % x.denominator == 0:
+            return x.numerator // x.denominator
+    elif isinstance(x, Decimal):
+        if is_integral(x):
+            return int(x)
+    elif is_backend_type(x):
+        return simplify_number(from_backend(x))
     return x
 
 def divide(x, y):
     # Assuming they've been converted to have
     # the same type.
     if isinstance(x, int):
-        return frac(x, y)
+        return fraction(x, y)
     return x/y
 
 class Array:
@@ -84,6 +94,37 @@ class Array:
     def append(self, x):
         self.contents.append(x)
 
+class Set:
+    """Distinct values with constant-time membership checks. Only values
+    whose hash agrees with `==` can go in a set (see `is_hashable`).
+    Kept in insertion order, so that sets print predictably."""
+    def __init__(self, elements):
+        # A dict rather than a set for the ordering; the values are unused.
+        self.elements = elements
+
+    @staticmethod
+    def from_values(xs):
+        return Set(dict.fromkeys(xs))
+
+    def __eq__(self, other):
+        return (isinstance(other, Set)
+                and self.elements.keys() == other.elements.keys())
+
+    def __str__(self):
+        return "Set(" + str(list(self.elements)) + ")"
+
+    def __repr__(self):
+        return str(self)
+
+    def __len__(self):
+        return len(self.elements)
+
+    def __iter__(self):
+        return iter(self.elements)
+
+    def __contains__(self, x):
+        return x in self.elements
+
 class IntRange:
     def __init__(self, lo, hi):
         self.lo = lo
@@ -164,6 +205,7 @@ class Combinatoric(numbers.Number):
         for numerator_range in self.ns:
             numerator_range = numerator_range.copy()
             while not numerator_range.is_empty():
+                check_limits()
                 # Multiply by the highest number in the range, since it's
                 # likely to have the most divisors.
                 result *= numerator_range.hi
@@ -179,6 +221,7 @@ class Combinatoric(numbers.Number):
         denom = 1
         for denom_range in denom_ranges:
             while not denom_range.is_empty():
+                check_limits()
                 denom *= denom_range.lo
                 denom_range.lo += 1
         
@@ -207,12 +250,23 @@ class Instant:
         return (isinstance(other, Instant)
                 and self.dt == other.dt)
 
+    def __hash__(self):
+        return hash(self.dt)
+
     def __str__(self):
         return self.dt.isoformat()
 
     def __repr__(self):
         return str(self)
 
+# Values that can go in a Set. Python's equality for these types is the
+# same as Ka's, and equal values have equal hashes (1 and 1.0, for
+# example).
+HASHABLE_TYPES = (numbers.Rational, float, Decimal, str, Instant)
+
+def is_hashable(x):
+    return isinstance(x, HASHABLE_TYPES)
+
 def instant_lt(I1, I2): return I1.dt < I2.dt
 def instant_leq(I1, I2): return I1.dt <= I2.dt
 def instant_gt(I1, I2): return I1.dt > I2.dt
@@ -258,7 +312,7 @@ def instant_minus_instant(i1, i2):
 
 def instant_plus_quantity(inst, q):
     validate_time(q)
-    delta = timedelta(seconds=q.mag)
+    delta = timedelta(seconds=float(q.mag))
     return Instant(inst.dt + delta)
 
 def instant_plus_int(inst, i):
@@ -267,7 +321,7 @@ def instant_plus_int(inst, i):
 
 def instant_minus_quantity(inst, q):
     validate_time(q)
-    delta = timedelta(seconds=q.mag)
+    delta = timedelta(seconds=float(q.mag))
     return Instant(inst.dt - delta)
 
 def instant_minus_int(inst, i):
@@ -1,16 +1,20 @@
 import collections
 from fractions import Fraction as frac
 import math
+import threading
 
 import ka.config
 from .config import ConfigProperties
-from .currency import load_currency_data
+from .currency import load_currency_data, maybe_refresh_rates
+from .suggest import SuggestionIndex
 
 QUANTITY_TO_QV = {} # <-- this is used only to check for mistakes
 QV_TO_QUANTITY = collections.defaultdict(list)
 NAME_TO_UNIT = {}
 SYMBOL_TO_UNIT = {}
 UNITS = []
+# Names and symbols of units, for suggesting alternatives to unknown ones.
+UNIT_NAME_INDEX = SuggestionIndex()
 
 class Prefix:
     def __init__(self, name_prefix, symbol_prefix, exp, base=10):
@@ -62,6 +66,19 @@ def lookup_unit(name):
         return NAME_TO_UNIT[name]
     if name in SYMBOL_TO_UNIT:
         return SYMBOL_TO_UNIT[name]
+    if not CURRENCIES_LOADED and looks_like_currency_code(name):
+        # Load before trying prefixes, otherwise something like "php"
+        # (Philippine peso) would be read as pico-horsepower.
+        load_currencies()
+        return lookup_unit(name)
+    unit = lookup_prefixed_unit(name)
+    if unit is None and not CURRENCIES_LOADED:
+        # Could be one of the longer currency names, like "euro".
+        load_currencies()
+        return lookup_unit(name)
+    return unit
+
+def lookup_prefixed_unit(name):
     for prefix in PREFIXES:
         unprefixed = name[len(prefix.name_prefix):]
         if name.startswith(prefix.name_prefix) and unprefixed in NAME_TO_UNIT:
@@ -71,6 +88,22 @@ def lookup_unit(name):
             return apply_prefix(prefix, SYMBOL_TO_UNIT[unprefixed])
     return None
 
+def suggest_units(name):
+    """Names or symbols of units that are like `name`, possibly with
+    the same prefix, e.g. "kilometre" for "kilometr"."""
+    suggestions = UNIT_NAME_INDEX.suggest(name)
+    if suggestions:
+        return suggestions
+    for prefix in PREFIXES:
+        if name.startswith(prefix.name_prefix):
+            unprefixed = name[len(prefix.name_prefix):]
+            suggestions = [prefix.name_prefix + s
+                           for s in UNIT_NAME_INDEX.suggest(unprefixed)
+                           if s in NAME_TO_UNIT]
+            if suggestions:
+                return suggestions
+    return []
+
 def apply_prefix(prefix, unit):
     # Don't need to update any of the other unit data besides
     # the multiple, since the other stuff won't be used anywhere.
@@ -208,10 +241,13 @@ def register_unit(symbol, singular_name, quantities, quantity_vector,
     assert symbol not in SYMBOL_TO_UNIT
     NAME_TO_UNIT[singular_name] = unit
     SYMBOL_TO_UNIT[symbol] = unit
+    UNIT_NAME_INDEX.add(singular_name)
+    UNIT_NAME_INDEX.add(symbol)
 
     if plural_name != Unit.NO_PLURAL:
         assert plural_name not in NAME_TO_UNIT
         NAME_TO_UNIT[plural_name] = unit
+        UNIT_NAME_INDEX.add(plural_name)
 
     # return this so that it can be reused when
     # defining other units.
@@ -225,21 +261,17 @@ def register_derived_unit(symbol, singular_name, base_unit, multiple=1, plural_n
                          plural_name=plural_name)
 
 DEFAULT_BASE_CURRENCY = "eur"
-CURRENCY_DATA = load_currency_data()
+# The currency data isn't read until a currency is actually used (see
+# `load_currencies`), so at this point we have to trust the config. If it
+# turns out that the base currency doesn't exist, the cash dimension gets
+# renamed when the currencies are loaded.
 BASE_CURRENCY = ka.config.get(ConfigProperties.BASE_CURRENCY)
 def has_currency(sym, currency_data):
     return any(c.symbol == sym for c in currency_data)
-if not has_currency(BASE_CURRENCY, CURRENCY_DATA):
-    if has_currency(DEFAULT_BASE_CURRENCY, CURRENCY_DATA):
-        BASE_CURRENCY = DEFAULT_BASE_CURRENCY
-    else:
-        BASE_CURRENCY = None
 
 ## Here's the "space" based on the base units we wanna use.
 ## All quantities exist within this space.
-BASE_UNITS = ["kg", "m", "s", "A", "K", "mol", "cd"]
-if BASE_CURRENCY is not None:
-    BASE_UNITS.append(BASE_CURRENCY)
+BASE_UNITS = ["kg", "m", "s", "A", "K", "mol", "cd", BASE_CURRENCY]
 QSPACE = QuantitySpace(BASE_UNITS)
 KG = QSPACE.get_basis_vector("kg")
 M = QSPACE.get_basis_vector("m")
@@ -377,9 +409,41 @@ SPECIAL_NAMES = {
     "jpy": "yen",
 }
 
-if BASE_CURRENCY is not None:
-    CASH = QSPACE.get_basis_vector(BASE_CURRENCY)
-    base = next(c for c in CURRENCY_DATA if c.symbol == BASE_CURRENCY)
+CASH = QSPACE.get_basis_vector(BASE_CURRENCY)
+CURRENCIES_LOADED = False
+# Currency code -> the units registered for it (there can be more than
+# one, e.g. "usd" and "$"), so that their rates can be updated later.
+CURRENCY_UNITS = {}
+CURRENCY_LOCK = threading.RLock()
+
+def load_currencies():
+    """Registers the currency units, if they haven't been registered yet.
+    Reading the exchange rates and registering ~170 extra units is a
+    noticeable chunk of start-up time, so this is put off until a currency
+    is actually needed. If the rates on disk are out of date, new ones
+    are fetched in the background and swapped in when they arrive."""
+    global CURRENCIES_LOADED, BASE_CURRENCY
+    with CURRENCY_LOCK:
+        if CURRENCIES_LOADED:
+            return
+        CURRENCIES_LOADED = True
+        currency_data = load_currency_data()
+        if not has_currency(BASE_CURRENCY, currency_data):
+            if not has_currency(DEFAULT_BASE_CURRENCY, currency_data):
+                return
+            BASE_CURRENCY = DEFAULT_BASE_CURRENCY
+            # Every QuantityVector shares this list of names, so this renames
+            # the cash dimension everywhere.
+            BASE_UNITS[-1] = BASE_CURRENCY
+        update_currency_rates(currency_data)
+    maybe_refresh_rates(update_currency_rates)
+
+def currency_multiples(currency_data):
+    """Returns a dict of currency code -> multiple, where the multiple
+    is relative to the base currency."""
+    base = next((c for c in currency_data if c.symbol == BASE_CURRENCY), None)
+    if base is None:
+        return None
     # Rates say how much of the currency each dollar is worth:
     #   c_to_dollar = currency/dollar
     # We want to convert that to how much of the currency each base
@@ -391,20 +455,47 @@ if BASE_CURRENCY is not None:
     #   c_to_base = base_to_dollar/c_to_dollar
     #             = (base/dollar)/(currency/dollar)
     #             = base/currency
-    for c in CURRENCY_DATA:
-        mul = base.dollar_rate/c.dollar_rate
-        if c.name in NAME_TO_UNIT and c.symbol in SYMBOL_TO_UNIT:
-            # I found that some currencies have duplicate names.
-            # E.g. there are two Venezuelan currencies with the
-            # same name, but different symbols. Also, some currency
-            # symbols clash with existing units (Cuban peso = "cup").
-            # So we try to handle that as elegantly as possible.
-            continue
-        name = c.symbol if c.name in NAME_TO_UNIT else c.name
-        sym = c.name if c.symbol in SYMBOL_TO_UNIT else c.symbol
-        if sym in SPECIAL_NAMES:
-            name = SPECIAL_NAMES[sym]
-        register_unit(sym, name, "cash", CASH, multiple=mul)
-        if sym in SPECIAL_CURRENCY_SYMBOLS:
-            special_sym = SPECIAL_CURRENCY_SYMBOLS[sym]
-            register_unit(special_sym, special_sym, "cash", CASH, multiple=mul)
+    return dict((c.symbol, base.dollar_rate/c.dollar_rate)
+                for c in currency_data)
+
+def update_currency_rates(currency_data):
+    """Sets the multiples of the currency units based on the given rates,
+    registering units for any currencies we haven't seen before. Expressions
+    evaluated after this returns use the new rates. Rates that don't
+    include the base currency are ignored."""
+    multiples = currency_multiples(currency_data)
+    if multiples is None:
+        return
+    with CURRENCY_LOCK:
+        for c in currency_data:
+            mul = multiples[c.symbol]
+            if c.symbol in CURRENCY_UNITS:
+                for unit in CURRENCY_UNITS[c.symbol]:
+                    unit.multiple = mul
+            else:
+                register_currency(c, mul)
+
+def register_currency(c, mul):
+    if c.name in NAME_TO_UNIT and c.symbol in SYMBOL_TO_UNIT:
+        # I found that some currencies have duplicate names.
+        # E.g. there are two Venezuelan currencies with the
+        # same name, but different symbols. Also, some currency
+        # symbols clash with existing units (Cuban peso = "cup").
+        # So we try to handle that as elegantly as possible.
+        return
+    name = c.symbol if c.name in NAME_TO_UNIT else c.name
+    sym = c.name if c.symbol in SYMBOL_TO_UNIT else c.symbol
+    if sym in SPECIAL_NAMES:
+        name = SPECIAL_NAMES[sym]
+    units = [register_unit(sym, name, "cash", CASH, multiple=mul)]
+    if sym in SPECIAL_CURRENCY_SYMBOLS:
+        special_sym = SPECIAL_CURRENCY_SYMBOLS[sym]
+        units.append(register_unit(special_sym, special_sym, "cash", CASH,
+                                   multiple=mul))
+    CURRENCY_UNITS[c.symbol] = units
+
+def looks_like_currency_code(name):
+    """Whether a name has the shape of an ISO-4217 code (like "usd") or
+    is one of the special currency symbols."""
+    return ((len(name) == 3 and name.isalpha() and name.islower())
+            or name in SPECIAL_CURRENCY_SYMBOLS.values())
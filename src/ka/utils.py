@@ -1,3 +1,4 @@
+import collections
 import math
 from .types import Combinatoric, IntRange
 
@@ -14,20 +15,51 @@ def separate_kwargs(kwargs, selected_keys):
 def _g(d, k, default=None):
     return d.get(k, default)
 
-def choose(n, k):
-    if k > n or n < 0 or k < 0:
-        return 0
+class ResultCache:
+    """Results of function calls, up to a maximum number of them. When
+    it's full, the least recently used result is forgotten."""
+    MISSING = object()
+
+    def __init__(self, size):
+        self.size = size
+        self.results = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """The result for `key`, or MISSING."""
+        result = self.results.get(key, ResultCache.MISSING)
+        if result is ResultCache.MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.results.move_to_end(key)
+        return result
+
+    def put(self, key, result):
+        self.results[key] = result
+        self.shrink()
 
-    M = n + 1
-    nterms = min(k, n - k)
+    def resize(self, size):
+        self.size = size
+        self.shrink()
 
-    numerator = 1
-    denominator = 1
-    for j in range(1, nterms + 1):
-        numerator *= M - j
-        denominator *= j
+    def shrink(self):
+        while len(self.results) > self.size:
+            self.results.popitem(last=False)
 
-    return numerator // denominator
+    def clear(self):
+        self.results.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.results)
+
+def choose(n, k):
+    if k > n or n < 0 or k < 0:
+        return 0
+    return math.comb(n, k)
 
 def lazy_choose(n, k):
     if k > n or n < 0 or k < 0:
@@ -0,0 +1,65 @@
+from fractions import Fraction as frac
+
+import pytest
+
+import ka.binning
+from ka.binning import bin_edges, bin_counts, BinningError
+from ka.tokens import tokenise
+from ka.parse import parse_tokens
+from ka.eval import eval_parse_tree
+from ka.types import Array, KaRuntimeError
+from ka.functions import BadTypeKeywordError
+
+def run(s):
+    return eval_parse_tree(parse_tokens(tokenise(s)))
+
+@pytest.fixture(params=["numpy", "bisect"])
+def engine(request, monkeypatch):
+    if request.param == "numpy":
+        if not ka.binning.load_numpy():
+            pytest.skip("NumPy isn't installed.")
+    else:
+        monkeypatch.setattr(ka.binning, "np", False)
+
+def test_edges_from_width():
+    assert bin_edges([0, 10], bin_width=5) == [0, 5, 10, 15]
+    assert bin_edges([3, 9], bin_width=5) == [0, 5, 10]
+    # Start moves back to cover the smallest value.
+    assert bin_edges([-7, 2], bin_width=5) == [-10, -5, 0, 5]
+    assert bin_edges([2, 3], bin_width=1, start=frac(1, 2)) == [frac(1, 2), frac(3, 2), frac(5, 2), frac(7, 2)]
+
+def test_edges_from_count():
+    assert bin_edges([0, 10], num_bins=4) == [0, 2.5, 5, 7.5, 10]
+    assert bin_edges([1, 1], num_bins=1) == [0.5, 1.5]
+
+def test_bad_bins():
+    with pytest.raises(BinningError):
+        bin_edges([], num_bins=3)
+    with pytest.raises(BinningError):
+        bin_edges([1], num_bins=0)
+    with pytest.raises(BinningError):
+        bin_edges([1], bin_width=-1)
+
+def test_counts(engine):
+    xs = [0, 1, 1.5, 2, 2, 5, 9.99, 10]
+    assert bin_counts(xs, [0, 2.5, 5, 7.5, 10]) == [5, 0, 1, 2]
+    # Values outside the bins are left out.
+    assert bin_counts([-1, 0, 3, 4], [0, 1, 2, 3]) == [1, 0, 1]
+
+def test_counts_of_fractions(engine):
+    assert bin_counts([frac(1, 3), frac(1, 2), 1], [0, frac(1, 2), 1]) == [1, 2]
+
+def test_counts_function(engine):
+    assert run("counts({1, 2, 2, 3}, bin_width: 1, start: 1)") == Array(
+        [Array([1, 2, 3, 4]), Array([1, 2, 1])])
+    assert run("counts({1, 2, 2, 3}, bin_width: 1, cumulative: true, normalise: true)") == Array(
+        [Array([0, 1, 2, 3, 4]), Array([0, frac(1, 4), frac(3, 4), 1])])
+    edges, counts = run("counts(sample(Uniform(0, 1), 10000), num_bins: 5)").contents
+    assert len(edges) == 6
+    assert sum(counts) == 10000
+    with pytest.raises(KaRuntimeError):
+        run("counts({}, num_bins: 5)")
+    with pytest.raises(BadTypeKeywordError):
+        run("counts({1, 2, 3}, num_bins: 2.5)")
+    with pytest.raises(KaRuntimeError, match="Tried to count"):
+        run("counts({1, \"a\"})")
@@ -0,0 +1,66 @@
+import io
+
+import ka.cli
+import ka.config
+from ka.cli import stream_script, run_script
+from ka.scriptcache import cache_path
+
+def run(script, print_all=False):
+    out = io.StringIO()
+    err = io.StringIO()
+    status = stream_script(io.StringIO(script), print_all=print_all,
+                           out=out, errout=err)
+    return status, out.getvalue(), err.getvalue()
+
+def test_stream_script():
+    script = "x = 2;\ny = x^10;\ny/4;\nsum({k : k in 1..y})"
+    assert run(script) == (0, "524800\n", "")
+    assert run(script, print_all=True) == (0, "256\n524800\n", "")
+    assert run("x = 1") == (0, "1\n", "")
+    assert run("") == (0, "", "")
+
+def test_stream_script_error():
+    status, out, err = run("x = 2;\n\ny = x +;\nx")
+    assert status == 1
+    assert out == ""
+    assert err.startswith("Error on line 3:\nUnexpected token.")
+
+def run_file(path, **kwargs):
+    out = io.StringIO()
+    status = run_script(path, out=out, errout=out, **kwargs)
+    return status, out.getvalue()
+
+def test_script_cache(tmp_path, monkeypatch):
+    script = tmp_path.joinpath("script.ka")
+    script.write_text("x = 3; x^2")
+    assert run_file(script) == (0, "9\n")
+    assert cache_path(script) == tmp_path.joinpath("__kacache__", "script.ka.kac")
+    assert cache_path(script).exists()
+    # Not parsed again.
+    def fail(s, errout):
+        raise AssertionError("Parsed " + s)
+    monkeypatch.setattr(ka.cli, "compile_source", fail)
+    assert run_file(script) == (0, "9\n")
+    monkeypatch.undo()
+    # A changed script is parsed again.
+    script.write_text("x = 4; x^2")
+    assert run_file(script) == (0, "16\n")
+    cache_path(script).write_bytes(b"garbage")
+    assert run_file(script) == (0, "16\n")
+
+def test_script_cache_is_optional(tmp_path):
+    script = tmp_path.joinpath("script.ka")
+    script.write_text("1 +")
+    assert run_file(script)[0] == 1
+    script.write_text("1 + 1")
+    assert run_file(script, use_cache=False) == (0, "2\n")
+    assert not cache_path(script).exists()
+
+def test_scripts_are_limited(tmp_path, monkeypatch):
+    monkeypatch.setitem(ka.config.CONFIG, "max-steps", 1000)
+    script = tmp_path.joinpath("script.ka")
+    script.write_text("sum({x : x in 1..100000})")
+    for kwargs in [{}, {"use_cache": False}, {"stream": True}]:
+        status, out = run_file(script, **kwargs)
+        assert status == 1
+        assert "maximum of 1000 steps" in out
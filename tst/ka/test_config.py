@@ -0,0 +1,13 @@
+import ka.config
+from ka.config import read_config, ConfigProperties
+
+def test_read_config(tmp_path, monkeypatch):
+    monkeypatch.setattr(ka.config, "CONFIG", {})
+    monkeypatch.setattr(ka.config, "HAVE_READ", False)
+    path = tmp_path / "config"
+    path.write_text("currency-source = https://example.com/rates?base=USD&x=1\n"
+                    "max-steps=100\n")
+    read_config(path)
+    assert (ka.config.get(ConfigProperties.CURRENCY_SOURCE)
+            == "https://example.com/rates?base=USD&x=1")
+    assert ka.config.get(ConfigProperties.MAX_STEPS) == 100
@@ -0,0 +1,113 @@
+import http.server
+import os
+import threading
+import time
+
+import pytest
+
+from ka.currency import (CurrencyData, parse_currency_data, store_rates_to,
+                         rates_are_stale, make_rate_provider, FileRateProvider,
+                         HttpRateProvider, ScrapingRateProvider,
+                         maybe_refresh_rates)
+import ka.currency
+import ka.units
+from ka.units import lookup_unit, load_currencies, update_currency_rates
+
+RATES = [
+    CurrencyData("usd", "usdollar", 1.0),
+    CurrencyData("eur", "euro", 0.5),
+    CurrencyData("gbp", "britishpound", 0.25),
+]
+RATES_TEXT = "usd,usdollar,1.0\neur,euro,0.5\ngbp,britishpound,0.25"
+
+def test_parse_skips_blank_lines():
+    parsed = parse_currency_data(RATES_TEXT + "\n\n")
+    assert [c.symbol for c in parsed] == ["usd", "eur", "gbp"]
+    assert parsed[2].dollar_rate == 0.25
+
+def test_store_rates_round_trips(tmp_path):
+    path = tmp_path / "sub" / "currency"
+    store_rates_to(path, RATES)
+    assert parse_currency_data(path.read_text()) == RATES
+    # Temporary file shouldn't be left lying around.
+    assert os.listdir(tmp_path / "sub") == ["currency"]
+
+def test_staleness(tmp_path):
+    path = tmp_path / "currency"
+    assert rates_are_stale(path, 24)
+    store_rates_to(path, RATES)
+    assert not rates_are_stale(path, 24)
+    old = time.time() - 25*3600
+    os.utime(path, (old, old))
+    assert rates_are_stale(path, 24)
+
+def test_make_rate_provider(tmp_path):
+    assert make_rate_provider("") is None
+    assert isinstance(make_rate_provider("xe"), ScrapingRateProvider)
+    assert isinstance(make_rate_provider("http://localhost/x"), HttpRateProvider)
+    p = make_rate_provider("file:" + str(tmp_path / "rates"))
+    assert isinstance(p, FileRateProvider)
+    assert p.path == str(tmp_path / "rates")
+
+class RatesHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = RATES_TEXT.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def rates_server():
+    server = http.server.HTTPServer(("127.0.0.1", 0), RatesHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/rates"
+    server.shutdown()
+    server.server_close()
+
+def test_http_provider(rates_server):
+    assert make_rate_provider(rates_server).fetch() == RATES
+
+def test_background_refresh(tmp_path, rates_server, monkeypatch):
+    path = tmp_path / "currency"
+    # Not for one-off commands.
+    assert maybe_refresh_rates(lambda cs: None, source=rates_server,
+                               path=path, max_age_hours=24) is None
+    monkeypatch.setattr(ka.currency, "REFRESH_IN_BACKGROUND", True)
+    received = []
+    thread = maybe_refresh_rates(received.append, source=rates_server,
+                                 path=path, max_age_hours=24)
+    assert thread is not None
+    thread.join(5)
+    assert received == [RATES]
+    assert parse_currency_data(path.read_text()) == RATES
+    # Now that the file is fresh, there's nothing to do.
+    assert maybe_refresh_rates(received.append, source=rates_server,
+                               path=path, max_age_hours=24) is None
+
+def test_no_refresh_without_source(tmp_path, monkeypatch):
+    monkeypatch.setattr(ka.currency, "REFRESH_IN_BACKGROUND", True)
+    assert maybe_refresh_rates(lambda cs: None, source="",
+                               path=tmp_path / "currency",
+                               max_age_hours=24) is None
+
+def test_new_rates_swap_into_units():
+    load_currencies()
+    gbp = lookup_unit("gbp")
+    old = dict((sym, [u.multiple for u in units])
+               for sym, units in ka.units.CURRENCY_UNITS.items())
+    base = ka.units.BASE_CURRENCY
+    try:
+        update_currency_rates([
+            CurrencyData(base, "base", 1.0),
+            CurrencyData("gbp", "britishpound", 4.0)])
+        assert gbp.multiple == 0.25
+        assert lookup_unit("£").multiple == 0.25
+    finally:
+        for sym, muls in old.items():
+            for u, mul in zip(ka.units.CURRENCY_UNITS[sym], muls):
+                u.multiple = mul
@@ -0,0 +1,62 @@
+import io
+
+import ka.config
+from ka.eval import EvalEnvironment
+from ka.interpret import execute, recompute
+
+def run(env, *commands):
+    out = io.StringIO()
+    for s in commands:
+        execute(s, env, out=out, errout=out)
+    return out.getvalue()
+
+def recomputed(env):
+    out = io.StringIO()
+    recompute(env, out=out, errout=out)
+    return out.getvalue()
+
+def test_only_dependents_are_recomputed():
+    env = EvalEnvironment()
+    run(env, "p = 1/2", "n = 10", "q = p*n", "n*2", "r = q + 1",
+        "{i*p : i in 1..3}", "p = 1")
+    assert recomputed(env) == "\n".join([
+        "  q = p*n", "10",
+        "  r = q + 1", "11",
+        "  {i*p : i in 1..3}", "{1, 2, 3}", ""])
+    assert recomputed(env) == ""
+    assert env.get_variable("r") == 11
+
+def test_dependency_order():
+    env = EvalEnvironment()
+    # r was computed from the q before this one.
+    run(env, "p = 1", "q = 1", "r = q + 1", "q = p*2", "p = 3")
+    assert recomputed(env) == "\n".join([
+        "  q = p*2", "6",
+        "  r = q + 1", "7", ""])
+
+def test_commands_that_update_a_variable_are_not_rerun():
+    env = EvalEnvironment()
+    run(env, "p = 1", "x = 1", "x = x + p", "p = 2")
+    assert recomputed(env) == ""
+    assert env.get_variable("x") == 2
+
+def test_overridden_commands_are_not_rerun():
+    env = EvalEnvironment()
+    run(env, "p = 1", "x = p", "x = 5", "p = 2")
+    assert recomputed(env) == ""
+    assert env.get_variable("x") == 5
+
+def test_failed_commands_count_as_assignments():
+    env = EvalEnvironment()
+    run(env, "p = 1", "q = p*2", "p = 3; 1/0")
+    assert recomputed(env) == "  q = p*2\n6\n"
+
+def test_unassigned_variables():
+    env = EvalEnvironment()
+    run(env, "y = z + 1", "z = 2")
+    assert recomputed(env) == "  y = z + 1\n3\n"
+
+def test_auto_recompute(monkeypatch):
+    monkeypatch.setitem(ka.config.CONFIG, "auto-recompute", True)
+    env = EvalEnvironment()
+    assert run(env, "p = 1", "q = p + 1", "p = 2") == "1\n2\n2\n  q = p + 1\n3\n"
@@ -4,28 +4,30 @@ from fractions import Fraction as frac
 import pytest
 
 from ka.tokens import tokenise
-from ka.functions import UnknownFunctionError, NoMatchingFunctionSignatureError
+from ka.functions import (UnknownFunctionError, NoMatchingFunctionSignatureError,
+    IncompatibleQuantitiesError, FunctionArgError,
+    PURE_RESULTS, PRIMITIVE_OPS, call_primitive_op, dispatch)
 from ka.parse import parse_tokens, ParsingError
-from ka.eval import eval_parse_tree, EvalError
+from ka.eval import eval_parse_tree, EvalError, EvalEnvironment
 from ka.types import (Quantity, Array, Interval, KaRuntimeError,
-    instant_from_iso)
+    instant_from_iso, Set)
 from ka.units import M, S, K
 
-def validate_result(s, expected):
-    assert expected == get_result(s)
+def validate_result(s, expected, env=None):
+    assert expected == get_result(s, env)
 
-def get_result(s):
+def get_result(s, env=None):
     tokens = tokenise(s)
     tree = parse_tokens(tokens)
-    return eval_parse_tree(tree)
+    return eval_parse_tree(tree, env)
 
-def validate_results(cases):
+def validate_results(cases, env=None):
     for s, expected in cases:
-        validate_result(s, expected)
+        validate_result(s, expected, env)
 
-def validate_fail(s, error_type=EvalError):
+def validate_fail(s, error_type=EvalError, env=None):
     with pytest.raises(error_type):
-        eval_parse_tree(parse_tokens(tokenise(s)))
+        eval_parse_tree(parse_tokens(tokenise(s)), env)
 
 def test_empty():
     validate_result("", None)
@@ -36,6 +38,30 @@ def test_arithmetic():
 def test_associativity():
     validate_result("2*3%2", 0)
 
+def test_primitive_ops_match_dispatch():
+    values = [0, 3, -2, 2.5, -0.5, 4.0, frac(1, 2), frac(-7, 3)]
+    for name in PRIMITIVE_OPS:
+        for x in values:
+            for y in values:
+                try:
+                    expected = dispatch(name, (x, y))
+                except (ZeroDivisionError, KaRuntimeError) as e:
+                    with pytest.raises(type(e)):
+                        call_primitive_op(name, x, y)
+                    continue
+                result = call_primitive_op(name, x, y)
+                assert (type(result), result) == (type(expected), expected)
+
+def test_primitive_ops_in_expressions():
+    validate_results([
+        ("1/2 + 1/2", 1),
+        ("{i/2 : i in 1..3}", Array([frac(1, 2), 1, frac(3, 2)])),
+        ("2^-1", 0.5),
+        ("(1/2)^2 < 1/3", 1),
+        ("1.5*2 == 3", 1),
+    ])
+    validate_fail("(-8)^(1/3)", KaRuntimeError)
+
 def test_variables():
     validate_result("x=3;5*x", 15)
 
@@ -195,12 +221,83 @@ def test_array():
                 Array([])]))
     ])
 
+def test_array_reductions():
+    validate_results([
+        ("sum({})", 0),
+        ("prod({})", 1),
+        ("sum(1..100)", 5050),
+        ("prod(1..5)", 120),
+        ("sum({1/3, 1/6})", frac(1, 2)),
+        ("sum({1/3, 2/3, 1})", 2),
+        ("sum({0.1 : i in 1..10})", 1),
+        ("sum({1/2, 0.25})", 0.75),
+        ("prod({1/2, 4})", 2),
+        # Floats that become whole numbers are exact again.
+        ("prod({0.5, 2, 1/3})", frac(1, 3)),
+        ("sum({0.5, 0.5, 1/3})", frac(4, 3)),
+        ("sum({1.5m, 0.5m, (1/3) m})", Quantity(frac(7, 3), M)),
+        ("min({3, 1/2, 0.75})", frac(1, 2)),
+        ("max({3, 1/2, 3.5})", 3.5),
+        ("mean({1, 2})", frac(3, 2)),
+        ("sum({1m, 2km})", Quantity(2001, M)),
+        ("max({1m, 2km})", Quantity(2000, M)),
+        ("min({5s, 1 minute})", Quantity(5, S)),
+        ("mean({1m, 2m})", Quantity(frac(3, 2), M)),
+        ("prod({2m, 3s})", Quantity(6, M*S)),
+        ("sum({[1,2], 3})", Interval(4, 5)),
+        ("min({[1,2], 3})", Interval(1, 2)),
+    ])
+    validate_fail("sum({1m, 2s})", IncompatibleQuantitiesError)
+    validate_fail("min({})", FunctionArgError)
+
+def test_quantity_divided_by_number():
+    validate_results([
+        ("3m / 2", Quantity(frac(3, 2), M)),
+        ("3m - 1m", Quantity(2, M)),
+    ])
+
 def test_array_with_conditions():
     validate_results([
         ("{x:x in 1..3}", Array([1,2,3])),
         ("{x:x in 1..2, x <= 2}", Array([1,2])),
     ])
 
+def test_sets():
+    validate_results([
+        ("set()", Set({})),
+        ("set({1, 2, 1.0, 2/2})", Set.from_values([1, 2])),
+        ("size(set({\"a\", \"b\", \"a\"}))", 2),
+        ("2 in set({1, 2})", 1),
+        ("1/2 in set({0.5})", 1),
+        ("3 in set({1, 2})", 0),
+        ("#2020-01-01# in set({#2020-01-01#})", 1),
+        ("union(set({1, 2}), set({2, 3}))", Set.from_values([1, 2, 3])),
+        ("intersection(set({1, 2, 3}), set({2, 3, 4}))", Set.from_values([2, 3])),
+        ("difference(set({1, 2, 3}), set({2}))", Set.from_values([1, 3])),
+        ("set({1, 2}) == set({2, 1})", 1),
+        ("array(set({3, 1}))", Array([3, 1])),
+        ("{x^2 : x in set({1, 2})}", Array([1, 4])),
+    ])
+    validate_fail("set({1 m})", FunctionArgError)
+
+def test_comprehension_membership():
+    validate_results([
+        ("ys = {2, 4}; {x : x in 1..5, (x in ys)}", Array([2, 4])),
+        ("{x : x in 1..5, (x in {2, 4})}", Array([2, 4])),
+        ("{x : x in 1..5, (x in set({2, 4}))}", Array([2, 4])),
+        ("ys = {\"a\"}; {x : x in {\"a\", \"b\"}, (x in ys)}", Array(["a"])),
+        # Not loop-invariant, so evaluated every time.
+        ("{x : x in 1..3, (x in {x})}", Array([1, 2, 3])),
+        ("{x : x in 1..3, (1 m in {x m})}", Array([1])),
+    ])
+
+def test_string_equality():
+    validate_results([
+        ("\"a\" == \"a\"", 1),
+        ("\"a\" != \"b\"", 1),
+        ("\"a\" in {\"b\", \"a\"}", True),
+    ])
+
 def test_comparison():
     validate_results([
         ("1 == 1", 1),
@@ -288,3 +385,78 @@ def test_bad_interval_expressions():
     for s in ["sqrt([-1, 1])", "log([0, 5], 7)",
               "log2([-0.1, 100])", "[-2, 4]^-0.2"]:
         validate_fail(s, KaRuntimeError)
+
+def test_user_functions():
+    env = EvalEnvironment()
+    validate_results([
+        ("f(x) = x^2 + 1; f(3)", 10),
+        ("f(x) = x^2 + 1; {f(i) : i in 1..3}", Array([2, 5, 10])),
+        ("x = 10; f(x) = x+1; f(1); x", 10),
+        ("g(x, y) = x*y + c; c = 1; g(2, 3)", 7),
+        ("h() = 5; h()", 5),
+        # Overloaded on the number of parameters.
+        ("k(x) = 1; k(x, y) = 2; k(0) + k(0, 0)", 3),
+        ("k(x) = 3; k(0) + k(0, 0)", 5),
+    ], env)
+    validate_fail("sin(x) = 1", KaRuntimeError)
+    validate_fail("f(x) = x; f(1, 2)", NoMatchingFunctionSignatureError)
+
+def test_user_functions_belong_to_their_environment():
+    env = EvalEnvironment()
+    validate_result("y = 10; f(x) = x + y; f(1)", 11, env)
+    other = EvalEnvironment()
+    validate_fail("y = 100; f(1)", UnknownFunctionError, other)
+    validate_result("f(x) = x + y; f(1)", 101, other)
+    validate_result("f(1)", 11, env)
+    validate_fail("f(1)", UnknownFunctionError)
+
+def test_deep_recursion():
+    validate_result("f(n) = if(n < 1, 0, f(n-1) + 1); f(5000)", 5000)
+    validate_result(
+        "f(n) = if(n < 1, 0, sum({max({f(n-1), 0}) : i in 1..1}) + 1); f(2000)",
+        2000)
+    validate_fail("f(x) = f(x); f(1)", EvalError)
+    validate_fail("f(n) = if(n < 1, 0, f(n-1) + 1); f(20000)", EvalError)
+
+def test_if():
+    validate_results([
+        ("if(1, 2, 3)", 2),
+        ("if(0, 2, 3)", 3),
+        ("if(1 < 2, 2, 1/0)", 2),
+        ("if(0, 1/0, 3)", 3),
+    ])
+    validate_fail("if(1, 2)")
+    validate_fail("if({1}, 2, 3)")
+
+def test_memoize():
+    env = EvalEnvironment()
+    validate_results([
+        ("fib(n) = if(n < 2, n, fib(n-1) + fib(n-2)); fib(15)", 610),
+        ('memoize("fib"); fib(200)', 280571172992510140037611932413038677189525),
+        # Still memoized after being redefined.
+        ("fib(n) = if(n < 2, 1, fib(n-1) + fib(n-2)); fib(200)",
+         453973694165307953197296969697410619233826),
+        ('f(x) = x/2; memoize("f", size: 2); {f(1), f(1.0), f(2), f(1)}',
+         Array([frac(1, 2), 0.5, 1, frac(1, 2)])),
+    ], env)
+    validate_fail('memoize("sin")', FunctionArgError)
+    validate_fail('f(x) = x; memoize("f", size: 0)', FunctionArgError)
+
+@pytest.fixture
+def pure_results():
+    PURE_RESULTS.clear()
+    yield PURE_RESULTS
+    PURE_RESULTS.clear()
+
+def test_pure_function_results_are_cached(pure_results):
+    validate_result("{ln(2) : i in 1..4}", Array([math.log(2)]*4))
+    assert (pure_results.hits, pure_results.misses) == (3, 1)
+    validate_result("{sqrt(4), sqrt(4), C(5, 2), C(5, 2)}",
+                    Array([2, 2, 10, 10]))
+    assert (pure_results.hits, pure_results.misses) == (5, 3)
+
+def test_impure_functions_are_not_cached(pure_results):
+    result = get_result("{rand() : i in 1..10}")
+    assert len(set(result)) > 1
+    get_result("sin(2 m)")
+    assert (pure_results.hits, pure_results.misses, len(pure_results)) == (0, 0, 0)
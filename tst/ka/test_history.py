@@ -0,0 +1,98 @@
+import os
+
+from ka.history import HistoryStore, read_tail_lines
+import ka.history
+
+def write(path, lines):
+    path.write_text("".join(line + "\n" for line in lines))
+
+def test_load_dedups_keeping_latest(tmp_path):
+    path = tmp_path / "history"
+    write(path, ["a", "b", "", "a", "c"])
+    h = HistoryStore(path, 10)
+    assert h.entries() == ["b", "a", "c"]
+
+def test_load_is_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(ka.history, "READ_BLOCK_SIZE", 16)
+    path = tmp_path / "history"
+    write(path, [f"cmd{i}" for i in range(1000)])
+    lines, size = read_tail_lines(path, 5)
+    assert lines == ["cmd995", "cmd996", "cmd997", "cmd998", "cmd999"]
+    assert size == os.path.getsize(path)
+    assert HistoryStore(path, 5).entries() == lines
+
+def test_lines_spanning_blocks(tmp_path, monkeypatch):
+    monkeypatch.setattr(ka.history, "READ_BLOCK_SIZE", 3)
+    path = tmp_path / "history"
+    write(path, ["first command", "x = 1", "sqrt(x)"])
+    assert HistoryStore(path, 10).entries() == ["first command", "x = 1", "sqrt(x)"]
+
+def test_add_and_save_appends(tmp_path):
+    path = tmp_path / "sub" / "history"
+    h = HistoryStore(path, 10)
+    h.add("1+1")
+    h.add("  ")
+    h.add("2+2")
+    h.save()
+    assert path.read_text() == "1+1\n2+2\n"
+    h = HistoryStore(path, 10)
+    h.add("1+1")
+    h.save()
+    assert path.read_text() == "1+1\n2+2\n1+1\n"
+    assert HistoryStore(path, 10).entries() == ["2+2", "1+1"]
+
+def test_save_after_old_format(tmp_path):
+    path = tmp_path / "history"
+    # Files used to be written without a trailing newline.
+    path.write_text("a\nb")
+    h = HistoryStore(path, 10)
+    h.add("c")
+    h.save()
+    assert HistoryStore(path, 10).entries() == ["a", "b", "c"]
+
+def test_compaction(tmp_path):
+    path = tmp_path / "history"
+    write(path, 100*["same"] + ["other"])
+    h = HistoryStore(path, 10)
+    assert h.entries() == ["same", "other"]
+    h.add("new")
+    h.save()
+    assert path.read_text() == "same\nother\nnew\n"
+    assert not [f for f in os.listdir(tmp_path) if f != "history"]
+
+def test_disabled(tmp_path):
+    path = tmp_path / "history"
+    write(path, ["a"])
+    h = HistoryStore(path, 10, enabled=False)
+    assert h.entries() == []
+    h.add("b")
+    h.save()
+    assert path.read_text() == "a\n"
+
+def test_prefix_search(tmp_path):
+    h = HistoryStore(tmp_path / "history", 10)
+    for cmd in ["x = 1", "y = 2", "x = 3", "sqrt(2)", "x + y"]:
+        h.add(cmd)
+    assert h.search_prefix("x") == "x + y"
+    assert h.search_prefix("x", before=h.seq("x + y")) == "x = 3"
+    assert h.search_prefix("x", before=h.seq("x = 3")) == "x = 1"
+    assert h.search_prefix("x", before=h.seq("x = 1")) is None
+    assert h.search_prefix("x", after=h.seq("x = 1")) == "x = 3"
+    assert h.search_prefix("x = ") == "x = 3"
+    assert h.search_prefix("z") is None
+    assert h.search_prefix("") == "x + y"
+
+def test_substring_search(tmp_path):
+    h = HistoryStore(tmp_path / "history", 10)
+    for cmd in ["x = 1", "sqrt(2)", "2*sqrt(x)", "y"]:
+        h.add(cmd)
+    assert h.search_substring("sqrt") == "2*sqrt(x)"
+    assert h.search_substring("sqrt", before=h.seq("2*sqrt(x)")) == "sqrt(2)"
+    assert h.search_substring("nope") is None
+
+def test_bounded_when_adding(tmp_path):
+    h = HistoryStore(tmp_path / "history", 3)
+    for cmd in ["a", "b", "c", "a", "d"]:
+        h.add(cmd)
+    assert h.entries() == ["c", "a", "d"]
+    assert h.search_prefix("b") is None
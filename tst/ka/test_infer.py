@@ -0,0 +1,82 @@
+import math
+
+import pytest
+
+import ka.functions
+from ka.tokens import tokenise
+from ka.functions import FUNCTIONS
+from ka.parse import parse_tokens
+from ka.eval import eval_parse_tree, EvalEnvironment
+from ka.infer import bind_calls, result_type
+from ka.types import Array
+
+def parse(s):
+    return parse_tokens(tokenise(s))
+
+@pytest.fixture
+def resolutions(monkeypatch):
+    """Counts the overloads looked up while calling functions."""
+    calls = []
+    resolve_header = ka.functions.resolve_header
+    def counting_resolve_header(name, args):
+        calls.append(name)
+        return resolve_header(name, args)
+    monkeypatch.setattr(ka.functions, "resolve_header", counting_resolve_header)
+    return calls
+
+def test_calls_with_known_types_are_bound():
+    tree = parse("x = 1.5; sin(2) + x")
+    bind_calls(tree, EvalEnvironment())
+    plus = tree.children[1]
+    assert plus.binding.types == (float, float)
+    assert plus.binding.header in FUNCTIONS["+"]
+    assert plus.children[0].binding.types == (int,)
+    assert plus.children[0].binding.header in FUNCTIONS["sin"]
+
+def test_calls_with_unknown_types_are_not_bound():
+    tree = parse("f(x) = x + 1; y + 1; if(y, 1, 2.5) + 1")
+    bind_calls(tree, EvalEnvironment())
+    for statement in tree.children:
+        assert statement.binding is None
+    assert tree.children[0].children[0].binding is None
+
+def test_variables_have_the_types_of_their_values():
+    env = EvalEnvironment()
+    env.set_variable("y", 2)
+    tree = parse("y + 1")
+    bind_calls(tree, env)
+    assert tree.children[0].binding.types == (int, int)
+
+def test_comprehension_bodies_are_bound(resolutions):
+    result = eval_parse_tree(parse("{C(50, i % 50) : i in 1..200, i > 1}"))
+    assert result == Array([math.comb(50, i % 50) for i in range(2, 201)])
+    assert resolutions == []
+
+def test_wrong_guesses_fall_back_to_dispatch(resolutions):
+    # sqrt(16) is an int, not a float.
+    assert (eval_parse_tree(parse("{sqrt(sqrt(i)) : i in {16, 2}}"))
+            == Array([2, 2**0.25]))
+    # Built-in functions call other functions through `dispatch`.
+    assert resolutions.count("sqrt") == 1
+    assert (eval_parse_tree(parse("{abs(i) : i in {1, -2.5, 3}}"))
+            == Array([1, 2.5, 3]))
+    assert resolutions.count("abs") == 3
+
+def test_redefined_functions_are_not_called():
+    env = EvalEnvironment()
+    eval_parse_tree(parse("f(x) = x + 1; g(n) = {f(i) : i in 1..n}"), env)
+    assert eval_parse_tree(parse("g(3)"), env) == Array([2, 3, 4])
+    eval_parse_tree(parse("f(x) = x * 10"), env)
+    assert eval_parse_tree(parse("g(3)"), env) == Array([10, 20, 30])
+
+@pytest.mark.parametrize("op", ["<", "<=", ">", ">=", "==", "!="])
+def test_comparisons_are_ints(op):
+    assert result_type(op, (int, float)) is int
+    tree = parse(f"(1 {op} 2.5) + 1")
+    bind_calls(tree, EvalEnvironment())
+    assert tree.children[0].binding.types == (int, int)
+    assert eval_parse_tree(tree) in (1, 2)
+
+def test_chained_comparisons_are_ints():
+    assert result_type("<_<=", (int, int, int)) is int
+    assert result_type(">_>=", (int, int, int)) is int
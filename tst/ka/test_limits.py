@@ -0,0 +1,95 @@
+import io
+import threading
+from fractions import Fraction as frac
+
+import pytest
+
+import ka.config
+from ka.tokens import tokenise
+from ka.parse import parse_tokens
+from ka.eval import eval_parse_tree
+from ka.interpret import execute
+from ka.limits import EvalLimits, EvalCancelledError, limits_in_effect
+from ka.types import KaRuntimeError
+
+def evaluate(s, limits):
+    with limits_in_effect(limits):
+        return eval_parse_tree(parse_tokens(tokenise(s)))
+
+def test_no_limits_by_default():
+    assert evaluate("1+2", None) == 3
+
+def test_cancelled_before_starting():
+    limits = EvalLimits()
+    limits.cancel()
+    with pytest.raises(EvalCancelledError):
+        evaluate("1+2", limits)
+
+def test_cancel_from_another_thread():
+    limits = EvalLimits()
+    timer = threading.Timer(0.1, limits.cancel)
+    timer.start()
+    out = io.StringIO()
+    # Would take minutes if it weren't cancelled.
+    status = execute("sample(Gaussian(0,1), 1000000000)",
+                     out=out, errout=out, limits=limits)
+    timer.join()
+    assert status == 1
+    assert out.getvalue().strip() == "Cancelled."
+
+def test_limits_are_restored():
+    limits = EvalLimits()
+    limits.cancel()
+    with pytest.raises(EvalCancelledError):
+        evaluate("1", limits)
+    assert evaluate("1", None) == 1
+
+def test_step_limit():
+    limits = EvalLimits(max_steps=1000)
+    assert evaluate("sum(1..10)", limits) == 55
+    limits = EvalLimits(max_steps=1000)
+    with pytest.raises(KaRuntimeError):
+        evaluate("{k : k in 1..100000000}", limits)
+    with pytest.raises(KaRuntimeError):
+        evaluate("{k^2 : k in range(1, 10^6, 1)}", EvalLimits(max_steps=1000))
+    limits = EvalLimits(max_steps=1000)
+    with pytest.raises(KaRuntimeError), limits_in_effect(limits):
+        evaluate("100000!", limits).resolve()
+
+def test_timeout():
+    out = io.StringIO()
+    status = execute("sample(Gaussian(0,1), 1000000000)",
+                     out=out, errout=out, limits=EvalLimits(timeout=1))
+    assert status == 1
+    assert "time limit" in out.getvalue()
+
+def test_limits_from_config(monkeypatch):
+    monkeypatch.setitem(ka.config.CONFIG, "max-steps", 100)
+    out = io.StringIO()
+    assert execute("{k : k in 1..1000}", out=out, errout=out) == 1
+    assert "maximum of 100 steps" in out.getvalue()
+
+def test_int_bits_limit():
+    limits = EvalLimits(max_int_bits=1000)
+    assert evaluate("2^999", limits) == 2**999
+    assert evaluate("(1/2)^999", limits) == frac(1, 2**999)
+    assert evaluate("2^0.5", limits) == 2**0.5
+    assert evaluate("2^500 * 2^400", limits) == 2**900
+    for s in ["2^(10^9)", "2^1001", "(3/2)^1000", "(1/2)^-2000",
+              "x = 2^999; x*x", "(1/2^600) * (1/2^600)", "{2^999 * 2^999}"]:
+        with pytest.raises(KaRuntimeError):
+            evaluate(s, EvalLimits(max_int_bits=1000))
+
+def test_elements_limit():
+    limits = EvalLimits(max_elements=100)
+    assert evaluate("size(1..100)", limits) == 100
+    # The budget is for the whole evaluation.
+    with pytest.raises(KaRuntimeError):
+        evaluate("size(1..60) + size(1..60)", EvalLimits(max_elements=100))
+    for s in ["1..1000000000",
+              "range(1, 10^9, 1)",
+              "sample(Gaussian(0,1), 10^9)",
+              "{k : k in 1..50, j in 1..50}",
+              "{{j : j in 1..20} : k in 1..20}"]:
+        with pytest.raises(KaRuntimeError):
+            evaluate(s, EvalLimits(max_elements=100))
@@ -41,6 +41,38 @@ def test_parse_assignment():
          t(Tokens.NUM, value=5)],
         pn("x", [pn(5)]))
 
+def test_parse_function_definition():
+    # f(x, y) = x
+    validate_parse(
+        [t(Tokens.VAR, name="f"),
+         t(Tokens.LBRACKET),
+         t(Tokens.VAR, name="x"),
+         t(Tokens.FUNCTION_ARG_SEPARATOR),
+         t(Tokens.VAR, name="y"),
+         t(Tokens.RBRACKET),
+         t(Tokens.ASSIGNMENT_OP),
+         t(Tokens.VAR, name="x")],
+        pn("f", [pn("x")]))
+    # f(x) == 1, a call.
+    validate_parse(
+        [t(Tokens.VAR, name="f"),
+         t(Tokens.LBRACKET),
+         t(Tokens.VAR, name="x"),
+         t(Tokens.RBRACKET),
+         t(Tokens.EQ),
+         t(Tokens.NUM, value=1)],
+        pn("==", [pn("f", [pn("x")]), pn(1)]))
+
+def test_parse_function_definition_with_bad_parameters():
+    # f(1) = 1
+    with pytest.raises(ParsingError):
+        parse_tokens([t(Tokens.VAR, name="f"),
+                      t(Tokens.LBRACKET),
+                      t(Tokens.NUM, value=1),
+                      t(Tokens.RBRACKET),
+                      t(Tokens.ASSIGNMENT_OP),
+                      t(Tokens.NUM, value=1)])
+
 def test_parse_arithmetic():
     validate_parse(
         [t(Tokens.NUM, value=3),
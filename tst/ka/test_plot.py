@@ -0,0 +1,41 @@
+import sys
+
+import pytest
+
+pytest.importorskip("matplotlib")
+
+from ka.tokens import tokenise
+from ka.parse import parse_tokens
+from ka.eval import eval_parse_tree
+from ka.types import KaRuntimeError
+
+PNG_MAGIC = b"\x89PNG"
+
+def run(s):
+    return eval_parse_tree(parse_tokens(tokenise(s)))
+
+def test_plot_to_file(tmp_path):
+    path = tmp_path / "lines.png"
+    run(f'''xs = {{0.2*i : i in 0..20}};
+            plot(options(xticks: {{0, 2, 4}}, yticks: {{-1, 0, 1.5}}, legend: true),
+                 line(xs, {{sin(x) : x in xs}}, label: "sin"),
+                 vline(1), text(1, 1, "hi"),
+                 output: "{path}")''')
+    assert path.read_bytes().startswith(PNG_MAGIC)
+
+def test_save_many(tmp_path):
+    for i in range(5):
+        path = tmp_path / f"hist{i}.png"
+        run(f'save(histogram(sample(Poisson(3), 100), bin_width: 1), "{path}")')
+        assert path.read_bytes().startswith(PNG_MAGIC)
+    path = tmp_path / "scatter.svg"
+    run(f'save(scatter({{1,2,3}}, {{3,1,2}}, title: "x"), "{path}")')
+    assert b"<svg" in path.read_bytes()
+
+def test_doesnt_load_interactive_backend(tmp_path):
+    run(f'save(line({{1,2}}, {{3,4}}), "{tmp_path / "x.png"}")')
+    assert "matplotlib.pyplot" not in sys.modules
+
+def test_bad_path(tmp_path):
+    with pytest.raises(KaRuntimeError):
+        run(f'save(line({{1,2}}, {{3,4}}), "{tmp_path / "nope" / "x.png"}")')
@@ -0,0 +1,101 @@
+import io
+from decimal import Decimal
+from fractions import Fraction as frac
+
+import pytest
+
+import ka.config
+import ka.precision
+from ka.precision import load_mpmath, format_decimal
+from ka.tokens import tokenise
+from ka.parse import parse_tokens
+from ka.eval import eval_parse_tree
+from ka.interpret import execute
+from ka.types import Quantity, Set
+from ka.units import M
+
+PI_50 = "3.1415926535897932384626433832795028841971693993751"
+E_50 = "2.7182818284590452353602874713526624977572470937"
+
+@pytest.fixture(params=["mpmath", "decimal"])
+def engine(request, monkeypatch):
+    if request.param == "mpmath":
+        if not load_mpmath():
+            pytest.skip("mpmath isn't installed.")
+    else:
+        monkeypatch.setattr(ka.precision, "mpmath", False)
+
+@pytest.fixture
+def digits(monkeypatch):
+    monkeypatch.setitem(ka.config.CONFIG, "decimal-precision", 50)
+    # The cached constants might have come from the other engine.
+    monkeypatch.setattr(ka.precision, "CONSTANTS", {})
+
+def evaluate(s):
+    return eval_parse_tree(parse_tokens(tokenise(s)))
+
+def formatted(s):
+    return format_decimal(evaluate(s))
+
+def test_off_by_default():
+    assert evaluate("0.1+0.2") == 0.1+0.2
+    assert type(evaluate("sin(1)")) is float
+
+def test_literals(digits):
+    assert evaluate("0.1+0.2") == Decimal("0.3")
+    assert evaluate("1.5e3") == 1500
+    assert type(evaluate("2*0.5")) is int
+    assert type(evaluate("1.0")) is int
+    # Too big to be a float, and too big to be worked out as an integer.
+    assert formatted("1.5e300^1000").startswith("1.2338405969061734792274390994")
+    assert evaluate("1/3") == frac(1, 3)
+
+def test_constants(engine, digits):
+    assert formatted("pi") == PI_50
+    assert formatted("e") == E_50
+    assert evaluate("pi=3;pi") == 3
+
+def test_functions(engine, digits):
+    assert formatted("sqrt(2)") == "1.4142135623730950488016887242096980785696718753769"
+    assert formatted("2^(1/2)") == "1.4142135623730950488016887242096980785696718753769"
+    assert formatted("ln(10)") == "2.3025850929940456840179914546843642076011014886288"
+    assert evaluate("log2(8)") == 3
+    assert formatted("sin(1)") == "0.84147098480789650665250232163029899962256306079837"
+    assert formatted("cos(1)") == "0.54030230586813971740093660744297660373231042061792"
+    assert formatted("tan(1)") == "1.5574077246549022305069748074583601730872507723815"
+    assert formatted("e^pi") == "23.1406926327792690057290863679485473802661062426"
+    assert abs(evaluate("sin(pi)")) < Decimal("1e-50")
+
+def test_big_arguments(engine, digits):
+    assert formatted("sin(10^30)") == "-0.090116901912138058030386428952987330274396332993043"
+
+def test_mixed_arithmetic(digits):
+    assert evaluate("0.5 + 1/4") == Decimal("0.75")
+    assert evaluate("1/4 < 0.3") == 1
+    assert evaluate("-10.5 % 3") == Decimal("1.5")
+    assert evaluate("1.5 feet") == Quantity(Decimal("0.4572"), M)
+
+def test_sets(digits):
+    assert evaluate("set({0.1, 1/10})") == Set.from_values([Decimal("0.1")])
+    assert (evaluate("set({0.5, 1/2, 0.1+0.2, 0.3})")
+            == Set.from_values([Decimal("0.5"), Decimal("0.3")]))
+
+def test_float_only_functions(digits):
+    assert evaluate("#2020-01-01# + 1.5 days") == evaluate("#2020-01-02T12:00:00#")
+    assert evaluate("#2020-01-01# - 0.5 days") == evaluate("#2019-12-31T12:00:00#")
+    assert 0 <= evaluate("sample(Uniform(0, 1.5))") <= 1.5
+    assert type(evaluate("sample(Gaussian(0.5, 0.1))")) is float
+    assert abs(evaluate("P(Gaussian(0, 1) < 0.5)") - 0.691462) < 1e-6
+    assert abs(evaluate("P(0.5 < Uniform(0, 2) < 1.5)") - 0.5) < 1e-9
+
+def test_display(digits):
+    out = io.StringIO()
+    execute("1/3", out=out)
+    assert out.getvalue() == "1/3     (0." + "3"*50 + ")\n"
+    assert format_decimal(Decimal("1.23E+70")) == "1.23e+70"
+    assert format_decimal(Decimal("0.0001")) == "0.0001"
+
+def test_cached_results_depend_on_precision(monkeypatch):
+    assert type(evaluate("sqrt(2)")) is float
+    monkeypatch.setitem(ka.config.CONFIG, "decimal-precision", 50)
+    assert type(evaluate("sqrt(2)")) is Decimal
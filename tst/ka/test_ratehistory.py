@@ -0,0 +1,75 @@
+import datetime
+import os
+
+import pytest
+
+import ka.config
+from ka.currency import CurrencyData
+from ka.ratehistory import RateHistory, RateHistoryError, add_rates, convert_at
+from ka.tokens import tokenise
+from ka.parse import parse_tokens
+from ka.eval import eval_parse_tree
+from ka.types import KaRuntimeError
+
+def day(s):
+    return datetime.date.fromisoformat(s)
+
+def rates(eur, gbp=None):
+    cs = [CurrencyData("usd", "usdollar", 1.0), CurrencyData("eur", "euro", eur)]
+    if gbp is not None:
+        cs.append(CurrencyData("gbp", "britishpound", gbp))
+    return cs
+
+@pytest.fixture
+def history_path(tmp_path):
+    path = tmp_path / "history"
+    add_rates(path, day("2023-01-01"), rates(0.5))
+    add_rates(path, day("2023-03-01"), rates(0.25))
+    return path
+
+def test_lookup_uses_latest_rates_on_or_before_date(history_path):
+    with RateHistory(history_path) as h:
+        assert len(h) == 2
+        assert h.dollar_rate("eur", day("2023-01-01")) == 0.5
+        assert h.dollar_rate("eur", day("2023-02-28")) == 0.5
+        assert h.dollar_rate("eur", day("2023-03-01")) == 0.25
+        assert h.dollar_rate("eur", day("2030-01-01")) == 0.25
+        with pytest.raises(RateHistoryError):
+            h.dollar_rate("eur", day("2022-12-31"))
+        with pytest.raises(RateHistoryError):
+            h.dollar_rate("xyz", day("2023-01-01"))
+
+def test_append_is_in_place(history_path):
+    size = os.path.getsize(history_path)
+    add_rates(history_path, day("2023-04-01"), rates(0.125))
+    # Header stays the same, one 3-column record gets added.
+    assert os.path.getsize(history_path) == size + 8*3
+    assert convert_at(1, "usd", "eur", day("2023-04-02"), path=history_path) == 0.125
+
+def test_out_of_order_and_new_currencies(history_path):
+    add_rates(history_path, day("2023-02-01"), rates(2.0, gbp=4.0))
+    add_rates(history_path, day("2023-03-01"), rates(3.0))
+    with RateHistory(history_path) as h:
+        assert h.codes == ["eur", "gbp", "usd"]
+        assert [h.date_ordinal(i) for i in range(len(h))] == [
+            day("2023-01-01").toordinal(),
+            day("2023-02-01").toordinal(),
+            day("2023-03-01").toordinal()]
+        assert h.dollar_rate("gbp", day("2023-02-15")) == 4.0
+        assert h.dollar_rate("eur", day("2023-03-01")) == 3.0
+        # gbp wasn't known back then.
+        with pytest.raises(RateHistoryError):
+            h.dollar_rate("gbp", day("2023-01-01"))
+
+def test_convert_function(history_path, monkeypatch):
+    monkeypatch.setitem(ka.config.CONFIG, "currency-history-path", str(history_path))
+    def run(s):
+        return eval_parse_tree(parse_tokens(tokenise(s)))
+    assert run('convert(100, "usd", "eur", #2023-02-01#)') == 50
+    assert run('convert(100, "EUR", "$", #2023-03-05#)') == 400
+    with pytest.raises(KaRuntimeError):
+        run('convert(100, "usd", "eur", #2020-01-01#)')
+
+def test_missing_history(tmp_path):
+    with pytest.raises(RateHistoryError):
+        convert_at(1, "usd", "eur", day("2023-01-01"), path=tmp_path / "nothing")
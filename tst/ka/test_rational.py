@@ -0,0 +1,45 @@
+from fractions import Fraction as frac
+
+import pytest
+
+import ka.rational
+from ka.rational import exact_sum, exact_prod, from_backend, load_gmpy2
+from ka.types import simplify_number
+
+@pytest.fixture(params=["gmpy2", "python"])
+def backend(request, monkeypatch):
+    if request.param == "gmpy2":
+        if not load_gmpy2():
+            pytest.skip("gmpy2 isn't installed.")
+    else:
+        monkeypatch.setattr(ka.rational, "gmpy2", False)
+
+def test_sum(backend):
+    assert exact_sum([]) == 0
+    assert exact_sum([frac(1, 3)]) == frac(1, 3)
+    assert exact_sum([frac(1, x) for x in range(1, 5)]) == frac(25, 12)
+    assert exact_sum([frac(1, 2), frac(1, 2), 1]) == 2
+    assert exact_sum([1, 2, 3]) == 6
+    xs = [frac(x, x+1) for x in range(1, 100)]
+    assert exact_sum(xs) == sum(xs)
+
+def test_prod(backend):
+    assert exact_prod([]) == 1
+    assert exact_prod([frac(x+1, x) for x in range(1, 100)]) == 100
+    assert exact_prod(list(range(1, 30))) == 8841761993739701954543616000000
+    assert exact_prod([frac(2, 3), frac(3, 5), 7]) == frac(14, 5)
+
+def test_results_are_python_types(backend):
+    # Otherwise they'd print differently, and fail type checks.
+    assert type(exact_sum([frac(1, 2), frac(1, 3)])) is frac
+    assert type(exact_sum([frac(1, 2), frac(1, 2)])) in (int, frac)
+    assert type(simplify_number(exact_prod([frac(1, 2), 2]))) is int
+
+def test_backend_values_are_converted():
+    gmpy2 = load_gmpy2()
+    if not gmpy2:
+        pytest.skip("gmpy2 isn't installed.")
+    assert type(from_backend(gmpy2.mpq(1, 2))) is frac
+    assert simplify_number(gmpy2.mpq(4, 2)) == 2
+    assert type(simplify_number(gmpy2.mpq(4, 2))) is int
+    assert type(simplify_number(gmpy2.mpq(1, 3))) is frac
@@ -0,0 +1,57 @@
+import random
+from fractions import Fraction as frac
+
+import pytest
+
+from ka.selection import select
+from ka.tokens import tokenise
+from ka.parse import parse_tokens
+from ka.eval import eval_parse_tree
+from ka.functions import FunctionArgError
+from ka.types import Array, Quantity, instant_from_iso
+from ka.units import M
+
+def run(s):
+    return eval_parse_tree(parse_tokens(tokenise(s)))
+
+@pytest.mark.parametrize("n", [1, 2, 15, 16, 17, 1000])
+def test_select_matches_sorting(n):
+    rng = random.Random(n)
+    for xs in [[rng.random() for _ in range(n)],
+               [rng.randint(0, 5) for _ in range(n)],
+               list(range(n)),
+               list(range(n, 0, -1))]:
+        ranks = [0, n//2, n-1, rng.randrange(n)]
+        expected = sorted(xs)
+        assert select(xs, ranks) == dict((r, expected[r]) for r in ranks)
+
+def test_median():
+    assert run("median({3, 1, 2})") == 2
+    assert run("median({4, 1, 3, 2})") == frac(5, 2)
+    assert run("median({1/3, 0.5, 1/4})") == frac(1, 3)
+    assert run("median({1m, 2km, 3m})") == Quantity(3, M)
+    assert run("median({1m, 2m})") == Quantity(frac(3, 2), M)
+
+def test_percentile():
+    assert run("percentile(1..5, 0)") == 1
+    assert run("percentile(1..5, 25)") == 2
+    assert run("percentile(1..5, 100)") == 5
+    assert run("percentile({1, 2}, 50)") == frac(3, 2)
+    assert run("percentile({1.5, 2.5}, 30)") == pytest.approx(1.8)
+    assert run("percentile({2m, 1m}, 25)") == Quantity(frac(5, 4), M)
+    # Values that can only be compared by dispatching.
+    assert (run("percentile({#2021-01-01#, #2019-01-01#, #2020-01-01#}, 50)")
+            == instant_from_iso("2020-01-01"))
+
+def test_quantiles():
+    # Same as Python's statistics.quantiles(..., method="inclusive").
+    assert run("quantiles(1..10, 4)") == Array([frac(13, 4), frac(11, 2), frac(31, 4)])
+    assert run("quantiles({5, 1}, 2)") == Array([3])
+    assert run("quantiles({1}, 1)") == Array([])
+
+@pytest.mark.parametrize("s", ["median({})", "percentile({}, 10)",
+                               "percentile({1}, 101)", "percentile({1}, -1)",
+                               "quantiles({1}, 0)"])
+def test_bad_arguments(s):
+    with pytest.raises(FunctionArgError):
+        run(s)
@@ -0,0 +1,112 @@
+import asyncio
+import json
+import time
+
+import ka.config
+import ka.plot
+import ka.server
+from ka.server import EvalService, evaluate, request_limits
+
+def test_evaluate():
+    assert evaluate("x = 3; 2 m * x") == {
+        "ok": True, "value": "6 m", "type": "Quantity", "output": "6 m"}
+    assert evaluate("1/2 + 1/3")["value"] == "5/6"
+    assert evaluate("x = 1")["value"] == "1"
+    result = evaluate("1 +")
+    assert not result["ok"]
+    assert result["error"].startswith("Unexpected")
+    assert not evaluate("counts({1, 2, 3}, num_bins: 2.5)")["ok"]
+
+def test_sessions():
+    evaluate("y = 2", session="a")
+    assert evaluate("y*3", session="a")["value"] == "6"
+    assert not evaluate("y*3", session="b")["ok"]
+    assert not evaluate("y*3")["ok"]
+
+def test_sessions_have_their_own_functions():
+    assert evaluate("y = 10; f(x) = x + y; f(1)", session="c")["value"] == "11"
+    assert not evaluate("y = 100; f(1)", session="d")["ok"]
+    assert not evaluate("f(1)")["ok"]
+    assert evaluate("f(x) = 2*x; f(1)", session="d")["value"] == "2"
+    assert evaluate("f(1)", session="c")["value"] == "11"
+
+def test_limits(monkeypatch):
+    start = time.monotonic()
+    for source in ["x = 3^(10^8); 1", "x = 3^(10^5); y = x*x; y = y*y; y*y",
+                   "size(1..(10^8))"]:
+        assert not evaluate(source)["ok"]
+    assert time.monotonic() - start < 5
+    # The config can only make them stricter.
+    monkeypatch.setitem(ka.config.CONFIG, "timeout", 1000)
+    monkeypatch.setitem(ka.config.CONFIG, "max-elements", 100)
+    limits = request_limits()
+    assert limits.timeout == ka.server.DEFAULT_TIMEOUT
+    assert limits.max_elements == 100
+    assert limits.max_int_bits == ka.server.DEFAULT_MAX_INT_BITS
+
+def test_no_plot_output(tmp_path, monkeypatch):
+    monkeypatch.setattr(ka.plot, "OUTPUT_ENABLED", False)
+    path = tmp_path / "plot.png"
+    for source in ["plot(line({1, 2}, {1, 2}))",
+                   f'plot(line({{1, 2}}, {{1, 2}}), output: "{path}")',
+                   f'save(line({{1, 2}}, {{1, 2}}), "{path}")']:
+        result = evaluate(source)
+        assert not result["ok"]
+        assert "Plots can't be shown or saved" in result["error"]
+    assert not path.exists()
+
+def test_unexpected_errors(monkeypatch):
+    def execute(*args, **kwargs):
+        raise AttributeError("oops")
+    monkeypatch.setattr(ka.server, "execute", execute)
+    assert evaluate("1") == {
+        "ok": False, "error": "Internal error: AttributeError('oops')"}
+
+async def request(port, body, method="POST", path="/eval"):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    data = json.dumps(body).encode() if not isinstance(body, bytes) else body
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\n"
+                 f"Content-Length: {len(data)}\r\n\r\n".encode() + data)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), json.loads(body)
+
+def test_service():
+    async def run():
+        service = EvalService(workers=2, idle_timeout=60)
+        await service.start(0)
+        try:
+            port = service.port
+            assert await request(port, {"source": "z = 5", "session": "s"}) == (
+                200, {"ok": True, "value": "5", "type": "Integral", "output": "5"})
+            statuses = await asyncio.gather(*(
+                request(port, {"source": "z^2", "session": "s"})
+                for _ in range(4)))
+            assert all(r == (200, {"ok": True, "value": "25", "type": "Integral", "output": "25"})
+                       for r in statuses)
+            status, body = await request(port, {"source": "z", "session": "t"})
+            assert status == 200 and not body["ok"]
+            assert (await request(port, {"source": 1}))[0] == 400
+            assert (await request(port, b"{not json"))[0] == 400
+            assert (await request(port, {}, path="/"))[0] == 404
+            assert (await request(port, {}, method="GET"))[0] == 405
+            # The workers can't write files.
+            status, body = await request(port, {"source": 'save(line({1}, {1}), "x.png")'})
+            assert status == 200 and "Plots can't be shown" in body["error"]
+
+            async def broken_evaluate(source, session_id=None):
+                raise TypeError("oops")
+            service.evaluate = broken_evaluate
+            assert await request(port, {"source": "1"}) == (
+                500, {"ok": False, "error": "Internal error: TypeError('oops')"})
+            del service.evaluate
+
+            assert service.evict_idle_sessions() == 0
+            assert service.evict_idle_sessions(now=service.sessions["s"].last_used + 61) == 2
+            status, body = await request(port, {"source": "z", "session": "s"})
+            assert not body["ok"]
+        finally:
+            await service.close()
+    asyncio.run(run())
@@ -0,0 +1,85 @@
+import io
+from decimal import Decimal
+from fractions import Fraction as frac
+
+import pytest
+
+import ka.snapshot
+from ka.snapshot import save, load, restore, SnapshotError
+from ka.eval import EvalEnvironment
+from ka.interpret import execute, recompute
+from ka.types import Array, Combinatoric
+from ka.probability import Binomial, Gaussian
+
+def run(env, *commands):
+    out = io.StringIO()
+    for s in commands:
+        execute(s, env, out=out, errout=out)
+    return out.getvalue()
+
+def round_trip(env, tmp_path):
+    path = tmp_path.joinpath("s.kasnap")
+    assert save(env, path) == []
+    loaded = EvalEnvironment()
+    restore(loaded, load(path), "%load s")
+    return loaded
+
+def test_round_trip(tmp_path):
+    env = EvalEnvironment()
+    run(env,
+        "a = 2^100", "b = -3/7", "c = 1.5", "d = \"text\"",
+        "e = {1, 2.5, 3/4, {-1, 2^70}}", "f = {1.5, 2.25, -0.0}",
+        "g = {1, 2, -3}", "h = set({1, 2})", "i = 3 km|s",
+        "j = [1, 2.5]", "k = #2024-01-02 03:04:05#", "l = C(100, 50)",
+        "m = Binomial(10, 1/3)", "n = Gaussian(1, 2)", "o = {}", "pi = 3")
+    loaded = round_trip(env, tmp_path)
+    for name in "abcdefghijko":
+        assert loaded.get_variable(name) == env.get_variable(name), name
+    assert type(loaded.get_variable("f").contents[0]) is float
+    l = loaded.get_variable("l")
+    assert isinstance(l, Combinatoric) and l == 100891344545564193334812497256
+    m = loaded.get_variable("m")
+    assert isinstance(m, Binomial) and (m.n, m.p) == (10, frac(1, 3))
+    assert isinstance(loaded.get_variable("n"), Gaussian)
+    assert loaded.get_variable("pi") == 3
+    assert run(loaded, "i to m|s") == "3000\n"
+
+def test_big_arrays_are_memory_mapped(tmp_path, monkeypatch):
+    monkeypatch.setattr(ka.snapshot, "MMAP_THRESHOLD", 0)
+    env = EvalEnvironment()
+    env.set_variable("xs", Array([x/3 for x in range(1000)]))
+    env.set_variable("d", Decimal("1.25"))
+    loaded = round_trip(env, tmp_path)
+    assert loaded.get_variable("xs") == env.get_variable("xs")
+    assert loaded.get_variable("d") == Decimal("1.25")
+
+def test_unsupported_values_are_skipped(tmp_path):
+    env = EvalEnvironment()
+    run(env, "x = 1", "p = Binomial(3, 1/2) > 1")
+    path = tmp_path.joinpath("s.kasnap")
+    assert save(env, path) == ["p"]
+    assert load(path) == {"x": 1}
+
+def test_bad_files(tmp_path):
+    with pytest.raises(SnapshotError):
+        load(tmp_path.joinpath("missing.kasnap"))
+    path = tmp_path.joinpath("bad.kasnap")
+    path.write_bytes(b"not a snapshot")
+    with pytest.raises(SnapshotError):
+        load(path)
+    env = EvalEnvironment()
+    env.set_variable("x", "some text")
+    save(env, path)
+    path.write_bytes(path.read_bytes()[:-3])
+    with pytest.raises(SnapshotError):
+        load(path)
+
+def test_loaded_variables_can_be_recomputed(tmp_path):
+    env = EvalEnvironment()
+    run(env, "p = 1")
+    save(env, tmp_path.joinpath("s.kasnap"))
+    run(env, "p = 2", "q = p*10")
+    restore(env, load(tmp_path.joinpath("s.kasnap")), "%load s")
+    out = io.StringIO()
+    recompute(env, out=out, errout=out)
+    assert out.getvalue() == "  q = p*10\n10\n"
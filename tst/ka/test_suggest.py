@@ -0,0 +1,42 @@
+import io
+
+from ka.suggest import SuggestionIndex, edit_distance
+from ka.functions import suggest_functions
+from ka.units import suggest_units
+from ka.interpret import execute
+
+def test_edit_distance():
+    assert edit_distance("sin", "sin", 2) == 0
+    assert edit_distance("sni", "sin", 2) == 1
+    assert edit_distance("sqr", "sqrt", 2) == 1
+    assert edit_distance("kitten", "sitting", 2) == 3
+    assert edit_distance("a", "abcdefg", 2) == 3
+
+def test_closest_words_are_suggested():
+    index = SuggestionIndex(["sine", "sin", "sign", "cosine", "sinh"])
+    assert index.suggest("sinr") == ["sin", "sine", "sinh"]
+    assert index.suggest("cosin") == ["cosine"]
+    assert index.suggest("csoine") == ["cosine"]
+    assert index.suggest("tangent") == []
+    # Too short to guess.
+    assert index.suggest("s") == []
+    index.add("sinr")
+    assert index.suggest("sinr") == ["sin", "sine", "sinh"]
+    assert index.suggest("sinr", exists=lambda w: w != "sinh") == ["sin", "sine"]
+    assert index.suggest("signn") == ["sign"]
+
+def test_functions_and_units():
+    assert suggest_functions("sni") == ["sin"]
+    assert suggest_functions("memoise") == ["memoize"]
+    assert suggest_units("metr") == ["metre"]
+    assert suggest_units("kilometr") == ["kilometre"]
+
+def test_error_messages():
+    out = io.StringIO()
+    execute("sqr(2)", out=out, errout=out)
+    execute("5 metr", out=out, errout=out)
+    assert out.getvalue() == "\n".join([
+        "Unknown function: 'sqr'",
+        "  You may have meant: sqrt",
+        "Unknown unit 'metr'. (Remember that it's case-sensitive).",
+        "  You may have meant: metre", ""])
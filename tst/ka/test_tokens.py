@@ -1,7 +1,9 @@
+import io
+
 import pytest
 
 from ka.tokens import (tokenise, Tokens, UnknownTokenError, BadNumberError,
-                       UnclosedInstantError)
+                       UnclosedInstantError, split_statements)
 
 def test_tokenise_valid_tokens():
     expected = [
@@ -96,3 +98,22 @@ def test_instant():
 def test_unclosed_instant():
     with pytest.raises(UnclosedInstantError):
         tokenise("#1984-01-01")
+
+def test_split_statements():
+    lines = io.StringIO('x = 1;\n\ny = "a;\nb"; z\n\n  = 2;\n1+\n2')
+    assert list(split_statements(lines)) == [
+        ("x = 1", 1),
+        ('y = "a;\nb"', 3),
+        ("z\n\n  = 2", 4),
+        ("1+\n2", 7)]
+    assert list(split_statements(["1;;", " "])) == [("1", 1)]
+    assert list(split_statements(["x = 1;", "@;", "y = 2"])) == [
+        ("x = 1", 1), ("@;", 1)]
+    assert list(split_statements(['"a\\', '";"; #;#;', "1"])) == [
+        ('"a\\";"', 1), ("#;#", 1), ("1", 1)]
+
+def test_split_long_statement():
+    lines = ["x = {\n"] + ["1,\n"]*100000 + ["1};\n", "x"]
+    statements = list(split_statements(lines))
+    assert statements[0] == ("".join(lines[:-1])[:-2], 1)
+    assert statements[1] == ("x", 100003)